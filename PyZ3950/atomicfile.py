@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""Replacing a file so that readers (and a crash) see either its old
+contents or all of the new ones, never part of a write.  Used for
+profile stores, harvest checkpoints and manifests, and MARC indexes.
+
+Sample usage:
+    from PyZ3950 import atomicfile
+    atomicfile.write ('state.json', lambda f: json.dump (state, f))
+"""
+
+import os
+import tempfile
+
+def write (path, fill, binary = 0, sync = 0):
+    """Replace the file at path with what fill, a function of a file
+    object (opened for binary writing if binary), writes to it.  The
+    new contents go to a temporary file in path's directory, renamed
+    over path once complete (and, if sync, flushed to disk first).  If
+    fill raises, path is left as it was."""
+    dirname = os.path.dirname (os.path.abspath (path))
+    (fd, tmp) = tempfile.mkstemp (dir = dirname, suffix = '.tmp')
+    try:
+        f = os.fdopen (fd, binary and 'wb' or 'w')
+        try:
+            fill (f)
+            if sync:
+                f.flush ()
+                os.fsync (f.fileno ())
+        finally:
+            f.close ()
+        try:
+            os.rename (tmp, path)
+        except OSError: # Windows won't rename over an existing file
+            os.remove (path)
+            os.rename (tmp, path)
+    except:
+        if os.path.exists (tmp):
+            os.remove (tmp)
+        raise
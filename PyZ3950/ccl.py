@@ -22,7 +22,10 @@ a single query, but for now I don't.
 """
 
 
+import re
 import string
+import copy
+import threading
 
 in_setup = 0
 
@@ -56,9 +59,22 @@ t_LPAREN= r'\('
 t_RPAREN= r'\)'
 t_COMMA = r','
 t_SLASH = r'/'
+
+def _ci (word):
+    """Case-insensitive regexp for word.  (We can't use (?i): PLY joins
+    all the token regexps into one, and Python only accepts global flags
+    at the start of a regexp.)"""
+    l = []
+    for c in word:
+        if c.isalpha ():
+            l.append ("[%s%s]" % (c.upper (), c.lower ()))
+        else:
+            l.append (re.escape (c))
+    return "".join (l)
+
 def t_ATTRSET(t):
-    r'(?i)ATTRSET'
     return t
+t_ATTRSET.__doc__ = _ci ('ATTRSET')
 
 def t_SET (t): # need to def as function to override parsing as WORD, gr XXX
     r'(SET)'
@@ -96,8 +112,8 @@ def t_QUAL(t):
     return t
 
 def mk_quals ():
-    quals = ("|".join (['(' + x + ')' for x in list(qual_dict.keys())]))
-    t_QUAL.__doc__ = "(?i)" + quals + r"|(\([0-9]+,[0-9]+\))"
+    quals = ("|".join (['(' + _ci (x) + ')' for x in list(qual_dict.keys())]))
+    t_QUAL.__doc__ = quals + r"|(\([0-9]+,[0-9]+\))"
 
 def t_QUOTEDVALUE(t):
     r"(\".*?\")"
@@ -111,8 +127,8 @@ word_non_init = r",|\.|\'"
 t_WORD = "(%s)(%s|%s)*" % (word_init, word_init, word_non_init)
 
 def t_LOGOP(t):
-    r'(?i)(AND)|(OR)|(NOT)'
     return t
+t_LOGOP.__doc__ = "(%s)|(%s)|(%s)" % (_ci ('AND'), _ci ('OR'), _ci ('NOT'))
 
 
 t_ignore = " \t"
@@ -125,10 +141,15 @@ from ply import lex
 
 
 
+_lexer_generation = 0
+"""Bumped whenever the lexer is regenerated, so per-thread copies of
+the old one get replaced"""
+
 def relex ():
-    global lexer
+    global lexer, _lexer_generation
     mk_quals ()
     lexer = lex.lex()
+    _lexer_generation += 1
 
 relex ()
 
@@ -254,7 +275,34 @@ precedence = (
     ('left', 'LOGOP'),
     )
 
-yacc.yacc (debug=0, tabmodule = 'PyZ3950_parsetab')
+parser = yacc.yacc (debug=0, tabmodule = 'PyZ3950_parsetab')
+
+_thread_state = threading.local ()
+
+def _get_lexer_parser ():
+    """Return this thread's private (lexer, parser) pair, creating them
+    on the thread's first parse (or first parse after relex).  Both
+    keep per-parse state in instance attributes, so they can't be
+    shared between threads, but the expensive parts (the lexer's
+    compiled regexps and the parser's tables) are shared by the copies."""
+    st = _thread_state
+    if getattr (st, 'generation', None) != _lexer_generation:
+        st.lexer = _copy_lexer ()
+        st.parser = copy.copy (parser)
+        st.generation = _lexer_generation
+    return (st.lexer, st.parser)
+
+def _copy_lexer ():
+    if hasattr (lexer, 'clone'):
+        return lexer.clone ()
+    # PLY 1.0 lacks __copy__, and in PLY 1.3.1-1.5 it's broken and
+    # returns None
+    copiedlexer = None
+    if hasattr (lexer, '__copy__'):
+        copiedlexer = lexer.__copy__ ()
+    if copiedlexer == None:
+        copiedlexer = lex.lex ()
+    return copiedlexer
 #yacc.yacc (debug=0, tabpackage = 'PyZ3950', tabmodule='PyZ3950_parsetab')
 
 
@@ -306,25 +354,11 @@ def tree_to_q (ast):
     raise UnimplError("Bad ast type " + str(ast.type))
 
 def mk_rpn_query (query):
-    """Transform a CCL query into an RPN query."""
-    # need to copy or create a new lexer because it contains globals
-    # PLY 1.0 lacks __copy__
-    # PLY 1.3.1-1.5 have __copy__, but it's broken and returns None
-    # I sent David Beazley a patch, so future PLY releases will
-    # presumably work correctly.
-    # Recreating the lexer each time is noticeably slower, so this solution
-    # is suboptimal for PLY <= 1.5, but better than being thread-unsafe.
-    # Perhaps I should have per-thread lexer instead XXX
-    # with example/twisted/test.py set to parse_only, I get 277 parses/sec
-    # with fixed PLY, vs. 63 parses/sec with broken PLY, on my 500 MHz PIII
-    # laptop.
-    
-    copiedlexer = None
-    if hasattr (lexer, '__copy__'):
-        copiedlexer = lexer.__copy__ ()
-    if copiedlexer == None:
-        copiedlexer = lex.lex ()
-    ast = yacc.parse (query, copiedlexer)
+    """Transform a CCL query into an RPN query.  Thread-safe: each
+    thread parses with its own copies of the lexer and parser (see
+    _get_lexer_parser), made once per thread rather than per call."""
+    (threadlexer, threadparser) = _get_lexer_parser ()
+    ast = threadparser.parse (query, lexer = threadlexer)
     return ast_to_rpn (ast)
 
 def ast_to_rpn (ast):
@@ -346,8 +380,8 @@ def testlex (s):
         print(token)
             
 def testyacc (s):
-    copylex = lexer.__copy__ ()
-    ast = yacc.parse (s, lexer = copylex)
+    (copylex, copyparser) = _get_lexer_parser ()
+    ast = copyparser.parse (s, lexer = copylex)
     print("AST:", ast)
     print("RPN Query:", ast_to_rpn (ast))
 
@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+
+"""A 'marc8' codec for Python's codecs machinery.
+
+Importing this module registers the codec, after which MARC-8 can be
+used wherever Python takes an encoding name:
+
+    from PyZ3950 import marc8
+    text = raw.decode ('marc8')
+    raw = text.encode ('marc8')
+    f = io.TextIOWrapper (open ('titles.txt', 'rb'), encoding = 'marc8')
+
+zdefs imports it, so 'marc8' can also be negotiated as a Z39.50
+character set and passed to asn1 set_codec.
+
+Unlike zmarc.MARC8_to_Unicode, which works on field text and drops
+control characters, the codec is lossless for whole records: controls
+(including the ISO 2709 terminators) pass through, escape sequences
+are parsed as the MARC-8 spec gives them, and the incremental decoder
+and encoder keep the G0 and G1 sets across chunks.  Both sets go back
+to the defaults (basic Latin and ANSEL) at each field terminator,
+record terminator and newline, since MARC-8 text starts there in the
+default state.
+
+Decoding translates a run of text at a time, as MARC8_to_Unicode
+does, and returns NFC.  Encoding takes any normalization form: a
+character MARC-8 doesn't have is decomposed, and combining marks are
+moved in front of their base character.  When a character isn't in
+the current G0 or G1 set, the encoder designates the set which can
+encode the longest run of the following text, so mixed text takes few
+escape sequences.  A combining mark should be given to the incremental
+encoder in the same chunk as its base character.
+
+See http://www.loc.gov/marc/specifications/speccharmarc8.html
+"""
+
+import re
+import codecs
+import functools
+import unicodedata
+
+from PyZ3950 import marc_to_unicode
+
+basic_latin = 0x42
+ansel = 0x45
+eacc = 0x31
+multibyte = (eacc,)
+technique1 = (0x62, 0x67, 0x70) # subscripts, Greek symbols, superscripts
+"""Sets designated by ESC and their final character alone"""
+
+lookahead = 32
+"""Characters the encoder looks ahead when choosing a set"""
+
+_special_re = re.compile ('[\x1b\x1d\x1e\n]')
+# whole characters (the last byte can be 0x20, as in EACC 0x212320),
+# or the start of one
+_multibyte_re = re.compile ('(?:[\x21-\x7e]{2}[\x20-\x7e])+|[\x21-\x7e]+')
+_ascii_run_re = re.compile ('[ -~]+')
+_ascii_re = re.compile ('[\x00-\x7f]*\\Z') # str.isascii is 3.7+
+_resets = '\x1d\x1e\n'
+
+def _latin1 (input):
+    """Return bytes-like or str (one character per byte, as asn1
+    decodes strings) input as str"""
+    if isinstance (input, str):
+        return input
+    return bytes (input).decode ('latin-1')
+
+def _char_class (chars):
+    return ''.join ([re.escape (c) for c in sorted (chars)])
+
+def _swap_marks (m):
+    return m.group (2) + m.group (1) # faster than a template
+
+def _needs_nfc (u):
+    """Whether character u could be changed by NFC, or change its
+    neighbours"""
+    return (unicodedata.normalize ('NFC', u) != u or
+            unicodedata.category (u) [0] == 'M' or
+            unicodedata.combining (u) or '\u1160' <= u <= '\u11ff')
+
+_decode_tables = {}
+
+def single_byte_tables (g0, g1, controls = 1):
+    """Tables for translating single byte MARC-8 with G0 set g0 and G1
+    set g1, built on first use: (table, ascii, invalid, reorder,
+    trailing, nfc).  table is for str.translate; it keeps control
+    characters, or drops them (and anything in the C1 range) if
+    controls is false.  A set's characters can be designated into
+    either register.  ascii is true if printable ASCII translates to
+    itself.  invalid is a regexp
+    matching a character which is neither a control nor in either set,
+    reorder a function moving each run of combining marks after the
+    character following it, trailing a regexp matching a run of marks
+    at the end, and nfc a regexp matching characters whose translation
+    may need normalizing.  reorder, trailing and nfc are None if there
+    are no such characters.  zmarc.MARC8_to_Unicode uses these too."""
+    t = _decode_tables.get ((g0, g1, controls))
+    if t != None:
+        return t
+    g0set = marc_to_unicode.codesets [g0]
+    g1set = marc_to_unicode.codesets [g1]
+    table = {}
+    valid = [chr (d) for d in range (0x21)] + ['\x7f']
+    marks = []
+    nfc = []
+    for d in range (0x21, 0x100):
+        if d == 0x7f:
+            continue
+        if d < 0x7f:
+            if g0 in multibyte:
+                continue
+            entry = g0set.get (d) or g0set.get (d | 0x80)
+        elif d < 0xa0:
+            entry = g1set.get (d)
+            if entry == None:
+                valid.append (chr (d)) # C1 control
+                continue
+        else:
+            entry = g1set.get (d) or g1set.get (d & 0x7f)
+        if entry == None:
+            continue
+        (uni, cflag) = entry
+        table [d] = chr (uni)
+        valid.append (chr (d))
+        if cflag:
+            marks.append (chr (d))
+        if cflag or _needs_nfc (chr (uni)):
+            nfc.append (chr (d))
+    ascii = all ([table.get (d) == chr (d) and chr (d) not in marks
+                  for d in range (0x21, 0x7f)])
+    invalid = re.compile ('[^%s]' % _char_class (valid))
+    if not controls: # including ANSEL's C1 non-sort markers and joiners
+        for d in list (range (0x20)) + list (range (0x7f, 0xa0)):
+            table [d] = None
+    if marks:
+        marks = _char_class (marks)
+        trailing = re.compile ('[%s]+\\Z' % marks)
+        reorder = functools.partial (
+            re.compile ('([%s]+)([^%s])' % (marks, marks)).sub, _swap_marks)
+    else:
+        (reorder, trailing) = (None, None)
+    if nfc:
+        nfc = re.compile ('[%s]' % _char_class (nfc))
+    else:
+        nfc = None
+    t = (table, ascii, invalid, reorder, trailing, nfc)
+    _decode_tables [(g0, g1, controls)] = t
+    return t
+
+def _designation (text, pos):
+    """Parse the escape sequence starting at text [pos]: return
+    (register, charset, end), with register None if it isn't a valid
+    designation, or None if text ends first"""
+    end = len (text)
+    i = pos + 1
+    if i >= end:
+        return None
+    c = text [i]
+    if c in 'bgp':
+        return (0, ord (c), i + 1)
+    if c == 's':
+        return (0, basic_latin, i + 1)
+    if c == '$':
+        i += 1
+        if i >= end:
+            return None
+        c = text [i]
+        g = int (c in ')-')
+        if c in '(,)-':
+            i += 1
+    elif c in '(,)-':
+        g = int (c in ')-')
+        i += 1
+    else:
+        return (None, None, i)
+    if i < end and text [i] == '!':
+        i += 1
+    if i >= end:
+        return None
+    final = ord (text [i])
+    if final not in marc_to_unicode.codesets:
+        return (None, None, i + 1)
+    return (g, final, i + 1)
+
+
+class IncrementalDecoder (codecs.IncrementalDecoder):
+    """Decodes MARC-8, keeping the G0 and G1 sets, an incomplete escape
+    sequence or multibyte character, and combining marks still waiting
+    for their base character, from one call to the next"""
+    def __init__ (self, errors = 'strict'):
+        codecs.IncrementalDecoder.__init__ (self, errors)
+        self.reset ()
+    def reset (self):
+        self.g0 = basic_latin
+        self.g1 = ansel
+        self.buffer = ''
+    def getstate (self):
+        if self.g0 == basic_latin and self.g1 == ansel:
+            flags = 0
+        else:
+            flags = self.g0 << 8 | self.g1
+        return (self.buffer.encode ('latin-1'), flags)
+    def setstate (self, state):
+        (buffer, flags) = state
+        self.buffer = _latin1 (buffer)
+        if flags:
+            (self.g0, self.g1) = (flags >> 8, flags & 0xff)
+        else:
+            (self.g0, self.g1) = (basic_latin, ansel)
+
+    def _error (self, text, start, end, reason):
+        exc = UnicodeDecodeError ('marc8', text.encode ('latin-1', 'replace'),
+                                  start, end, reason)
+        return codecs.lookup_error (self.errors) (exc) [0]
+
+    def _single (self, text, start, stop, out, pending):
+        """Decode text [start:stop] with single byte sets onto out.
+        pending is [marks, where they started, (g0, g1) there], the
+        combining marks waiting for a base character.  Returns whether
+        out needs normalizing."""
+        (table, ascii, invalid, reorder, trailing, nfc) = (
+            single_byte_tables (self.g0, self.g1))
+        seg = text [start:stop]
+        if ascii and not pending [0] and _ascii_re.match (seg):
+            out.append (seg)
+            return 0
+        need = 0
+        while start < stop:
+            bad = invalid.search (text, start, stop)
+            if bad == None:
+                upto = stop
+            else:
+                upto = bad.start ()
+            seg = text [start:upto]
+            if nfc != None and nfc.search (seg) != None:
+                need = 1
+                if reorder != None:
+                    m = trailing.search (seg)
+                    if m != None:
+                        seg = seg [:m.start ()]
+                    seg = reorder (seg)
+                    self._emit (seg.translate (table), out, pending)
+                    seg = ''
+                    if m != None:
+                        if not pending [0]:
+                            pending [1:] = [start + m.start (),
+                                            (self.g0, self.g1)]
+                        pending [0] += m.group ().translate (table)
+            if seg:
+                self._emit (seg.translate (table), out, pending)
+            if bad == None:
+                break
+            self._emit (self._error (text, upto, upto + 1,
+                                     'not in the current G0 or G1 set'),
+                        out, pending)
+            start = upto + 1
+        return need
+
+    def _emit (self, s, out, pending):
+        if pending [0] and s:
+            s = s [0] + pending [0] + s [1:]
+            pending [0] = ''
+        out.append (s)
+
+    def _multibyte (self, text, start, stop, out, pending, final):
+        """Decode text [start:stop] with a multibyte G0 set, as
+        _single.  Returns where it stopped, short of stop if the text
+        ends partway through a character."""
+        codeset = marc_to_unicode.codesets [self.g0]
+        pos = start
+        for m in _multibyte_re.finditer (text, start, stop):
+            if m.start () > pos:
+                self._single (text, pos, m.start (), out, pending)
+            pos = m.start ()
+            end = m.end () - (m.end () - pos) % 3
+            for i in range (pos, end, 3):
+                code = (ord (text [i]) << 16 | ord (text [i + 1]) << 8 |
+                        ord (text [i + 2]))
+                entry = codeset.get (code)
+                if entry == None:
+                    self._emit (self._error (text, i, i + 3,
+                                             'not in the current G0 set'),
+                                out, pending)
+                elif entry [1]:
+                    if not pending [0]:
+                        pending [1:] = [i, (self.g0, self.g1)]
+                    pending [0] += chr (entry [0])
+                else:
+                    self._emit (chr (entry [0]), out, pending)
+            pos = end
+            if end < m.end ():
+                if m.end () == len (text) and not final:
+                    return end
+                self._emit (self._error (text, end, m.end (),
+                                         'incomplete multibyte character'),
+                            out, pending)
+                pos = m.end ()
+        if pos < stop:
+            self._single (text, pos, stop, out, pending)
+        return stop
+
+    def decode (self, input, final = False):
+        text = self.buffer + _latin1 (input)
+        self.buffer = ''
+        out = []
+        pending = ['', None, None]
+        need = 0
+        pos = 0
+        end = len (text)
+        while pos < end:
+            m = _special_re.search (text, pos)
+            if m == None:
+                stop = end
+            elif m.group () == '\x1b':
+                stop = m.start ()
+            else:
+                stop = m.end ()
+            if self.g0 in multibyte:
+                done = self._multibyte (text, pos, stop, out, pending, final)
+                need = 1
+                if done < stop:
+                    self.buffer = text [done:]
+                    break
+            else:
+                need = self._single (text, pos, stop, out, pending) or need
+            pos = stop
+            if m == None:
+                break
+            if stop == m.end ():
+                (self.g0, self.g1) = (basic_latin, ansel)
+                continue
+            d = _designation (text, pos)
+            if d == None:
+                if final:
+                    out.append (self._error (text, pos, end,
+                                             'incomplete escape sequence'))
+                else:
+                    self.buffer = text [pos:]
+                break
+            (g, charset, pos) = d
+            if g == None:
+                self._emit (self._error (text, stop, pos,
+                                         'invalid escape sequence'),
+                            out, pending)
+            elif g:
+                self.g1 = charset
+            else:
+                self.g0 = charset
+        if pending [0]:
+            if final:
+                out.append (pending [0])
+            else:
+                # decode the marks again with the text they combine with
+                self.buffer = text [pending [1]:]
+                (self.g0, self.g1) = pending [2]
+        s = ''.join (out)
+        if need:
+            s = unicodedata.normalize ('NFC', s)
+        return s
+
+
+_reverse = {}
+
+def _reverse_table ():
+    """Build the encoder's tables on first use: 'chars' maps each
+    character to [(charset, bytes)], basic Latin and ANSEL first,
+    'marks' is the set of MARC-8 combining marks, 'g1' the sets which
+    go in G1, 'simple' matches a run of characters which need no
+    reordering or decomposing and 'units' one which does, with the
+    combining marks after it."""
+    if _reverse:
+        return _reverse
+    rev = {}
+    marks = set ()
+    g1 = set ()
+    finals = sorted (marc_to_unicode.codesets.keys (),
+                     key = lambda f: (f not in (basic_latin, ansel), f))
+    for final in finals:
+        codeset = marc_to_unicode.codesets [final]
+        if final not in multibyte and min (codeset) >= 0x80:
+            g1.add (final)
+        for (code, (uni, cflag)) in codeset.items ():
+            if code < 0x20:
+                continue
+            if final in multibyte:
+                code = bytes ([code >> 16, (code >> 8) & 0xff, code & 0xff])
+            else:
+                code = bytes ([code])
+            rev.setdefault (chr (uni), []).append ((final, code))
+            if cflag:
+                marks.add (chr (uni))
+    for codes in rev.values ():
+        # a multibyte code with a space in it (EACC 0x212320, where
+        # 0x212321 will do) confuses decoders which take 0x20 as space
+        codes.sort (key = lambda e: len (e [1]) > 1 and b' ' in e [1])
+    simple = _char_class ([c for c in rev if c not in marks] +
+                          [chr (c) for c in range (0x20)] + ['\x7f'])
+    # only MARC-8's own combining marks are reordered: some characters
+    # Unicode has as combining (U+0670, say) MARC-8 has as spacing
+    combining = _char_class (marks)
+    _reverse ['chars'] = rev
+    _reverse ['marks'] = marks
+    _reverse ['g1'] = g1
+    _reverse ['simple'] = re.compile ('[%s]*' % simple)
+    _reverse ['units'] = re.compile ('[^%s][%s]+|[^%s]' %
+                                     (combining, combining, simple))
+    return _reverse
+
+def _recompose (unit, rev):
+    """Return unit, a base character and the combining marks after it,
+    as MARC-8 has it: decomposed, with the marks recomposed onto the
+    base while MARC-8 has the result (so U+1EF0, U with horn and dot
+    below, becomes U+01AF, U with horn, which ANSEL has, and a
+    combining dot below).  None if there's a character it can't
+    have."""
+    nfd = unicodedata.normalize ('NFD', unit)
+    base = nfd [0]
+    rest = []
+    for mark in nfd [1:]:
+        c = unicodedata.normalize ('NFC', base + mark)
+        if len (c) == 1 and c in rev:
+            base = c
+        elif mark in rev:
+            rest.append (mark)
+        else:
+            return None
+    if base not in rev:
+        return None
+    return base + ''.join (rest)
+
+def _designate (charset, g):
+    if g:
+        if charset == ansel:
+            return b'\x1b)!E'
+        return b'\x1b)' + bytes ([charset])
+    if charset in technique1:
+        return b'\x1b' + bytes ([charset])
+    if charset in multibyte:
+        return b'\x1b$' + bytes ([charset])
+    return b'\x1b(' + bytes ([charset])
+
+
+class IncrementalEncoder (codecs.IncrementalEncoder):
+    """Encodes to MARC-8, keeping the G0 and G1 sets from one call to
+    the next"""
+    def __init__ (self, errors = 'strict'):
+        codecs.IncrementalEncoder.__init__ (self, errors)
+        self.reset ()
+    def reset (self):
+        self.g0 = basic_latin
+        self.g1 = ansel
+    def getstate (self):
+        if self.g0 == basic_latin and self.g1 == ansel:
+            return 0
+        return self.g0 << 8 | self.g1
+    def setstate (self, state):
+        if state:
+            (self.g0, self.g1) = (state >> 8, state & 0xff)
+        else:
+            self.reset ()
+
+    def _default (self):
+        """Return the escapes going back to the default sets"""
+        s = b''
+        if self.g0 != basic_latin:
+            s = _designate (basic_latin, 0)
+        if self.g1 != ansel:
+            s += _designate (ansel, 1)
+        self.reset ()
+        return s
+
+    def _unit (self, text, start, end, rev, marks):
+        """Return text [start:end], a character and the combining marks
+        after it, in MARC-8 order"""
+        unit = text [start:end]
+        if unit [0] < ' ' or unit [0] == '\x7f':
+            return unit
+        for ch in unit:
+            if ch not in rev:
+                break
+        else:
+            if len (unit) == 1 or unit [0] in marks:
+                return unit
+            return unit [1:] + unit [0]
+        parts = _recompose (unit, rev)
+        if parts == None:
+            exc = UnicodeEncodeError ('marc8', text, start, end,
+                                      'no MARC-8 equivalent')
+            return _latin1 (codecs.lookup_error (self.errors) (exc) [0])
+        return parts [1:] + parts [0]
+
+    def _marc8_order (self, text, tables):
+        """Return text with characters MARC-8 doesn't have decomposed
+        (or replaced, as errors says), and combining marks before
+        their base character"""
+        if tables ['simple'].match (text).end () == len (text):
+            return text
+        (rev, marks) = (tables ['chars'], tables ['marks'])
+        out = []
+        pos = 0
+        for m in tables ['units'].finditer (text):
+            out.append (text [pos:m.start ()])
+            out.append (self._unit (text, m.start (), m.end (), rev, marks))
+            pos = m.end ()
+        out.append (text [pos:])
+        return ''.join (out)
+
+    def _covered (self, text, pos, g0, g1, rev):
+        """How many characters from text [pos] sets g0 and g1 cover"""
+        n = 0
+        for ch in text [pos:pos + lookahead]:
+            if ch in _resets:
+                break
+            if ch > ' ' and ch != '\x7f':
+                for (charset, code) in rev.get (ch, ()):
+                    if charset == g0 or charset == g1:
+                        break
+                else:
+                    break
+            n += 1
+        return n
+
+    def encode (self, input, final = False):
+        if (self.g0 == basic_latin and self.g1 == ansel and
+            _ascii_re.match (input)):
+            return input.encode ('ascii')
+        tables = _reverse_table ()
+        (rev, g1sets) = (tables ['chars'], tables ['g1'])
+        text = self._marc8_order (input, tables)
+        out = []
+        pos = 0
+        end = len (text)
+        while pos < end:
+            if self.g0 == basic_latin:
+                m = _ascii_run_re.match (text, pos)
+                if m != None:
+                    out.append (m.group ().encode ('ascii'))
+                    pos = m.end ()
+                    continue
+            ch = text [pos]
+            pos += 1
+            if ch <= ' ' or ch == '\x7f':
+                if ch in _resets:
+                    out.append (self._default ())
+                out.append (ch.encode ('ascii'))
+                continue
+            entries = rev.get (ch)
+            if entries == None:
+                # from an error handler
+                raise UnicodeEncodeError ('marc8', input, 0, len (input),
+                                          'no MARC-8 equivalent for %r' % ch)
+            for (charset, code) in entries:
+                if charset == self.g0 or charset == self.g1:
+                    out.append (code)
+                    break
+            else:
+                best = None
+                for (charset, code) in entries:
+                    if charset in g1sets:
+                        n = self._covered (text, pos - 1, self.g0, charset, rev)
+                    else:
+                        n = self._covered (text, pos - 1, charset, self.g1, rev)
+                    if best == None or n > best [0]:
+                        best = (n, charset, code)
+                (n, charset, code) = best
+                g = int (charset in g1sets)
+                out.append (_designate (charset, g))
+                out.append (code)
+                if g:
+                    self.g1 = charset
+                else:
+                    self.g0 = charset
+        if final:
+            out.append (self._default ())
+        return b''.join (out)
+
+
+def encode (input, errors = 'strict'):
+    return (IncrementalEncoder (errors).encode (input, True), len (input))
+
+def decode (input, errors = 'strict'):
+    return (IncrementalDecoder (errors).decode (input, True), len (input))
+
+class StreamWriter (codecs.StreamWriter):
+    def __init__ (self, stream, errors = 'strict'):
+        codecs.StreamWriter.__init__ (self, stream, errors)
+        self.encoder = IncrementalEncoder (errors)
+    def encode (self, input, errors = 'strict'):
+        return (self.encoder.encode (input), len (input))
+    def reset (self):
+        self.stream.write (self.encoder.encode ('', True))
+
+class StreamReader (codecs.StreamReader):
+    def __init__ (self, stream, errors = 'strict'):
+        codecs.StreamReader.__init__ (self, stream, errors)
+        self.decoder = IncrementalDecoder (errors)
+    def decode (self, input, errors = 'strict'):
+        return (self.decoder.decode (input), len (input))
+    def reset (self):
+        codecs.StreamReader.reset (self)
+        self.decoder.reset ()
+
+def _search (name):
+    if name.replace ('-', '').replace ('_', '') == 'marc8':
+        return codecs.CodecInfo (
+            encode, decode, StreamReader, StreamWriter,
+            IncrementalEncoder, IncrementalDecoder, name = 'marc8')
+    return None
+
+codecs.register (_search)
@@ -65,6 +65,7 @@ import sys
 import random
 import socket
 import string
+import threading
 import traceback
 
 import codecs
@@ -468,11 +469,20 @@ class Client (Conn):
                   implementationName = "", implementationVersion = "",
                   ConnectionError = ConnectionError,
                   ProtocolError = ProtocolError,
-                  UnexpectedCloseError = UnexpectedCloseError):
+                  UnexpectedCloseError = UnexpectedCloseError,
+                  timeout = None):
 
         Conn.__init__ (self, ConnectionError = ConnectionError,
                        ProtocolError = ProtocolError,
                        UnexpectedCloseError = UnexpectedCloseError)
+        # Serializes transactions, so a Client can be shared between
+        # threads.  Callers which need several transactions to happen
+        # without interleaving (e.g. set_dbnames then search) can hold it
+        # too: it's reentrant.
+        self.lock = threading.RLock ()
+        # timeout (seconds) applies to connecting and to each read or
+        # write; exceeding it raises ConnectionError
+        self.sock.settimeout (timeout)
         try:
             self.sock.connect ((addr, port))
         except socket.error as val:
@@ -530,6 +540,12 @@ class Client (Conn):
     def get_option (self, option_name):
         return self.initresp.options[option_name]
     def transact (self, to_send, expected):
+        self.lock.acquire ()
+        try:
+            return self._transact (to_send, expected)
+        finally:
+            self.lock.release ()
+    def _transact (self, to_send, expected):
         b = self.encode_ctx.encode (APDU, to_send)
         if print_hex:
             print(list(map (hex, b)))
@@ -564,10 +580,12 @@ class Client (Conn):
         if arm == expected: # may be 'close'
             return val
         elif arm == 'close':
-            raise self.UnexpectedCloseError (
+            err = self.UnexpectedCloseError (
                 "Server closed connection reason %d diag info %s" % \
                 (getattr (val, 'closeReason', -1),
                  getattr (val, 'diagnosticInformation', 'None given')))
+            err.closeReason = getattr (val, 'closeReason', -1)
+            raise err
         else:
             raise self.ProtocolError (
                 "Unexpected response from server %s %s " % (expected,
@@ -602,11 +620,16 @@ class Client (Conn):
     def get_count (self, rsn = default_resultSetName):
         return self.search_results[rsn].resultCount
     def delete (self, rsn):
+        return self.delete_many ([rsn])
+    def delete_many (self, rsns):
+        """Delete the result sets named in rsns with one request"""
         if not self.initresp.options['delSet']:
             return None
+        for rsn in rsns:
+            self.search_results.pop (rsn, None)
         delreq = DeleteResultSetRequest ()
         delreq.deleteFunction = 0 # list
-        delreq.resultSetList = [rsn]
+        delreq.resultSetList = list (rsns)
         return self.transact (('deleteResultSetRequest', delreq),
                               'deleteResultSetResponse')
     def present (self, rsn= default_resultSetName, start = None,
@@ -0,0 +1,822 @@
+#!/usr/bin/env python
+
+"""Table-driven crosswalks from MARC to other XML (or SGML) formats.
+
+A Crosswalk is a list of Rules, each saying how occurrences of some
+MARC fields become an element.  On first use, the rules are sorted out
+by tag, so converting a record is one pass over its fields, each
+occurrence being handed to the rules for its tag; the output is then
+assembled in rule order.  Each element's text is escaped once, after
+its subfields have been joined, and the start and end tags of each
+element are worked out once for each tag and code (and indicators, if
+its attributes use them).
+
+The built-in crosswalks, 'DC' (simple Dublin Core, following LC's
+crosswalk) and 'SGML' (the USMARC DTD), are what zmarc.MARC's
+toSimpleDC and toSGML use.  'MODS' follows LC's MODS 3 mapping more
+closely than zmarc.MARC's toMODS, whose output is kept as it was
+(subtitle, recordInformation, subdivisions in 6XX names).  Others can
+be registered, and existing ones extended:
+
+    from PyZ3950 import zcrosswalk
+    from PyZ3950.zcrosswalk import Rule
+    zcrosswalk.register (zcrosswalk.Crosswalk ('MyDC', 'dc', [
+        Rule (245, 'title', codes = 'ab', first = 1, strip = ' /:;,'),
+        Rule ([100, 700], 'creator', codes = 'a', strip = ','),
+        Rule (856, 'identifier', codes = 'u', each = 1)]))
+    xml = zcrosswalk.convert (marc, 'MyDC')
+
+A Rule's arguments are all optional:
+  tags      a tag or list of tags; 0 is the leader pseudofield (see
+            zmarc.MARC.hdrbits), 1-9 are control fields
+  path      element, or 'outer/inner' elements with the text in the
+            innermost, written on one line.  Segments can include
+            literal attributes ('placeTerm type="code"') and
+            '%(tag)03d'; path may also be a function of tag and
+            subfield code returning such a string (it's called once
+            for each tag and code, the result being kept)
+  codes     subfield codes whose values make the text, in record order
+            (None for all)
+  join      what goes between the values taken from one occurrence
+  each      make an element per subfield, rather than per occurrence
+  first     only use the first occurrence of the field
+  ind1/ind2 only occurrences with one of these indicator values
+  chars     (start, end) slice of a control field's data to use
+  strip     characters to strip from the end of the text
+  skip      values to ignore (empty text is always ignored)
+  values    dict mapping text to what's output; other values are ignored
+  attrs     list of (name, spec) for attributes of the innermost
+            element, where spec is a string, (source, dict[, default])
+            with source 'ind1', 'ind2' or 'tag' looked up in dict,
+            ('sub', code[, default]) for a subfield's value, or a
+            function of (marc, tag, occurrence); or a function of
+            (tag, ind1, ind2) returning a list of (name, value).
+            Attributes whose values come out None are left out.
+            Attributes depending only on tag and indicators are worked
+            out once for each combination.
+  when      function of (marc, tag, occurrence): skip it if false
+  text      constant text, or function of (marc, tag, occurrence)
+            returning the text, instead of codes
+  source    function of (marc, tag, occurrence) returning what this
+            rule and its children use in place of the occurrence
+  children  Rules making elements inside this one, from the same
+            occurrence's subfields, in record order (children with
+            constant text first)
+  group     'outer/inner' path of elements wrapping this rule's
+            output, shared with the rules around it with the same
+            group, and only written if one of them has output (or
+            there's a Rule with just group and always, which forces it)
+  always    write the element even if its text is blank
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+from PyZ3950 import zmarc
+
+def _tags (tags):
+    if tags == None:
+        return ()
+    if isinstance (tags, int):
+        return (tags,)
+    return tuple (tags)
+
+def _segments (path):
+    """Return (open, close) strings for a one-line path"""
+    opens = []
+    closes = []
+    for seg in path.split ('/'):
+        opens.append ('<%s>' % seg)
+        closes.insert (0, '</%s>' % seg.split () [0])
+    return (''.join (opens), ''.join (closes))
+
+def _quote (val):
+    if '&' in val or '<' in val or '"' in val:
+        return quoteattr (val)
+    return '"' + val + '"'
+
+class Rule:
+    """One line of a crosswalk table; see the module documentation"""
+    def __init__ (self, tags = None, path = None, codes = None, join = ' ',
+                  each = 0, first = 0, ind1 = None, ind2 = None, chars = None,
+                  strip = '', skip = (), values = None, attrs = (),
+                  when = None, text = None, source = None, children = (),
+                  group = None, always = 0):
+        self.tags = _tags (tags)
+        self.path = path
+        self.codes = codes
+        self.join = join
+        self.each = each
+        self.first = first
+        self.ind1 = ind1
+        self.ind2 = ind2
+        self.chars = chars
+        self.strip = strip
+        self.skip = skip
+        self.values = values
+        self.attrs = attrs
+        self.when = when
+        self.text = text
+        self.source = source
+        self.children = list (children)
+        self.group = group
+        self.always = always
+        self._static = None
+        self._cache = {} # (depth, tag, code[, ind1, ind2]) : ends
+        self._plans = {} # fixed : container plan
+        if not callable (path) and path != None and '%(' not in path:
+            self._static = _segments (path)
+        # whether the attributes depend only on tag and indicators, so
+        # the ends can be kept, and whether they use the indicators
+        self._attrs_fixed = callable (attrs) or not [
+            spec for (name, spec) in attrs
+            if not (isinstance (spec, str) or
+                    (isinstance (spec, tuple) and spec [0] != 'sub'))]
+        self._attrs_inds = self._attrs_fixed and (callable (attrs) or [
+            spec for (name, spec) in attrs
+            if isinstance (spec, tuple) and spec [0] in ('ind1', 'ind2')]
+            != [])
+
+    def _open_close (self, tag, code):
+        if self._static != None:
+            return self._static
+        if callable (self.path):
+            return _segments (self.path (tag, code))
+        return _segments (self.path % {'tag' : tag, 'code' : code})
+
+    def _attr_text (self, marc, tag, occ):
+        attrs = self.attrs
+        if callable (attrs):
+            attrs = attrs (tag, occ [0], occ [1])
+        l = []
+        for (name, spec) in attrs:
+            if callable (spec):
+                val = spec (marc, tag, occ)
+            elif isinstance (spec, tuple):
+                default = None
+                if len (spec) > 2:
+                    default = spec [2]
+                if spec [0] == 'sub':
+                    val = default
+                    for (code, v) in occ [2]:
+                        if code == spec [1]:
+                            val = v
+                            break
+                else:
+                    key = {'ind1' : occ [0], 'ind2' : occ [1],
+                           'tag' : tag} [spec [0]]
+                    val = spec [1].get (key, default)
+            else:
+                val = spec
+            if val != None:
+                l.append (' %s=%s' % (name, _quote (val)))
+        return ''.join (l)
+
+    def _ends (self, marc, tag, occ, code, depth):
+        """Return (start, end) strings to put around an element's text,
+        or, for a container, its children.  Ends not depending on the
+        occurrence's subfields are kept, by tag, code and (if the
+        attributes use them) indicators."""
+        if self._attrs_inds:
+            key = (depth, tag, code, occ [0], occ [1])
+        elif self._attrs_fixed:
+            key = (depth, tag, code)
+        else:
+            return self._make_ends (marc, tag, occ, code, depth)
+        ends = self._cache.get (key)
+        if ends == None:
+            ends = self._cache [key] = self._make_ends (marc, tag, occ, code,
+                                                        depth)
+        return ends
+
+    def _make_ends (self, marc, tag, occ, code, depth):
+        (opens, closes) = self._open_close (tag, code)
+        indent = '  ' * depth
+        if self.children:
+            ends = (indent + opens + '\n', indent + closes + '\n')
+        else:
+            ends = (indent + opens, closes + '\n')
+        attrs = self.attrs and self._attr_text (marc, tag, occ)
+        if attrs:
+            i = ends [0].rindex ('>')
+            ends = (ends [0][:i] + attrs + ends [0][i:], ends [1])
+        return ends
+
+    def _finish (self, text):
+        """strip, skip, values and escape text; None for no element"""
+        if self.strip:
+            text = text.rstrip (self.strip)
+        if text in self.skip:
+            return None
+        if self.values != None:
+            text = self.values.get (text)
+            if text == None:
+                return None
+        elif not self.always and (not text or text.isspace ()):
+            return None
+        if '&' in text or '<' in text or '>' in text:
+            return escape (text)
+        return text
+
+    def _by_code (self):
+        """True if, as a child, the rule is done in the one pass over an
+        occurrence's subfields its container makes: an element per
+        subfield, with nothing but the code to decide which"""
+        return (self.each and self.path != None and not self.attrs and
+                not self.children and self.text == None and
+                self.source == None and self.when == None and
+                self.ind1 == None and self.ind2 == None and
+                not (self.strip or self.skip or self.values != None))
+
+    def _plan (self, fixed):
+        """Sort a container's children into those in front, those done
+        in the pass over the subfields, and the others, as lists of
+        (index, child), plus a dict to keep the pass's work for each
+        subfield code in; if there are others, the front ones are done
+        with them, in table order"""
+        plan = self._plans.get (fixed)
+        if plan == None:
+            front = []
+            bycode = []
+            others = []
+            for (i, child) in enumerate (self.children):
+                if not fixed and child._by_code ():
+                    bycode.append ((i, child))
+                elif _in_front (child, fixed):
+                    front.append ((i, child))
+                else:
+                    others.append ((i, child))
+            if others:
+                others = sorted (front + others, key = lambda e: e [0])
+                front = []
+            plan = self._plans [fixed] = (front, bycode, others, {})
+        return plan
+
+
+def _in_front (rule, fixed):
+    """True if rule, as a child, puts its elements before those from
+    subfields: constant text, control field data, or containers of
+    nothing else"""
+    if rule.children:
+        return not [child for child in rule.children
+                    if not _in_front (child, fixed)]
+    return fixed or (rule.text != None and not rule.each)
+
+# A sink is (list, sorting): the output is appended to the list, as
+# (position, rank, text) if sorting (see _do_container).
+
+def _emit (sink, pos, rank, text):
+    if sink [1]:
+        sink [0].append ((pos, rank, text))
+    else:
+        sink [0].append (text)
+
+def _do_rule (rule, marc, depth, fixed, tag, occ, sink, rank):
+    """Do rule's work for one occurrence of a control field (if fixed)
+    or data field"""
+    if fixed and (rule.ind1 != None or rule.ind2 != None):
+        return
+    if rule.when != None and not rule.when (marc, tag, occ):
+        return
+    if rule.ind1 != None and occ [0] not in rule.ind1:
+        return
+    if rule.ind2 != None and occ [1] not in rule.ind2:
+        return
+    if rule.source != None:
+        occ = rule.source (marc, tag, occ)
+    if rule.children:
+        _do_container (rule, marc, depth, fixed, tag, occ, sink, rank)
+    elif rule.each:
+        _do_each (rule, marc, depth, tag, occ, sink, rank)
+    else:
+        _do_single (rule, marc, depth, fixed, tag, occ, sink, rank)
+
+def _do_single (rule, marc, depth, fixed, tag, occ, sink, rank):
+    """One element per occurrence"""
+    pos = -1
+    if rule.text != None:
+        if callable (rule.text):
+            text = rule.text (marc, tag, occ)
+            if text == None:
+                return
+        else:
+            text = rule.text
+    elif fixed:
+        text = occ
+        if rule.chars != None:
+            text = occ [rule.chars [0]:rule.chars [1]]
+    else:
+        if rule.codes == None:
+            vals = [v for (c, v) in occ [2]]
+            pos = 0
+        elif not sink [1]:
+            vals = [v for (c, v) in occ [2] if c in rule.codes]
+        else:
+            vals = []
+            for (i, (c, v)) in enumerate (occ [2]):
+                if c in rule.codes:
+                    if not vals:
+                        pos = i
+                    vals.append (v)
+        if not vals and not rule.always:
+            return
+        text = rule.join.join (vals)
+    text = rule._finish (text)
+    if text != None:
+        (start, end) = rule._ends (marc, tag, occ, None, depth)
+        if sink [1]:
+            sink [0].append ((pos, rank, start + text + end))
+        else:
+            sink [0].append (start + text + end)
+
+def _do_each (rule, marc, depth, tag, occ, sink, rank):
+    """One element per subfield"""
+    for (i, (c, v)) in enumerate (occ [2]):
+        if rule.codes == None or c in rule.codes:
+            v = rule._finish (v)
+            if v != None:
+                (start, end) = rule._ends (marc, tag, occ, c, depth)
+                _emit (sink, i, rank, start + v + end)
+
+def _do_container (rule, marc, depth, fixed, tag, occ, sink, rank):
+    """An element holding the elements of rule's children, in the order
+    of the subfields they come from (constant text first).  Children
+    that can be are done in one pass over the subfields, after those
+    in front.  If there are others, the children are done in turn, each
+    adding (position, rank, text) to a list which is then sorted.
+    Ranks break ties between children using the same subfield: the
+    children done in turn come first, then the others, each in table
+    order."""
+    (front, bycode, others, bycodes) = rule._plan (fixed)
+    sorting = others != []
+    parts = []
+    for (i, child) in front:
+        _do_rule (child, marc, depth + 1, fixed, tag, occ, (parts, 0), i)
+    first = None # position of the first part, for a sorting sink
+    if parts:
+        first = -1
+    if bycode:
+        for (i, (c, v)) in enumerate (occ [2]):
+            # (rank, always, start, end) for each child using code c
+            entries = bycodes.get ((depth, tag, c))
+            if entries == None:
+                entries = bycodes [(depth, tag, c)] = [
+                    (1000 + j, child.always) +
+                    child._ends (marc, tag, occ, c, depth + 1)
+                    for (j, child) in bycode
+                    if child.codes == None or c in child.codes]
+            if not entries:
+                continue
+            if '&' in v or '<' in v or '>' in v:
+                v = escape (v)
+            blank = not v or v.isspace ()
+            for (j, always, start, end) in entries:
+                if blank and not always:
+                    continue
+                if sorting:
+                    parts.append ((i, j, start + v + end))
+                else:
+                    if first == None:
+                        first = i
+                    parts.append (start + v + end)
+    for (i, child) in others:
+        _do_rule (child, marc, depth + 1, fixed, tag, occ, (parts, 1), i)
+    if parts:
+        (start, end) = rule._ends (marc, tag, occ, None, depth)
+        if sorting:
+            parts.sort ()
+            first = parts [0][0]
+            parts = [p [2] for p in parts]
+        _emit (sink, first, rank, start + ''.join (parts) + end)
+
+def _layout (items, level, bytag):
+    """Return the layout of items, (rule, groups) pairs whose first level
+    groups are open: a list of the rules' numbers, with each run of
+    rules sharing a group at this level replaced by (start, end,
+    forced, layout).  Each rule is added to bytag, under its tags, as
+    (number, rule, depth)."""
+    layout = []
+    i = 0
+    while i < len (items):
+        (n, rule, groups) = items [i]
+        if len (groups) == level:
+            if rule.tags:
+                for tag in set (rule.tags):
+                    bytag.setdefault (tag, []).append ((n, rule, level + 1))
+                layout.append (n)
+            i += 1
+            continue
+        j = i + 1
+        while j < len (items) and items [j][2][:level + 1] == \
+              groups [:level + 1]:
+            j += 1
+        run = items [i:j]
+        forced = [r for (n, r, g) in run if r.path == None and r.always] != []
+        layout.append (('%s<%s>\n' % ('  ' * (level + 1), groups [level]),
+                        '%s</%s>\n' % ('  ' * (level + 1),
+                                       groups [level].split () [0]),
+                        forced, _layout (run, level + 1, bytag)))
+        i = j
+    return layout
+
+def _assemble (layout, parts, out):
+    """Add the rules' output, parts, to out in layout order.  A group
+    element is only written if its rules output anything, unless it's
+    forced."""
+    for item in layout:
+        if isinstance (item, tuple):
+            (start, end, forced, inner) = item
+            mark = len (out)
+            out.append (start)
+            _assemble (inner, parts, out)
+            if forced or len (out) > mark + 1:
+                out.append (end)
+            else:
+                del out [mark]
+        elif parts [item]:
+            out.extend (parts [item])
+
+
+class Crosswalk:
+    """A named list of Rules, producing root elements (root may include
+    attributes, e.g. 'dc xmlns="..."')"""
+    def __init__ (self, name, root, rules):
+        self.name = name
+        self.root = root
+        self.rules = list (rules)
+        self._layout = None
+        self._bytag = None
+    def add (self, rule, before = None):
+        """Add rule at the end, or before the rule before"""
+        if before == None:
+            self.rules.append (rule)
+        else:
+            self.rules.insert (self.rules.index (before), rule)
+        self._layout = None
+    def _plan (self):
+        """Work out the layout and which rules want each tag.  Done on
+        first use, and after add."""
+        items = []
+        for (n, rule) in enumerate (self.rules):
+            groups = ()
+            if rule.group != None:
+                groups = tuple (rule.group.split ('/'))
+            items.append ((n, rule, groups))
+        bytag = {}
+        self._layout = _layout (items, 0, bytag)
+        self._bytag = bytag
+    def convert (self, marc):
+        """Return marc, a zmarc.MARC, converted"""
+        if self._layout == None:
+            self._plan ()
+        bytag = self._bytag
+        fields = marc.fields
+        # one pass over the fields, each rule's output kept apart
+        parts = [None] * len (self.rules)
+        for tag in sorted (fields):
+            rules = bytag.get (tag)
+            if not rules:
+                continue
+            occs = fields [tag]
+            if not occs:
+                continue
+            fixed = zmarc.is_fixed (tag)
+            for (n, rule, depth) in rules:
+                if parts [n] == None:
+                    parts [n] = []
+                sink = (parts [n], 0)
+                if rule.first:
+                    _do_rule (rule, marc, depth, fixed, tag, occs [0], sink, 0)
+                else:
+                    for occ in occs:
+                        _do_rule (rule, marc, depth, fixed, tag, occ, sink,
+                                  0)
+        out = ['<%s>\n' % self.root]
+        _assemble (self._layout, parts, out)
+        out.append ('</%s>' % self.root.split () [0])
+        return ''.join (out)
+
+crosswalks = {}
+"""Registered Crosswalks, by name"""
+
+def register (crosswalk):
+    crosswalks [crosswalk.name] = crosswalk
+
+def get (name):
+    return crosswalks [name]
+
+def convert (marc, name):
+    """Convert zmarc.MARC marc with the crosswalk registered as name"""
+    return crosswalks [name].convert (marc)
+
+
+# --- Simple Dublin Core, after LC's crosswalk ---
+
+_isbd_punct = ',.;:'
+
+def _dc_title (marc, tag, occ):
+    a = b = ''
+    for (code, val) in occ [2]:
+        if code == 'a':
+            a = val
+        elif code == 'b':
+            b = val
+    if a and b and a [-1] in _isbd_punct:
+        return a + " " + b
+    elif a and b:
+        return a + "; " + b
+    return a or b
+
+def _dc_creator (marc, tag, occ):
+    a = h = d = ''
+    for (code, val) in occ [2]:
+        if code == 'a':
+            a = val
+        elif code == 'h':
+            h = val
+        elif code == 'd':
+            d = val
+    if h:
+        a += ", " + h
+    if d:
+        a += " (" + d + ")"
+    return a
+
+def _dc_publisher (marc, tag, occ):
+    a = b = ''
+    for (code, val) in occ [2]:
+        if code == 'a':
+            a = val
+        elif code == 'b':
+            b = val
+            if b [-1:] in (',', ';', ':'):
+                b = b [:-1]
+    if b:
+        a += " " + b
+    return a
+
+# As ever, elements are written even if blank (publisher unless empty)
+register (Crosswalk ('DC', 'dc xmlns="http://www.loc.gov/zing/srw/dcschema/v1.0/"', [
+    Rule (245, 'title', first = 1, text = _dc_title, always = 1),
+    Rule ([100, 110, 111, 700, 710, 711], 'creator', text = _dc_creator,
+          always = 1),
+    Rule ([600, 610, 611, 630, 650, 653], 'subject', join = ' -- ',
+          always = 1),
+    Rule (260, 'date', codes = 'c', each = 1, strip = '.', always = 1),
+    Rule (260, 'publisher', text = _dc_publisher, skip = ('',), always = 1),
+    Rule (655, 'type', join = ' -- ', always = 1),
+    Rule ([20, 22], 'identifier', codes = 'a', each = 1, always = 1),
+    Rule (300, 'description', always = 1),
+    ]))
+
+
+# --- MODS 3, after LC's MARC to MODS mapping ---
+
+def _collection (marc, tag, occ):
+    if occ [2:3] == 'c':
+        return 'yes'
+    return None
+
+def _manuscript (marc, tag, occ):
+    if occ [1:2] in ('d', 'f', 'p', 't'):
+        return 'yes'
+    return None
+
+def _date_type (types):
+    """when function: 008/06 (type of date) is in types"""
+    def when (marc, tag, occ):
+        return occ [6:7] in types
+    return when
+
+def _questionable (marc, tag, occ):
+    if occ [6:7] == 'q':
+        return 'questionable'
+    return None
+
+_name_types = {100 : 'personal', 110 : 'corporate', 111 : 'conference',
+               600 : 'personal', 610 : 'corporate', 611 : 'conference',
+               700 : 'personal', 710 : 'corporate', 711 : 'conference'}
+
+def _name_part (tag, code):
+    if code == 'b' and _name_types [tag] == 'personal':
+        return 'namePart type="termsOfAddress"'
+    return 'namePart'
+
+def _name_parts ():
+    return [
+        Rule (path = _name_part, codes = 'ab', each = 1),
+        Rule (path = 'namePart type="date"', codes = 'd', each = 1),
+        Rule (path = 'role/roleTerm type="text"', codes = 'e', each = 1),
+        Rule (path = 'role/roleTerm type="code"', codes = '4', each = 1)]
+
+_subject_authority = [('authority', ('ind2', {
+    '0' : 'lcsh', '1' : 'lcshac', '2' : 'mesh', '3' : 'csh', '5' : 'nal',
+    '6' : 'rvm'}))]
+
+def _subject (tags, first):
+    """A subject from tags, with first (a list of Rules) for the heading
+    and the usual subdivisions"""
+    return Rule (tags, 'subject', attrs = _subject_authority,
+                 children = first + [
+                     Rule (path = 'topic', codes = 'vx', each = 1),
+                     Rule (path = 'temporal', codes = 'y', each = 1),
+                     Rule (path = 'geographic', codes = 'z', each = 1)])
+
+_title_parts = [Rule (path = 'partNumber', codes = 'n', each = 1),
+                Rule (path = 'partName', codes = 'p', each = 1)]
+
+_resource_types = {'a' : 'text', 't' : 'text', 'e' : 'cartographic',
+                   'f' : 'cartographic', 'c' : 'notated music',
+                   'd' : 'notated music', 'i' : 'sound recording - nonmusical',
+                   'j' : 'sound recording - musical', 'k' : 'still image',
+                   'g' : 'moving image', 'r' : 'three dimensional object',
+                   'm' : 'software, multimedia', 'p' : 'mixed material'}
+
+_issuance = {'b' : 'continuing', 'i' : 'continuing', 's' : 'continuing',
+             'a' : 'monographic', 'c' : 'monographic', 'd' : 'monographic',
+             'm' : 'monographic'}
+
+# http://www.loc.gov/standards/mods/mods-notes.html
+_note_types = [(500, None), (541, 'acquisition'), (583, 'action'),
+               (530, 'additional form'), (504, 'bibliography'),
+               (545, 'biographical'), (510, 'citation'), (518, 'venue'),
+               (585, 'exhibitions'), (536, 'funding'), (546, 'language'),
+               (561, 'ownership'), (511, 'performers')]
+
+_no_code = ('|', '||', '|||', '||||', '||||||')
+
+_mods_rules = [
+    # --- titleInfo ---
+    Rule (245, 'titleInfo', first = 1, children = [
+        Rule (path = 'title', codes = 'afgk'),
+        Rule (path = 'subTitle', codes = 'b')]),
+    Rule (210, 'titleInfo type="abbreviated"', first = 1, children = [
+        Rule (path = 'title', codes = 'a'),
+        Rule (path = 'subTitle', codes = 'b')]),
+    Rule (242, 'titleInfo type="translated"', first = 1,
+          attrs = [('displayLabel', ('sub', 'i'))], children = [
+              Rule (path = 'title', codes = 'a'),
+              Rule (path = 'subTitle', codes = 'b')] + _title_parts),
+    Rule (246, 'titleInfo', first = 1,
+          attrs = [('type', ('ind2', {'1' : 'translated'}, 'alternative'))],
+          children = [Rule (path = 'title', codes = 'a'),
+                      Rule (path = 'subTitle', codes = 'b')] + _title_parts),
+    Rule ([130, 240], 'titleInfo type="uniform"', first = 1,
+          when = lambda marc, tag, occ: tag == 130 or 130 not in marc.fields,
+          children = [Rule (path = 'title', codes = 'a')] + _title_parts),
+    # --- name ---
+    Rule ([100, 110, 111, 700, 710, 711], 'name',
+          attrs = [('type', ('tag', _name_types))], children = [
+              Rule (path = 'role/roleTerm type="text"', text = 'creator',
+                    when = lambda marc, tag, occ: tag < 200)] +
+          _name_parts ()),
+    # --- typeOfResource, genre ---
+    Rule (0, 'typeOfResource', chars = (1, 2), values = _resource_types,
+          attrs = [('collection', _collection),
+                   ('manuscript', _manuscript)]),
+    Rule (8, 'genre authority="marcgt"', chars = (33, 34),
+          values = {'0' : 'non fiction'}),
+    Rule (655, 'genre', join = ' -- '),
+    # --- originInfo ---
+    Rule (8, 'place/placeTerm type="code" authority="marccountry"',
+          chars = (15, 18), skip = _no_code, group = 'originInfo'),
+    Rule (44, 'place/placeTerm type="code" authority="iso3166"',
+          codes = 'c', each = 1, group = 'originInfo'),
+    Rule (260, 'place/placeTerm type="text"', codes = 'a', each = 1,
+          group = 'originInfo'),
+    Rule (260, 'publisher', codes = 'b', each = 1, group = 'originInfo'),
+    Rule (260, 'dateIssued', codes = 'c', each = 1, group = 'originInfo'),
+    Rule (8, 'dateIssued encoding="marc"', chars = (7, 11),
+          when = _date_type ('eprst'), skip = _no_code,
+          group = 'originInfo'),
+    Rule (8, 'dateIssued point="start" encoding="marc"', chars = (7, 11),
+          when = _date_type ('cdikmuq'), skip = _no_code,
+          attrs = [('qualifier', _questionable)], group = 'originInfo'),
+    Rule (8, 'dateIssued point="end" encoding="marc"', chars = (11, 15),
+          when = _date_type ('cdikmuq'), skip = _no_code,
+          attrs = [('qualifier', _questionable)], group = 'originInfo'),
+    Rule (260, 'dateCreated', codes = 'g', each = 1, group = 'originInfo'),
+    Rule (46, 'dateCreated point="start"', codes = 'k', first = 1,
+          group = 'originInfo'),
+    Rule (46, 'dateCreated point="end"', codes = 'l', first = 1,
+          group = 'originInfo'),
+    Rule (46, 'dateValid point="start"', codes = 'm', first = 1,
+          group = 'originInfo'),
+    Rule (46, 'dateValid point="end"', codes = 'n', first = 1,
+          group = 'originInfo'),
+    Rule (46, 'dateModified', codes = 'j', first = 1, group = 'originInfo'),
+    Rule (250, 'edition', codes = 'a', first = 1, group = 'originInfo'),
+    Rule (0, 'issuance', chars = (2, 3), values = _issuance,
+          group = 'originInfo'),
+    Rule ([310, 321], 'frequency', codes = 'ab', first = 1,
+          group = 'originInfo'),
+    # --- language ---
+    Rule (8, 'language/languageTerm type="code" authority="iso639-2b"',
+          chars = (35, 38), skip = _no_code),
+    Rule (41, 'language/languageTerm type="code"', codes = 'ade', each = 1,
+          attrs = [('authority', ('sub', '2', 'iso639-2b'))]),
+    # --- physicalDescription ---
+    Rule (8, 'form authority="marcform"', chars = (23, 24),
+          values = {' ' : 'print', 'r' : 'regular print reproduction'},
+          group = 'physicalDescription'),
+    Rule (300, 'extent', first = 1, group = 'physicalDescription'),
+    # --- abstract, tableOfContents, note ---
+    Rule (520, 'abstract', codes = 'ab'),
+    Rule (505, 'tableOfContents', codes = 'agrt', first = 1)] + [
+    Rule (tag, ['note', 'note type="%s"' % typ] [typ != None], codes = 'a')
+    for (tag, typ) in _note_types] + [
+    # --- subject ---
+    _subject ([600, 610, 611], [
+        Rule (path = 'name', attrs = [('type', ('tag', _name_types))],
+              children = _name_parts () + [
+                  Rule (path = 'affiliation', codes = 'u', each = 1)])]),
+    _subject (630, [Rule (path = 'titleInfo', children = [
+        Rule (path = 'title', codes = 'a')] + _title_parts)]),
+    _subject (650, [Rule (path = 'topic', codes = 'a', each = 1)]),
+    _subject (651, [Rule (path = 'geographic', codes = 'a', each = 1)]),
+    _subject (653, [Rule (path = 'topic', codes = 'a', each = 1)]),
+    Rule (45, 'subject/temporal encoding="iso8601"', codes = 'b', each = 1,
+          ind1 = '01'),
+    Rule (43, 'subject/geographicCode authority="marcgac"', codes = 'a',
+          each = 1),
+    Rule (43, 'subject/geographicCode authority="iso3166"', codes = 'c',
+          each = 1),
+    Rule (752, 'subject/hierarchicalGeographic', children = [
+        Rule (path = 'country', codes = 'a', each = 1),
+        Rule (path = 'state', codes = 'b', each = 1),
+        Rule (path = 'county', codes = 'c', each = 1),
+        Rule (path = 'city', codes = 'd', each = 1)]),
+    Rule (255, 'subject/cartographics', children = [
+        Rule (path = 'scale', codes = 'a', each = 1),
+        Rule (path = 'projection', codes = 'b', each = 1),
+        Rule (path = 'coordinates', codes = 'c', each = 1)]),
+    Rule (656, 'subject/occupation', codes = 'a', each = 1),
+    # --- classification ---
+    Rule (50, 'classification authority="lcc"', codes = 'ab', first = 1),
+    Rule (82, 'classification authority="ddc"', codes = 'ab', first = 1),
+    Rule (80, 'classification authority="udc"', codes = 'ab', first = 1),
+    Rule (60, 'classification authority="nlm"', codes = 'ab', first = 1),
+    Rule (86, 'classification', codes = 'a', each = 1, ind1 = '01',
+          attrs = [('authority', ('ind1', {'0' : 'sudocs',
+                                           '1' : 'candocs'}))]),
+    # --- identifier ---
+    Rule (20, 'identifier type="isbn"', codes = 'a', each = 1),
+    Rule (22, 'identifier type="issn"', codes = 'a', each = 1),
+    Rule (24, 'identifier type="isrc"', codes = 'a', each = 1),
+    Rule (28, 'identifier type="matrix number"', codes = 'a', each = 1),
+    # --- recordInfo ---
+    Rule (40, 'recordContentSource authority="marcorg"', codes = 'a',
+          each = 1, group = 'recordInfo'),
+    Rule (8, 'recordCreationDate encoding="marc"', chars = (0, 6),
+          group = 'recordInfo'),
+    Rule (1, 'recordIdentifier', group = 'recordInfo'),
+    Rule (40, 'languageOfCataloging/languageTerm authority="iso639-2b"',
+          codes = 'b', each = 1, first = 1, group = 'recordInfo'),
+    ]
+
+register (Crosswalk ('MODS', 'mods xmlns="http://www.loc.gov/mods/v3"',
+                     _mods_rules))
+
+
+# --- SGML, per the USMARC DTD ---
+
+def _leader (marc, tag, occ):
+    return marc.leader ()
+
+def _sgml_indicators (tag, ind1, ind2):
+    (i1, i2) = zmarc.attrHash.get (tag, ('I1', 'I2'))
+    return [(i1, ind1), (i2, ind2)]
+
+def _sgml_subfield (tag, code):
+    return zmarc.subfieldHash.get (code, code)
+
+_sgml_groups = [(10, 'numbcode'), (100, 'mainenty'), (200, 'titles'),
+                (250, 'edimprnt'), (300, 'physdesc'), (400, 'series'),
+                (500, 'notes'), (600, 'subjaccs'), (700, 'addenty'),
+                (760, 'linkenty'), (800, 'saddenty'), (840, 'holdaltg'),
+                (900, 'fld9xx'), (1000, None)]
+
+_sgml_rules = [
+    Rule (0, 'leader', source = _leader, children = [
+        Rule (path = name, chars = (start, end), always = 1)
+        for (name, start, end) in [
+            ('lrl', 0, 5), ('recstat', 5, 6), ('rectype', 6, 7),
+            ('biblevel', 7, 8), ('ucp', 8, 10), ('indcount', 10, 11),
+            ('sfcount', 11, 12), ('baseaddr', 12, 17), ('enclevel', 17, 18),
+            ('dsccatfm', 18, 19), ('linkrec', 19, 20)]] + [
+        Rule (path = 'entrymap', children = [
+            Rule (path = name, chars = (start, end), always = 1)
+            for (name, start, end) in [
+                ('flength', 20, 21), ('scharpos', 21, 22),
+                ('idlength', 22, 23), ('emucp', 23, 24)]])]),
+    Rule (0, 'directry', text = '', always = 1),
+    Rule (group = 'varflds/varcflds', always = 1),
+    Rule (range (1, 10), 'fld%(tag)03d', always = 1,
+          group = 'varflds/varcflds'),
+    Rule (group = 'varflds/vardflds/numbcode', always = 1)] + [
+    Rule (range (_sgml_groups [i][0], _sgml_groups [i + 1][0]),
+          'fld%(tag)03d', attrs = _sgml_indicators,
+          group = 'varflds/vardflds/' + _sgml_groups [i][1],
+          children = [Rule (path = _sgml_subfield, each = 1, always = 1)])
+    for i in range (len (_sgml_groups) - 1)]
+
+register (Crosswalk ('SGML', 'usmarc', _sgml_rules))
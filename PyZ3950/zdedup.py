@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""Deduplicates MARC records merged from several targets.
+
+Federated searches return the same work many times over, from LC, the
+BL and every university library which has a copy.  A Deduper computes
+normalized match keys for each record as it arrives, and clusters
+records which share any key:
+- "isbn:", from 020 $a, normalized to ISBN-13
+- "issn:", from 022 $a
+- "oclc:", from 035 $a (OCoLC) numbers, and 001 when 003 is OCoLC
+- "tad:", the normalized 245 title, the first word of the 100/110/111
+  main entry, and the year from 260/264 $c (or 008/07-10)
+
+Keys go in a hash index mapping key to cluster, so each record costs
+one lookup per key rather than a comparison with every record seen
+before: the whole stream is O(n).  When a record matches two existing
+clusters (say, one by ISBN and one by OCLC number), they're merged
+(union-find, so merging is cheap too).  The key index holds at most
+maxKeys keys, least recently used ones being forgotten first, so memory
+use is bounded: beyond the index, only a cluster number per record is
+kept.  Duplicates far apart in a very long stream may be missed once
+their keys have been forgotten.
+
+Key functions take a zmarc.MARC and return a list of strings;
+pass your own list as keyfuncs to match on other things.
+
+Sample usage:
+    import itertools
+    from PyZ3950 import zdedup, zexport
+    d = zdedup.Deduper ()
+    merged = itertools.chain (loc_results, bl_results, copac_results)
+    zexport.export (d.dedup (merged), [zexport.Sink ('out.mrc', 'MARC')])
+    print (d)
+"""
+
+import re
+import array
+import collections
+import unicodedata
+
+from PyZ3950 import zmarc
+
+def _subfields (marc, tag, codes):
+    """Yield (field, value) for subfields with codes in codes, from every
+    occurrence of variable field tag"""
+    for field in marc.fields.get (tag, []):
+        for (code, val) in field [2]:
+            if code in codes:
+                yield (field, val)
+
+def _is_utf8 (marc):
+    leader = getattr (marc, 'marc', None)
+    return leader != None and leader [9:10] in ('a', b'a')
+
+def _fold (s, utf8):
+    """Lowercase s and reduce it to ASCII letters and digits separated
+    by single spaces.  MARC-8 puts diacritics in separate (non-ASCII)
+    bytes, so dropping those leaves the base letters; for UTF-8 records
+    we decompose first to get the same result."""
+    if utf8:
+        try:
+            s = s.encode ('latin-1').decode ('utf-8')
+        except UnicodeError:
+            pass
+        s = unicodedata.normalize ('NFKD', s)
+    s = s.lower ()
+    s = re.sub ('[^a-z0-9 ]', '', re.sub ('[-\t/.,:;]', ' ', s))
+    return ' '.join (s.split ())
+
+_year_re = re.compile ('[12][0-9]{3}')
+
+def _year (marc):
+    for tag in (260, 264):
+        for (field, val) in _subfields (marc, tag, 'c'):
+            m = _year_re.search (val)
+            if m != None:
+                return m.group (0)
+    fixed = marc.fields.get (8)
+    if fixed:
+        m = _year_re.match (fixed [0][7:11])
+        if m != None:
+            return m.group (0)
+    return None
+
+def _id_keys (marc, tag, prefix, normalize):
+    l = []
+    for (field, val) in _subfields (marc, tag, 'a'):
+        val = normalize (val)
+        if val: # not one, or (pbk.) etc. alone: would merge anything
+            l.append (prefix + val)
+    return l
+
+def isbn_keys (marc):
+    return _id_keys (marc, 20, 'isbn:', zmarc.normalize_isbn)
+
+def issn_keys (marc):
+    return _id_keys (marc, 22, 'issn:', zmarc.normalize_issn)
+
+def oclc_keys (marc):
+    return ['oclc:' + n for n in zmarc.oclc_numbers (marc)]
+
+title_length = 60
+"""Characters of normalized title used in title/author/date keys"""
+
+def title_author_date_keys (marc):
+    """One key from 245 $a$b$n$p (skipping nonfiling characters), the
+    first word of the main entry and the year.  No key if there's no
+    title or no year, which would make for too many false matches."""
+    utf8 = _is_utf8 (marc)
+    fields = marc.fields.get (245)
+    if not fields:
+        return []
+    (ind1, ind2, subfields) = fields [0]
+    parts = [val for (code, val) in subfields if code in 'abnp']
+    if not parts:
+        return []
+    if ind2.isdigit () and subfields [0][0] == 'a':
+        parts [0] = parts [0][int (ind2):]
+    title = _fold (' '.join (parts), utf8) [:title_length].strip ()
+    year = _year (marc)
+    if not title or year == None:
+        return []
+    author = ''
+    for tag in (100, 110, 111):
+        for (field, val) in _subfields (marc, tag, 'a'):
+            words = _fold (val, utf8).split ()
+            if words:
+                author = words [0]
+            break
+        if tag in marc.fields:
+            break
+    return ['tad:%s|%s|%s' % (title, author, year)]
+
+default_keys = [isbn_keys, issn_keys, oclc_keys, title_author_date_keys]
+"""Key functions used when a Deduper isn't given any"""
+
+
+class Deduper:
+    """Incrementally clusters records which share a match key.  Records
+    are numbered from 0 in the order they're added; a cluster is
+    identified by its earliest record.  Attributes 'records',
+    'duplicates' (records matching an earlier cluster), 'merges'
+    (clusters joined by a later record), 'unkeyed' (records which
+    couldn't be parsed or had no keys) and 'forgotten' (keys dropped
+    from the index) count what's happened so far."""
+    def __init__ (self, keyfuncs = None, maxKeys = 1000000, strict = 0):
+        if keyfuncs == None:
+            keyfuncs = default_keys
+        if maxKeys < 1:
+            raise ValueError ("maxKeys must be at least 1")
+        self.keyfuncs = keyfuncs
+        self.maxKeys = maxKeys
+        self.strict = strict
+        self._index = collections.OrderedDict ()
+        self._parent = array.array ('l')
+        self.records = 0
+        self.duplicates = 0
+        self.merges = 0
+        self.unkeyed = 0
+        self.forgotten = 0
+    def _find (self, n):
+        parent = self._parent
+        while parent [n] != n:
+            parent [n] = parent [parent [n]] # path halving
+            n = parent [n]
+        return n
+    def keys (self, rec):
+        """Return the match keys for rec, a zmarc.MARC, raw MARC (str or
+        bytes) or zoom Record.  Records which can't be parsed have no
+        keys."""
+        if not isinstance (rec, zmarc.MARC):
+            rec = getattr (rec, 'data', rec)
+            try:
+                rec = zmarc.LazyMARC (rec, strict = self.strict)
+            except (zmarc.MarcError, AssertionError, IndexError,
+                    ValueError, TypeError):
+                return []
+        l = []
+        for fn in self.keyfuncs:
+            for k in fn (rec):
+                if k not in l:
+                    l.append (k)
+        return l
+    def add (self, rec):
+        """Add rec (see keys) and return (recno, cluster, dup): rec's
+        number, the number of the cluster it's now in, and whether it
+        matched a record added earlier."""
+        recno = len (self._parent)
+        self._parent.append (recno)
+        self.records += 1
+        keys = self.keys (rec)
+        if not keys:
+            self.unkeyed += 1
+            return (recno, recno, 0)
+        roots = []
+        for k in keys:
+            c = self._index.get (k)
+            if c != None:
+                c = self._find (c)
+                if c not in roots:
+                    roots.append (c)
+        if roots:
+            target = min (roots)
+            for r in roots:
+                if r != target:
+                    self._parent [r] = target
+                    self.merges += 1
+            self._parent [recno] = target
+            self.duplicates += 1
+        else:
+            target = recno
+        index = self._index
+        for k in keys:
+            if k in index:
+                del index [k] # reinsert as most recently used
+            index [k] = target
+        while len (index) > self.maxKeys:
+            index.popitem (last = 0)
+            self.forgotten += 1
+        return (recno, target, int (len (roots) > 0))
+    def cluster (self, recno):
+        """Return the current cluster number of record recno (clusters
+        may have been merged since it was added)"""
+        return self._find (recno)
+    def dedup (self, records):
+        """Yield the records from iterable records which don't match any
+        earlier one"""
+        for rec in records:
+            if not self.add (rec) [2]:
+                yield rec
+    def __str__ (self):
+        return ("%d records, %d duplicates, %d merges, %d unkeyed, "
+                "%d keys (%d forgotten)" % (
+                    self.records, self.duplicates, self.merges,
+                    self.unkeyed, len (self._index), self.forgotten))
@@ -2,6 +2,8 @@
 
 import codecs
 
+from PyZ3950 import marc8 # registers the 'marc8' codec
+
 from PyZ3950.z3950_2001 import *
 from PyZ3950.oids import *
 
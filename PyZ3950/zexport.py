@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""Streams MARC records from a ZOOM ResultSet (or any iterable of
+records) to several output files in one pass.
+
+Each Sink writes one format:
+- "MARC", raw ISO 2709
+- "MARCXML", a MARC21 slim <collection>
+- "OAI-MARC", an <oai_marc> per record, wrapped in <collection>
+- "MODS", a <modsCollection>
+- "DC", simple Dublin Core records, wrapped in <collection>
+- "JSON", MARC-in-JSON, one record per line
+
+Conversion can be farmed out to a pool of worker processes.  At most
+'window' records are in flight at once: when the window is full, we
+stop pulling records (and so stop sending present requests) until the
+oldest one has been written, so memory use is bounded regardless of the
+size of the result set.  Records are written in result set order.
+
+Sample usage:
+    from PyZ3950 import zoom, zexport
+    res = conn.search (zoom.Query ('CCL', 'ti=cookery'))
+    stats = zexport.export (res, [zexport.Sink ('out.mrc', 'MARC'),
+                                  zexport.Sink ('out.xml', 'MARCXML')],
+                            workers = 4)
+    print (stats)
+"""
+
+import time
+import collections
+import multiprocessing
+
+from PyZ3950 import zmarc
+from PyZ3950 import zoom
+
+_wrappers = {
+    # format : (header, footer, convert fn name); the XML collections
+    # are those zmarc.MARCXMLWriter writes
+    'MARC'     : ('', '', None),
+    'MARCXML'  : zmarc._xml_collections ['MARCXML'][:2] + ('toMARCXML',),
+    'OAI-MARC' : zmarc._xml_collections ['OAI-MARC'][:2] + ('toOAIMARC',),
+    'MODS'     : ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<modsCollection xmlns="http://www.loc.gov/mods/v3">\n',
+                  '</modsCollection>\n', 'toMODS'),
+    'DC'       : ('<?xml version="1.0" encoding="UTF-8"?>\n<collection>\n',
+                  '</collection>\n', 'toSimpleDC'),
+    'JSON'     : ('', '', 'toJSON')
+    }
+
+formats = list(_wrappers.keys ())
+"""Formats accepted by Sink"""
+
+def to_bytes (s):
+    """Record data decoded from OCTET STRINGs has one char per byte, so
+    latin-1 gets the original bytes back.  Anything else (e.g.
+    a GeneralString decoded with a negotiated charset) goes out as UTF-8."""
+    try:
+        return s.encode ('latin-1')
+    except UnicodeError:
+        return s.encode ('utf-8')
+
+def header (fmt):
+    """Bytes to write before the first record in format fmt"""
+    return to_bytes (_wrappers [fmt][0])
+
+def footer (fmt):
+    """Bytes to write after the last record in format fmt"""
+    return to_bytes (_wrappers [fmt][1])
+
+def convert (raw, fmts, strict = 1):
+    """Convert raw MARC to each of fmts, returning a list of bytes"""
+    marc = None
+    out = []
+    for fmt in fmts:
+        meth = _wrappers [fmt][2]
+        if meth == None:
+            out.append (to_bytes (raw))
+            continue
+        if marc == None:
+            marc = zmarc.MARC (raw, strict = strict)
+        out.append (to_bytes (getattr (marc, meth) () + "\n"))
+    return out
+
+def _convert (args):
+    """convert, taking one tuple, for the worker pool.  Module-level so
+    that worker processes can unpickle it."""
+    return convert (*args)
+
+
+class Sink:
+    """Output file for one format.  f is either a filename, or a file
+    object opened in binary mode (which export won't close)."""
+    def __init__ (self, f, fmt):
+        if fmt not in _wrappers:
+            raise ValueError ("Unknown export format %s" % fmt)
+        self.fmt = fmt
+        self.name = getattr (f, 'name', f)
+        self._owned = not hasattr (f, 'write')
+        if self._owned:
+            self._f = open (f, 'wb')
+        else:
+            self._f = f
+        self.bytes = 0
+    def write (self, b):
+        self._f.write (b)
+        self.bytes += len (b)
+    def open (self):
+        self.write (header (self.fmt))
+    def close (self):
+        self.write (footer (self.fmt))
+        if self._owned:
+            self._f.close ()
+        else:
+            self._f.flush ()
+
+
+class ExportStats:
+    """Throughput report returned by export.  'records' counts
+    records written, 'errors' records skipped because the server
+    returned a surrogate diagnostic or the record couldn't be converted."""
+    def __init__ (self, sinks):
+        self.records = 0
+        self.errors = 0
+        self.start = time.time ()
+        self.end = None
+        self._sinks = sinks
+    def elapsed (self):
+        end = self.end
+        if end == None:
+            end = time.time ()
+        return end - self.start
+    def rate (self):
+        """Records per second"""
+        elapsed = self.elapsed ()
+        if elapsed <= 0:
+            return 0.0
+        return self.records / elapsed
+    def bytes (self):
+        """Dict mapping sink name to bytes written"""
+        d = {}
+        for s in self._sinks:
+            d [s.name] = s.bytes
+        return d
+    def __str__ (self):
+        l = ["%d records, %d errors in %.2fs (%.1f records/sec)" % (
+            self.records, self.errors, self.elapsed (), self.rate ())]
+        for s in self._sinks:
+            l.append ("  %s (%s): %d bytes" % (s.name, s.fmt, s.bytes))
+        return "\n".join (l)
+
+
+def _raw_records (records, stats):
+    """Yield raw MARC strings, skipping (and counting) surrogate
+    diagnostics.  ResultSets are walked by index so a diagnostic for one
+    record doesn't end the iteration."""
+    if isinstance (records, zoom.ResultSet):
+        for i in range (len (records)):
+            try:
+                yield records [i].data
+            except zoom.Bib1Err:
+                stats.errors += 1
+    else:
+        for r in records:
+            if isinstance (r, zoom.Record):
+                r = r.data
+            yield r
+
+def export (records, sinks, workers = 0, window = 256, strict = 1,
+            progress = None, progress_every = 1000):
+    """Convert records (a ResultSet, or an iterable of Records or raw MARC
+    strings) once each and write them to every Sink in sinks.  workers
+    is the number of conversion processes (0 converts in this process),
+    window the maximum number of records in flight.  progress, if
+    given, is called with the ExportStats every progress_every
+    records.  Returns the ExportStats."""
+    if window < 1:
+        raise ValueError ("window must be at least 1")
+    fmts = [s.fmt for s in sinks]
+    stats = ExportStats (sinks)
+    pool = None
+    if workers > 0:
+        pool = multiprocessing.Pool (workers)
+    pending = collections.deque ()
+
+    def write_one (converted):
+        for s, b in zip (sinks, converted):
+            s.write (b)
+        stats.records += 1
+        if progress != None and stats.records % progress_every == 0:
+            progress (stats)
+
+    def drain_one ():
+        item = pending.popleft ()
+        try:
+            if pool != None:
+                item = item.get ()
+        except Exception: # one bad record mustn't end the export
+            stats.errors += 1
+            return
+        write_one (item)
+
+    for s in sinks:
+        s.open ()
+    try:
+        for raw in _raw_records (records, stats):
+            if pool != None:
+                pending.append (pool.apply_async (_convert,
+                                                  ((raw, fmts, strict),)))
+                if len (pending) >= window:
+                    drain_one ()
+            else:
+                try:
+                    converted = convert (raw, fmts, strict)
+                except Exception:
+                    stats.errors += 1
+                    continue
+                write_one (converted)
+        while pending:
+            drain_one ()
+    finally:
+        if pool != None:
+            pool.terminate ()
+            pool.join ()
+        for s in sinks:
+            s.close ()
+    stats.end = time.time ()
+    return stats
+
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+
+"""Resumable bulk harvesting: run many searches against many targets
+concurrently, streaming the records to sharded output files, with
+checkpoints so that an interrupted harvest picks up where it stopped.
+
+Jobs are read from a file, one per line:
+    host:port:dbname querytype query
+e.g.
+    z3950.loc.gov:7090:Voyager CCL ti=cookery
+    LC PQF @attr 1=4 cookery
+where the target may also be a name from z3950.host_dict.  Blank lines
+and lines starting with '#' are ignored.
+
+Each job gets its own session; the number of sessions at once is
+'workers', and sessions to the same target share a zoom.AIMDLimiter so
+that targets which struggle get fewer concurrent requests.  A request
+which gets no answer for 'timeout' seconds fails (and counts against
+the target, as overload).  A job's
+records go to outdir/<job>-<shard>.<ext>, a new shard every
+shardRecords records.  Every checkpointEvery records (and at the end
+of each job) the checkpoint file outdir/checkpoint.json records, per
+job, the result set position reached, the shards written, the length of
+the current shard, the result count and a hash of the last record.
+
+On restart, finished jobs are skipped.  Unfinished ones are searched
+again.  If the result count and the last record checkpointed still
+match, the current shard is truncated to its checkpointed length and
+the harvest resumes from the checkpointed position.  Otherwise the
+job's shards are removed and it starts over.  Connection and protocol
+errors are retried (with a new session, and the same check) up to
+'retries' times.
+
+Incremental mode (manifestDir): for each job, a manifest in
+manifestDir records the identifier (MARC 001, qualified by 003) and
+005 timestamp of every record harvested.  Later runs (each into a new
+outdir) restrict the job's query to records modified since the latest
+005 in the manifest, less a day's overlap, by ANDing it with a BIB-1
+date-of-last-modification (1012) >= date term, and only write records
+which are new or whose 005 has changed.  If the target rejects the date
+search, or the query isn't RPN, the job is run in full, still writing
+only new and changed records.
+
+Usage: pyz3950-harvest [options] jobfile
+    -o dir      output directory (default '.')
+    -f format   output format, one of zexport.formats (default MARC)
+    -w n        concurrent sessions (default 4)
+    -m n        most concurrent requests per target (default 8)
+    -s n        records per output shard (default 100000)
+    -c n        records between checkpoints (default 1000)
+    -r n        retries per job (default 5)
+    -t n        seconds to wait for an answer to a request (default 60)
+    -p syntax   preferred record syntax (default USMARC)
+    -i dir      incremental: keep manifests in dir, harvest only
+                new and changed records
+    -v          report progress every 10 seconds
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import time
+import getopt
+import hashlib
+import datetime
+import threading
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+from PyZ3950 import atomicfile
+from PyZ3950 import z3950
+from PyZ3950 import zmarc
+from PyZ3950 import zoom
+from PyZ3950 import zexport
+
+_extensions = {'MARC' : 'mrc', 'JSON' : 'json'}
+
+class HarvestError (Exception):
+    """Exception for bad job files and jobs which can't be done"""
+    pass
+
+class Job:
+    """One search on one target"""
+    def __init__ (self, host, port, dbname, qtype, query):
+        self.host = host
+        self.port = port
+        self.dbname = dbname
+        self.qtype = qtype
+        self.query = query
+        desc = "%s:%d:%s %s %s" % (host, port, dbname, qtype, query)
+        self.key = hashlib.md5 (desc.encode ('utf-8')).hexdigest () [:12]
+        self.name = "%s-%s-%s" % (host.replace (':', '_'),
+                                  dbname.replace ('/', '_'), self.key)
+    def target (self):
+        return "%s:%d" % (self.host, self.port)
+    def __str__ (self):
+        return "%s:%d:%s %s %s" % (self.host, self.port, self.dbname,
+                                   self.qtype, self.query)
+
+def read_jobs (f):
+    """Return list of Jobs from file object f"""
+    jobs = []
+    for (lineno, line) in enumerate (f):
+        line = line.strip ()
+        if line == '' or line [0] == '#':
+            continue
+        try:
+            (target, qtype, query) = line.split (None, 2)
+        except ValueError:
+            raise HarvestError ("line %d: expected target, query type and "
+                                "query" % (lineno + 1))
+        if target in z3950.host_dict:
+            (host, port, dbname) = z3950.host_dict [target]
+        else:
+            try:
+                (host, port, dbname) = target.split (':', 2)
+                port = int (port)
+            except ValueError:
+                raise HarvestError ("line %d: bad target %s" %
+                                    (lineno + 1, target))
+        jobs.append (Job (host, port, dbname, qtype, query))
+    return jobs
+
+
+class Checkpoint:
+    """Per-job progress, saved atomically as JSON"""
+    def __init__ (self, path):
+        self.path = path
+        self._lock = threading.Lock ()
+        self._state = {}
+        if os.path.exists (path):
+            f = open (path)
+            try:
+                self._state = json.load (f)
+            finally:
+                f.close ()
+    def get (self, key):
+        self._lock.acquire ()
+        try:
+            return copy.deepcopy (self._state.get (key))
+        finally:
+            self._lock.release ()
+    def update (self, key, d):
+        self._lock.acquire ()
+        try:
+            self._state [key] = copy.deepcopy (d)
+            atomicfile.write (
+                self.path, lambda f: json.dump (self._state, f, indent = 1),
+                sync = 1)
+        finally:
+            self._lock.release ()
+
+
+class TargetStats:
+    """Throughput, retries and bytes for one target.  Sessions update
+    the counters concurrently, through add."""
+    def __init__ (self, target):
+        self.target = target
+        self._lock = threading.Lock ()
+        self.records = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.unchanged = 0
+        self.fullRuns = 0
+        self.jobs = 0
+        self.failedJobs = 0
+        self.start = time.time ()
+        self.busy = 0.0 # seconds spent in jobs, summed over sessions
+    def add (self, **counts):
+        """Add to counters, e.g. add (records = 1, bytes = 100)"""
+        self._lock.acquire ()
+        try:
+            for (name, n) in counts.items ():
+                setattr (self, name, getattr (self, name) + n)
+        finally:
+            self._lock.release ()
+    def rate (self):
+        """Records per second of wall clock time"""
+        elapsed = time.time () - self.start
+        if elapsed <= 0:
+            return 0.0
+        return self.records / elapsed
+    def __str__ (self):
+        s = ("%s: %d records, %d bytes, %.1f records/sec, %d retries, "
+             "%d record errors, %d/%d jobs failed" % (
+                 self.target, self.records, self.bytes, self.rate (),
+                 self.retries, self.errors, self.failedJobs, self.jobs))
+        if self.unchanged or self.fullRuns:
+            s += ", %d unchanged, %d full runs" % (self.unchanged,
+                                                   self.fullRuns)
+        return s
+
+
+class _Shard:
+    """One output file.  Opened at offset (truncating anything after
+    it, e.g. records written after the last checkpoint), or created
+    with the format's header if offset is None."""
+    def __init__ (self, path, fmt, offset = None):
+        self.path = path
+        self.fmt = fmt
+        if offset == None:
+            self._f = open (path, 'wb')
+            self._f.write (zexport.header (fmt))
+        else:
+            self._f = open (path, 'r+b')
+            self._f.truncate (offset)
+            self._f.seek (offset)
+        self.records = 0
+    def write (self, b):
+        self._f.write (b)
+    def tell (self):
+        return self._f.tell ()
+    def flush (self):
+        self._f.flush ()
+        os.fsync (self._f.fileno ())
+    def close (self, finished = 1):
+        """Close, writing the footer if finished"""
+        if finished:
+            self._f.write (zexport.footer (self.fmt))
+        self._f.close ()
+
+
+class Manifest:
+    """Record identifiers and their 005 timestamps, for one job.  Kept
+    as an append-only file of 'id<TAB>timestamp' lines, later lines
+    overriding earlier ones.  Additions are buffered until flush."""
+    def __init__ (self, path):
+        self.path = path
+        self._stamps = {}
+        self._pending = []
+        self._lines = 0
+        if os.path.exists (path):
+            f = open (path)
+            try:
+                for line in f:
+                    if not line.endswith ('\n'): # torn write
+                        break
+                    (recid, stamp) = line [:-1].split ('\t', 1)
+                    self._stamps [recid] = stamp
+                    self._lines += 1
+            finally:
+                f.close ()
+    def compact (self):
+        """Rewrite the file without overridden lines, if they're most of
+        it.  This moves the lines kept, so only do it when no checkpoint
+        has sizes of the file."""
+        if self._lines <= 2 * len (self._stamps) + 1000:
+            return
+        self.flush ()
+        def fill (f):
+            for (recid, stamp) in list (self._stamps.items ()):
+                f.write ("%s\t%s\n" % (recid, stamp))
+        atomicfile.write (self.path, fill)
+        self._lines = len (self._stamps)
+    def __len__ (self):
+        return len (self._stamps)
+    def changed (self, recid, stamp):
+        """Is the record new, or modified since we saw it?"""
+        return recid == None or self._stamps.get (recid) != stamp
+    def note (self, recid, stamp):
+        if recid != None:
+            self._stamps [recid] = stamp
+            self._pending.append ((recid, stamp))
+    def since (self, overlap = 1):
+        """Return the latest 005 date, less overlap days, as 'YYYYMMDD',
+        or None if we have no dates"""
+        dates = [stamp [:8] for stamp in list (self._stamps.values ())
+                 if len (stamp) >= 8 and stamp [:8].isdigit ()]
+        if dates == []:
+            return None
+        d = datetime.datetime.strptime (max (dates), '%Y%m%d')
+        return (d - datetime.timedelta (days = overlap)).strftime ('%Y%m%d')
+    def flush (self):
+        """Write buffered additions, returning the manifest's size"""
+        f = open (self.path, 'a')
+        try:
+            for (recid, stamp) in self._pending:
+                f.write ("%s\t%s\n" % (recid, stamp))
+            self._lines += len (self._pending)
+            f.flush ()
+            os.fsync (f.fileno ())
+            size = f.tell ()
+        finally:
+            f.close ()
+        self._pending = []
+        return size
+    def truncate (self, size):
+        """Forget additions after the manifest was size bytes long
+        (e.g. ones made after the last checkpoint)"""
+        if os.path.exists (self.path) and os.path.getsize (self.path) > size:
+            f = open (self.path, 'r+')
+            try:
+                f.truncate (size)
+            finally:
+                f.close ()
+            self.__init__ (self.path)
+
+def _marc_id_stamp (raw):
+    """Return (identifier, 005 timestamp) of raw MARC record; either may
+    be None if missing"""
+    marc = zmarc.LazyMARC (raw, strict = 0)
+    recid = None
+    if 1 in marc.fields:
+        recid = marc.fields [1][0].strip ()
+        if 3 in marc.fields:
+            recid = "%s:%s" % (marc.fields [3][0].strip (), recid)
+    stamp = None
+    if 5 in marc.fields:
+        stamp = marc.fields [5][0].strip ()
+    return (recid, stamp)
+
+_date_search_conditions = (108, 113, 114, 117, 118, 121, 123, 124, 125,
+                           126)
+"""BIB-1 diagnostics meaning the target can't do a date-restricted search"""
+
+def _hash (raw):
+    return hashlib.md5 (zexport.to_bytes (raw)).hexdigest ()
+
+class _Restart (Exception):
+    pass
+
+class Harvester:
+    """Run jobs (a list of Jobs) into outdir.  See the module
+    docstring for the other arguments.  progress, if given, is called
+    with the Harvester every progressInterval seconds while running."""
+    def __init__ (self, jobs, outdir, fmt = 'MARC', workers = 4,
+                  maxPerTarget = 8, shardRecords = 100000,
+                  checkpointEvery = 1000, retries = 5,
+                  preferredRecordSyntax = 'USMARC', strict = 1,
+                  manifestDir = None, progress = None,
+                  progressInterval = 10.0, timeout = 60.0):
+        if fmt not in zexport.formats:
+            raise HarvestError ("Unknown output format %s" % fmt)
+        self.jobs = jobs
+        self.outdir = outdir
+        self.fmt = fmt
+        self.workers = workers
+        self.maxPerTarget = maxPerTarget
+        self.shardRecords = shardRecords
+        self.checkpointEvery = checkpointEvery
+        self.retries = retries
+        self.preferredRecordSyntax = preferredRecordSyntax
+        self.strict = strict
+        self.manifestDir = manifestDir
+        self.progress = progress
+        self.progressInterval = progressInterval
+        self.timeout = timeout
+        self.stats = {}
+        self._lock = threading.Lock ()
+        for d in (outdir, manifestDir):
+            if d != None and not os.path.isdir (d):
+                os.makedirs (d)
+        self.checkpoint = Checkpoint (os.path.join (outdir,
+                                                    'checkpoint.json'))
+    def _stats (self, job):
+        self._lock.acquire ()
+        try:
+            target = job.target ()
+            if target not in self.stats:
+                self.stats [target] = TargetStats (target)
+            return self.stats [target]
+        finally:
+            self._lock.release ()
+    def _shard_path (self, job, n):
+        ext = _extensions.get (self.fmt, 'xml')
+        return os.path.join (self.outdir, "%s-%04d.%s" % (job.name, n, ext))
+    def run (self):
+        """Harvest everything, returning the dict of target name to
+        TargetStats"""
+        todo = queue.Queue ()
+        seen = {}
+        for job in self.jobs:
+            if job.key not in seen: # they'd share output files
+                seen [job.key] = 1
+                todo.put (job)
+        def worker ():
+            while 1:
+                try:
+                    job = todo.get_nowait ()
+                except queue.Empty:
+                    return
+                self._run_job (job)
+        threads = []
+        for i in range (min (self.workers, len (self.jobs))):
+            th = threading.Thread (target = worker)
+            th.daemon = True
+            th.start ()
+            threads.append (th)
+        for th in threads:
+            while th.is_alive ():
+                th.join (self.progressInterval)
+                if self.progress != None and th.is_alive ():
+                    self.progress (self)
+        return self.stats
+    def _connect (self, job):
+        conn = zoom.Connection (
+            job.host, job.port, connect = False,
+            databaseName = job.dbname,
+            preferredRecordSyntax = self.preferredRecordSyntax,
+            timeout = self.timeout,
+            limiter = zoom.target_limiter (job.host, job.port,
+                                           maximum = self.maxPerTarget))
+        conn.connect ()
+        return conn
+    def _run_job (self, job):
+        stats = self._stats (job)
+        stats.add (jobs = 1)
+        state = self.checkpoint.get (job.key)
+        if state != None and state.get ('done'):
+            return
+        start = time.time ()
+        tries = 0
+        try:
+            while 1:
+                try:
+                    self._harvest (job, stats)
+                    return
+                except (zoom.ConnectionError, zoom.ProtocolError):
+                    tries += 1
+                    stats.add (retries = 1)
+                    if tries > self.retries:
+                        raise
+                    time.sleep (min (60, 2 ** tries))
+        except Exception as err:
+            stats.add (failedJobs = 1)
+            print ("Job %s failed: %s" % (job, err), file = sys.stderr)
+        finally:
+            stats.add (busy = time.time () - start)
+    def _harvest (self, job, stats):
+        """Harvest job from its checkpoint, if any.  Connection and
+        protocol errors propagate, having checkpointed nothing past what
+        was safely written."""
+        conn = self._connect (job)
+        try:
+            state = self.checkpoint.get (job.key)
+            manifest = None
+            if self.manifestDir != None:
+                manifest = Manifest (os.path.join (self.manifestDir,
+                                                   job.name + '.manifest'))
+                if state != None and 'manifestSize' in state:
+                    manifest.truncate (state ['manifestSize'])
+            (rs, since) = self._search (conn, job, state, manifest, stats)
+            try:
+                if state == None or state.get ('since') != since:
+                    raise _Restart ()
+                self._check_resumable (rs, state)
+            except _Restart:
+                if state != None:
+                    for path in state ['shards']:
+                        if os.path.exists (path):
+                            os.remove (path)
+                    if manifest != None and 'manifestStart' in state:
+                        manifest.truncate (state ['manifestStart'])
+                state = {'pos' : 0, 'shards' : [], 'offset' : None,
+                         'shardRecords' : 0, 'count' : len (rs),
+                         'lastHash' : None, 'lastPos' : None, 'done' : 0,
+                         'since' : since}
+                if manifest != None:
+                    # nothing refers to the file's old sizes now
+                    manifest.compact ()
+                    state ['manifestStart'] = manifest.flush ()
+                    state ['manifestSize'] = state ['manifestStart']
+            self._harvest_from (job, rs, state, stats, manifest)
+        finally:
+            try:
+                conn.close ()
+            except (zoom.ConnectionError, zoom.ProtocolError):
+                pass
+    def _search (self, conn, job, state, manifest, stats):
+        """Search for job, restricted to records modified since the
+        date from its checkpoint or manifest, if incremental and
+        possible.  Returns (ResultSet, date or None)."""
+        query = zoom.Query (job.qtype, job.query)
+        if manifest == None:
+            return (conn.search (query), None)
+        if state != None:
+            since = state.get ('since')
+        else:
+            since = manifest.since ()
+        if since != None:
+            try:
+                return (conn.search (zoom.date_restricted (query, since)),
+                        since)
+            except zoom.ClientNotImplError: # not RPN
+                pass
+            except zoom.Bib1Err as err:
+                if err.condition not in _date_search_conditions:
+                    raise
+            stats.add (fullRuns = 1)
+        return (conn.search (query), None)
+    def _check_resumable (self, rs, state):
+        if len (rs) != state ['count']:
+            raise _Restart ()
+        if state ['lastHash'] != None:
+            try:
+                raw = rs [state ['lastPos']].data
+            except zoom.Bib1Err:
+                raise _Restart ()
+            if _hash (raw) != state ['lastHash']:
+                raise _Restart ()
+    def _harvest_from (self, job, rs, state, stats, manifest = None):
+        shard = None
+        if state ['shards'] and state ['offset'] != None:
+            shard = _Shard (state ['shards'][-1], self.fmt, state ['offset'])
+            shard.records = state ['shardRecords']
+        def save (done = 0):
+            if shard != None:
+                shard.flush ()
+                state ['offset'] = shard.tell ()
+                state ['shardRecords'] = shard.records
+            if manifest != None:
+                state ['manifestSize'] = manifest.flush ()
+            state ['done'] = done
+            self.checkpoint.update (job.key, state)
+        unsaved = 0
+        try:
+            for i in range (state ['pos'], len (rs)):
+                unsaved += 1
+                if unsaved >= self.checkpointEvery:
+                    save ()
+                    unsaved = 0
+                try:
+                    raw = rs [i].data
+                except zoom.Bib1Err:
+                    stats.add (errors = 1)
+                    state ['pos'] = i + 1
+                    continue
+                try:
+                    if manifest != None:
+                        (recid, stamp) = _marc_id_stamp (raw)
+                        if not manifest.changed (recid, stamp):
+                            stats.add (unchanged = 1)
+                            state ['pos'] = i + 1
+                            continue
+                    (b,) = zexport.convert (raw, [self.fmt], self.strict)
+                except Exception: # skip it, as export does
+                    stats.add (errors = 1)
+                    state ['pos'] = i + 1
+                    continue
+                if shard == None or shard.records >= self.shardRecords:
+                    if shard != None:
+                        shard.close ()
+                    path = self._shard_path (job, len (state ['shards']))
+                    shard = _Shard (path, self.fmt)
+                    state ['shards'].append (path)
+                shard.write (b)
+                shard.records += 1
+                state ['pos'] = i + 1
+                state ['lastHash'] = _hash (raw)
+                state ['lastPos'] = i
+                if manifest != None:
+                    manifest.note (recid, stamp)
+                stats.add (records = 1, bytes = len (b))
+        except:
+            # Records after the last checkpoint will be written again
+            # on resume, and truncated away then.
+            if shard != None:
+                shard.close (finished = 0)
+            raise
+        if shard != None:
+            shard.close ()
+            shard = None
+            state ['offset'] = None
+        save (done = 1)
+
+
+def _print_progress (harvester):
+    for stats in list (harvester.stats.values ()):
+        print (str (stats), file = sys.stderr)
+
+def _usage (msg = None):
+    """Print msg, if any, and the usage to stderr; return main's exit
+    status for bad arguments"""
+    if msg != None:
+        print (msg, file = sys.stderr)
+    print (__doc__ [__doc__.index ('Usage'):], file = sys.stderr)
+    return 2
+
+def main (argv = None):
+    if argv == None:
+        argv = sys.argv [1:]
+    try:
+        (optlist, args) = getopt.getopt (argv, 'o:f:w:m:s:c:r:p:i:t:v')
+    except getopt.GetoptError as err:
+        return _usage (str (err))
+    if len (args) != 1:
+        return _usage ()
+    kw = {}
+    outdir = '.'
+    ints = {'-w' : 'workers', '-m' : 'maxPerTarget', '-s' : 'shardRecords',
+            '-c' : 'checkpointEvery', '-r' : 'retries'}
+    for (opt, val) in optlist:
+        try:
+            if opt == '-o':
+                outdir = val
+            elif opt == '-f':
+                kw ['fmt'] = val
+            elif opt == '-p':
+                kw ['preferredRecordSyntax'] = val
+            elif opt == '-i':
+                kw ['manifestDir'] = val
+            elif opt == '-t':
+                kw ['timeout'] = float (val)
+            elif opt == '-v':
+                kw ['progress'] = _print_progress
+            else:
+                kw [ints [opt]] = int (val)
+        except ValueError:
+            return _usage ('option %s: %r is not a number' % (opt, val))
+    try:
+        f = open (args [0])
+        try:
+            jobs = read_jobs (f)
+        finally:
+            f.close ()
+        harvester = Harvester (jobs, outdir, **kw)
+    except (HarvestError, IOError, OSError) as err:
+        return _usage (str (err))
+    stats = harvester.run ()
+    failed = 0
+    for target in sorted (stats.keys ()):
+        print (str (stats [target]))
+        failed += stats [target].failedJobs
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit (main ())
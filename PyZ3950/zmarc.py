@@ -35,10 +35,28 @@ which takes binary MARC data.
 # or other dealings in this Software without prior written authorization
 # of the copyright holder.
 
+import os
 import sys
+import re
+import mmap
+import array
+import struct
 import string
+import json
+import heapq
+import hashlib
+import tempfile
+import collections
+import multiprocessing
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+from PyZ3950 import atomicfile
 
 class MarcError (Exception):
     pass
@@ -140,6 +158,73 @@ def parse_sub (field):
         sublist.append((sub[0], sub[1:].strip()))
     return (ind1, ind2, sublist)
     
+def normalize_plain (s):
+    return s.strip ().upper ()
+
+def _isbn_check13 (digits12):
+    total = 0
+    for i in range (len (digits12)):
+        total += int (digits12 [i]) * (1, 3) [i % 2]
+    return str ((10 - total % 10) % 10)
+
+def normalize_isbn (s):
+    """Normalize ISBN-10 or -13 (possibly with hyphens and trailing
+    qualifiers like '(pbk.)') to ISBN-13, or return None if s doesn't
+    start with one (X is allowed only as an ISBN-10 check digit)"""
+    m = re.match ('[0-9Xx-]+', s.strip ().replace (' ', ''))
+    if m == None:
+        return None
+    isbn = m.group (0).replace ('-', '').upper ()
+    if re.match ('[0-9]{9}[0-9X]$', isbn):
+        isbn = '978' + isbn [:9]
+        isbn += _isbn_check13 (isbn)
+    elif not re.match ('[0-9]{13}$', isbn):
+        return None
+    return isbn
+
+def normalize_issn (s):
+    """Normalize ISSN to 8 characters, no hyphen, or return None if s
+    doesn't start with one"""
+    m = re.match ('[0-9Xx-]+', s.strip ().replace (' ', ''))
+    if m == None:
+        return None
+    issn = m.group (0).replace ('-', '').upper ()
+    if not re.match ('[0-9]{7}[0-9X]$', issn):
+        return None
+    return issn
+
+def normalize_lccn (s):
+    """Normalize LCCN as per http://www.loc.gov/marc/lccn-namespace.html"""
+    s = s.replace (' ', '').split ('/') [0]
+    if '-' in s:
+        (left, right) = s.split ('-', 1)
+        s = left + right.zfill (6)
+    return s.lower ()
+
+def normalize_oclc (s):
+    """Strip (OCoLC), ocm/ocn/on prefixes and leading zeroes"""
+    s = s.strip ()
+    for prefix in ('(OCoLC)', 'ocm', 'ocn', 'on'):
+        if s.startswith (prefix):
+            s = s [len (prefix):]
+    return s.strip ().lstrip ('0')
+
+def oclc_numbers (marc):
+    """Return the normalized OCLC numbers of marc (a MARC or LazyMARC):
+    its 001 if 003 is OCoLC, or there's no 003 and the 001 has an OCLC
+    prefix, and each 035 $a starting (OCoLC)"""
+    l = []
+    if 1 in marc.fields:
+        ctl = marc.fields [1][0].strip ()
+        org = marc.fields.get (3, [''])[0].strip ()
+        if org == 'OCoLC' or (org == '' and ctl [:2] in ('oc', 'on')):
+            l.append (normalize_oclc (ctl))
+    for field in marc.fields.get (35, []):
+        for (code, val) in field [2]:
+            if code == 'a' and val.startswith ('(OCoLC)'):
+                l.append (normalize_oclc (val))
+    return [n for n in l if n != '']
+
 class MARC:
     """Parses data into 'fields' attribute, indexed by field number.
     Each value is a list.  For fixed fields, it's a list of the string data
@@ -238,101 +323,168 @@ class MARC:
         except:
             raise MarcError("Un-intable string: %r in %r" % (bit, self.marc))
         
-    def get_MARC (self):
+    def _leader (self, reclen, baseaddr):
         hdrlist = [' '] * 24
         zerostr = self.fields [0][0]
         for i in range (len (zerostr)):
             hdrlist [self.hdrbits [i]] = zerostr [i]
+        hdrlist [0:5] = "%05d" % reclen
         hdrlist [10] = '2' # replace these with data map, assert on read
         hdrlist [11] = '2'
-        hdrlist [20] = '4'
-        hdrlist [21] = '5'
-        hdrlist [22] = '0'
-        hdrlist [23] = '0'
-        # later - 0-4 log. record length, 12-16 base addr of data
-        # directory: 3 of tag, 4 of field len, 5 of starting pos (rel.
-        # to base address of data, 12-16
-        fields = list(self.fields.keys ())
-        data = ''
-        directory = ''
-        for field in fields:
+        hdrlist [12:17] = "%05d" % baseaddr
+        hdrlist [20:24] = '4500'
+        return "".join (hdrlist)
+    def _field_strs (self):
+        """Yield (tag, field data including its terminator), in the order
+        fields are written"""
+        for field in list (self.fields.keys ()):
             if field == 0: # pseudofield
                 continue
             for fielddat in self.fields [field]:
-                start = len (data)
                 if is_fixed (field):
-                    data += fielddat
+                    yield (field, fielddat + fieldsep)
+                else:
+                    l = [fielddat [0], fielddat [1]]
+                    for (code, val) in fielddat [2]:
+                        l.append (sep)
+                        l.append (code)
+                        l.append (val)
+                    l.append (fieldsep)
+                    yield (field, "".join (l))
+    def leader (self):
+        """Return the leader get_MARC would produce, working out the
+        lengths without building the record"""
+        entries = 0
+        datalen = 0
+        for field in list (self.fields.keys ()):
+            if field == 0:
+                continue
+            for fielddat in self.fields [field]:
+                entries += 1
+                if is_fixed (field):
+                    datalen += len (fielddat) + 1
                 else:
-                    sublist = (fielddat [0] + fielddat [1] +
-                               "".join ([sep + s[0] + s[1] for s in fielddat[2]]))
-                    data += sublist
-                data += fieldsep # XXX is this right?
-
-                length = len (data) - start
-                directory += "%.03d%.04d%.05d" % (field, length, start)
-        def id (x): return x
-        data += fieldsep + recsep
-        hdrlist [0:5] = list(map (id, "%.05d" % (len (hdrlist) + len (directory) +
-                                   len (data),)))
-        hdrlist [12:17] = list(map (id,"%.05d" % (len (hdrlist) + len (directory),)))
-        return "".join (hdrlist) + directory + data
+                    datalen += len (fielddat [0]) + len (fielddat [1]) + 1
+                    for (code, val) in fielddat [2]:
+                        datalen += 1 + len (code) + len (val)
+        baseaddr = 24 + 12 * entries + 1
+        return self._leader (baseaddr + datalen + 1, baseaddr)
+    def chunks (self, encode = None):
+        """Return the ISO 2709 record as a list of pieces (leader,
+        directory, then each field) to be written or joined.  If encode
+        (a function from str to bytes) is given, the pieces are bytes,
+        and lengths are counted in bytes."""
+        directory = []
+        data = []
+        pos = 0
+        for (field, s) in self._field_strs ():
+            if encode != None:
+                s = encode (s)
+            data.append (s)
+            directory.append ("%03d%04d%05d" % (field, len (s), pos))
+            pos += len (s)
+        directory.append (fieldsep)
+        directory = "".join (directory)
+        baseaddr = 24 + len (directory)
+        leader = self._leader (baseaddr + pos + 1, baseaddr)
+        if encode != None:
+            leader = leader.encode ('ascii')
+            directory = directory.encode ('ascii')
+            data.append (recsep.encode ('ascii'))
+        else:
+            data.append (recsep)
+        return [leader, directory] + data
+    def get_MARC (self):
+        return "".join (self.chunks ())
+    def as_bytes (self, encoding = 'latin-1'):
+        """Return the ISO 2709 record as bytes.  Field data are encoded
+        with encoding: the default, latin-1, gets back the original bytes
+        of data parsed from raw MARC, which has one char per byte."""
+        return b"".join (self.chunks (lambda s: s.encode (encoding)))
 
     def toMARCXML(self):
         " Convert record to MarcXML Schema "
+        return ''.join(self.marcxml_pieces())
+
+    def marcxml_pieces(self):
+        """Yield the pieces of toMARCXML's output, for writing out without
+        building it all"""
         keys = list(self.fields.keys())
         keys.sort()
 
 
-        xmllist = ["<record>\n", "  <leader>%s</leader>\n" % (self.get_MARC()[:24])]
+        yield "<record>\n"
+        yield "  <leader>%s</leader>\n" % (self.leader())
 
         for key in keys:
             if key == 0:
                 # XXX Skip?? What are these??
                 pass
             elif key < 10:
-                xmllist.append("  <controlfield tag=\"00%d\">%s</controlfield>\n" % (key, self.fields[key][0]))
+                yield "  <controlfield tag=\"00%d\">%s</controlfield>\n" % (key, self.fields[key][0])
             else:
                 for instance in self.fields[key]:
                     if key < 100:
                         keystr = "0" + str(key)
                     else:
                         keystr = str(key)
-                    xmllist.append("  <datafield tag=\"%s\" ind1=\"%s\" ind2=\"%s\">\n" % (keystr, instance[0], instance[1]))
+                    yield "  <datafield tag=\"%s\" ind1=\"%s\" ind2=\"%s\">\n" % (keystr, instance[0], instance[1])
                     for sub in instance[2]:
-                        xmllist.append("    <subfield code=\"%s\">%s</subfield>\n" % (sub[0], escape(sub[1])))
-                    xmllist.append("  </datafield>\n")
+                        yield "    <subfield code=\"%s\">%s</subfield>\n" % (sub[0], escape(sub[1]))
+                    yield "  </datafield>\n"
 
-        xmllist.append("</record>")
-        xml = ''.join(xmllist)
-        return xml
+        yield "</record>"
 
     def toOAIMARC(self):
         """Convert record to OAI MARC XML Schema.
         Note Well that OAI-MHP 2.0 recommends using MarcXML"""
-        
+        return ''.join(self.oaimarc_pieces())
+
+    def oaimarc_pieces(self):
+        """Yield the pieces of toOAIMARC's output"""
         keys = list(self.fields.keys())
         keys.sort()
-        marc = self.get_MARC()
+        marc = self.leader()
 
         # What should these attributes really be?
-        xmllist  = ['<oai_marc type="%s" level="%s">\n' % (marc[6], marc[7])]
+        yield '<oai_marc type="%s" level="%s">\n' % (marc[6], marc[7])
 
         for key in keys:
             if key == 0:
                 # Skip?? What are these?
                 pass
             elif key < 10:
-                xmllist.append("  <fixfield id=\"%d\">%s</fixfield>\n" % (key, self.fields[key][0]))
+                yield "  <fixfield id=\"%d\">%s</fixfield>\n" % (key, self.fields[key][0])
             else:
                 for instance in self.fields[key]:
-                    xmllist.append("  <varfield tag=\"%d\" i1=\"%s\" i2=\"%s\">\n" % (key, instance[0], instance[1]))
+                    yield "  <varfield tag=\"%d\" i1=\"%s\" i2=\"%s\">\n" % (key, instance[0], instance[1])
                     for sub in instance[2]:
-                        xmllist.append("    <subfield label=\"%s\">%s</subfield>\n" % (sub[0], escape(sub[1])))
-                    xmllist.append("  </varfield>\n")
+                        yield "    <subfield label=\"%s\">%s</subfield>\n" % (sub[0], escape(sub[1]))
+                    yield "  </varfield>\n"
 
-        xmllist.append("</oai_marc>")
-        xml = ''.join(xmllist)
-        return xml        
+        yield "</oai_marc>"
+
+    def toJSON(self):
+        """Convert record to MARC-in-JSON
+        (http://dilettantes.code4lib.org/blog/2010/09/a-proposal-to-serialize-marc-in-json/)"""
+        keys = list(self.fields.keys())
+        keys.sort()
+        fields = []
+        for key in keys:
+            if key == 0:
+                continue
+            keystr = "%03d" % key
+            if key < 10:
+                for instance in self.fields[key]:
+                    fields.append({keystr : instance})
+            else:
+                for instance in self.fields[key]:
+                    fields.append({keystr : {
+                        'ind1' : instance[0], 'ind2' : instance[1],
+                        'subfields' : [{sub[0] : sub[1]}
+                                       for sub in instance[2]]}})
+        return json.dumps({'leader' : self.leader(),
+                           'fields' : fields})
 
     def sgml_processCode(self, k):
         if k in attrHash:
@@ -361,267 +513,11 @@ class MARC:
 
     def toSGML(self):
         """ Convert record to USMARC SGML """
-
-        keys = list(self.fields.keys())
-        keys.sort()
-
-        # Extract field ranges
-        cflds = []
-        numbcode = []
-        mainenty = []
-        titles = []
-        edimprnt = []
-        physdesc = []
-        series = []
-        notes = []
-        subjaccs = []
-        addenty = []
-        linkenty = []
-        saddenty = []
-        holdaltg = []
-        fld9xx = []
-        # Ugly
-        for k in keys:
-            if k == 0:
-                pass
-            elif k < 10:
-                cflds.append(k)
-            elif k < 100:
-                numbcode.append(k)
-            elif k < 200:
-                mainenty.append(k)
-            elif k < 250:
-                titles.append(k)
-            elif k < 300:
-                edimprnt.append(k)
-            elif k < 400:
-                physdesc.append(k)
-            elif k < 500:
-                series.append(k)
-            elif k < 600:
-                notes.append(k)
-            elif k < 700:
-                subjaccs.append(k)
-            elif k < 760:
-                addenty.append(k)
-            elif k < 800:
-                linkenty.append(k)
-            elif k < 840:
-                saddenty.append(k)
-            elif k < 900:
-                holdaltg.append(k)
-            else:
-                fld9xx.append(k)
-
-
-                 
-        marc = self.get_MARC()
-
-        sgml = ["<usmarc>\n"]
-        sgml.append("  <leader>\n")
-        sgml.append("    <lrl>%s</lrl>\n" % (marc[:5]))
-        sgml.append("    <recstat>%s</recstat>\n" % (marc[5]))
-        sgml.append("    <rectype>%s</rectype>\n" % (marc[6]))
-        sgml.append("    <biblevel>%s</biblevel>\n" % (marc[7]))
-        sgml.append("    <ucp>%s</ucp>\n" % (marc[8:10]))
-        sgml.append("    <indcount>%s</indcount>\n" % (marc[10]))
-        sgml.append("    <sfcount>%s</sfcount>\n" % (marc[11]))
-        sgml.append("    <baseaddr>%s</baseaddr>\n" % (marc[12:17]))
-        sgml.append("    <enclevel>%s</enclevel>\n" % (marc[17]))
-        sgml.append("    <dsccatfm>%s</dsccatfm>\n" % (marc[18]))
-        sgml.append("    <linkrec>%s</linkrec>\n" % (marc[19]))
-        sgml.append("    <entrymap>\n")
-        sgml.append("      <flength>%s</flength>\n" % (marc[20]))
-        sgml.append("      <scharpos>%s</scharpos>\n" % (marc[21]))
-        sgml.append("      <idlength>%s</idlength>\n" % (marc[22]))
-        sgml.append("      <emucp>%s</emucp>\n" % (marc[23]))
-        sgml.append("    </entrymap>\n")
-        sgml.append("  </leader>\n")
-        sgml.append("  <directry></directry>\n")
-
-        sgml.append("  <varflds>\n")
-        sgml.append("    <varcflds>\n")
-        for k in cflds:
-            sgml.append("      <fld00%d>%s</fld00%s>\n" % (k, self.fields[k][0], k))
-        sgml.append("    </varcflds>\n")
-        sgml.append("    <vardflds>\n")
-        sgml.append("      <numbcode>\n")
-        for k in numbcode:
-            sgml.append(self.sgml_processCode(k))
-        sgml.append("      </numbcode>\n")
-
-        if mainenty:
-            sgml.append("      <mainenty>\n")
-            for k in mainenty:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </mainenty>\n")
-        if titles:
-            sgml.append("      <titles>\n")
-            for k in titles:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </titles>\n")
-        if edimprnt:
-            sgml.append("      <edimprnt>\n")
-            for k in edimprnt:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </edimprnt>\n")
-        if physdesc:
-            sgml.append("      <physdesc>\n")
-            for k in physdesc:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </physdesc>\n")
-        if series:
-            sgml.append("      <series>\n")
-            for k in series:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </series>\n")
-        if notes:
-            sgml.append("      <notes>\n")
-            for k in notes:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </notes>\n")
-        if subjaccs:
-            sgml.append("      <subjaccs>\n")
-            for k in subjaccs:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </subjaccs>\n")
-        if addenty:
-            sgml.append("      <addenty>\n")
-            for k in addenty:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </addenty>\n")
-        if linkenty:
-            sgml.append("      <linkenty>\n")
-            for k in linkenty:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </linkenty>\n")
-        if saddenty:
-            sgml.append("      <saddenty>\n")
-            for k in saddenty:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </saddenty>\n")
-        if holdaltg:
-            sgml.append("      <holdaltg>\n")
-            for k in holdaltg:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </holdaltg>\n")
-        if fld9xx:
-            sgml.append("      <fld9xx>\n")
-            for k in fld9xx:
-                sgml.append(self.sgml_processCode(k))
-            sgml.append("      </fld9xx>\n")
-        sgml.append("    </vardflds>\n")
-        sgml.append("  </varflds>\n")
-        sgml.append("</usmarc>")
-        return ''.join(sgml)
-        
+        return zcrosswalk.convert(self, 'SGML')
 
     def toSimpleDC(self):
         """ Convert Marc into DC according to LC Crosswalk """
-        xml = ['<dc xmlns="http://www.loc.gov/zing/srw/dcschema/v1.0/">\n']
-
-        # Title -> 245
-        if 245 in self.fields:
-            instance = self.fields[245][0][2]
-            a = ''
-            b = ''
-            for sub in instance:
-                if sub[0] == 'a':
-                    a = sub[1]
-                elif sub[0] == 'b':
-                    b = sub[1]
-            if a and b and a[-1] in [',', '.', ';', ':']:
-                a += " " + b
-            elif a and b:
-                a += "; " + b
-            elif b and not a:
-                a = b
-            xml.append("  <title>%s</title>\n" % (a))
-
-        # Creator -> 100,110,111,700,710,711
-        authorKeys = [100, 110, 111, 700, 710, 711]
-        for k in authorKeys:
-            if k in self.fields:
-                for instance in self.fields[k]:
-                    a = ''
-                    h = ''
-                    d = ''
-                    for sub in instance[2]:
-                        if sub[0] == 'a':
-                            a = sub[1]
-                        elif sub[0] == 'h':
-                            h = sub[1]
-                        elif sub[0] == 'd':
-                            d = sub[1]
-                    if h:
-                        a += ", " + h
-                    if d:
-                        a += " (" + d + ")"
-                    xml.append("  <creator>%s</creator>\n" % (a))
-        
-        # Subject -> 600,610, 611, 630, 650, 653
-        # Just dump in directly...
-        subjectList = [600, 610, 611, 630, 650, 653]
-        for s in subjectList:
-            if s in self.fields:
-                for instance in self.fields[s]:
-                    subject = ''
-                    for sub in instance[2]:
-                        subject += sub[1] + " -- "
-                    subject = subject[:-4]
-                    xml.append("  <subject>%s</subject>\n" % (subject))
-        
-
-        # Publisher -> 260$a$b
-        if 260 in self.fields:
-            for instance in self.fields[260]:
-                a = b = ''
-                for sub in instance[2]:
-                    if sub[0] == 'a':
-                        a = sub[1]
-                    elif sub[0] == 'b':
-                        b = sub[1]
-                        if b[-1] in [',', ';', ':']:
-                            b = b[:-1]
-                    elif sub[0] == 'c':
-                        d = sub[1]
-                        if d[-1] == '.':
-                            d = d[:-1]
-                        xml.append("  <date>%s</date>\n" % (d))
-                if b:
-                    a += " " + b
-                if a:
-                    xml.append("  <publisher>%s</publisher>\n" % (a))
-
-        # Type -> 655
-        if 655 in self.fields:
-            for instance in self.fields[655]:
-                gf = ''
-                for sub in instance[2]:
-                    gf  += sub[1] + " -- "
-                gf = gf[:-4]
-                xml.append("  <type>%s</type>\n" % (gf))
-
-        # Non Standard:  Identifier -> ISSN/ISBN
-        for k in [20,22]:
-            if k in self.fields:
-                for instance in self.fields[k]:
-                    for sub in instance[2]:
-                        if sub[0] == 'a':
-                            xml.append("  <identifier>%s</identifier>\n" % (sub[1]))
-
-        # Non Standard: Description -> 300
-        if 300 in self.fields:
-            for instance in self.fields[300]:
-                desc = ''
-                for sub in instance[2]:
-                    desc += sub[1] + " "
-                desc = desc[:-1]
-                xml.append("  <description>%s</description>\n" % (desc))
-                
-        xml.append("</dc>")
-        return ''.join(xml)
-
+        return zcrosswalk.convert(self, 'DC')
 
     def toMODS(self):
         """ Transform MARC record into MODS according to CrossWalk """
@@ -1161,16 +1057,1143 @@ class MARC:
         txt = ''.join(xml)
         return txt
 
+
+def _to_int (b):
+    """int from ASCII digits in b, 0 if b is blank (like extract_int)"""
+    try:
+        return int (b)
+    except ValueError:
+        if not b.strip ():
+            return 0
+        raise MarcError ("Un-intable string: %r" % (b,))
+
+_dir_structs = {}
+
+def _decode_directory (directory):
+    """Decode a MARC directory to an array of tag, length and offset
+    triples.  The usual case, all digits, is done with one struct.unpack;
+    otherwise we go entry by entry, stopping at a terminator and
+    skipping non-numeric tags."""
+    n = len (directory) // 12
+    entries = directory [:n * 12]
+    if entries.isdigit ():
+        st = _dir_structs.get (n)
+        if st == None:
+            st = _dir_structs [n] = struct.Struct ('3s4s5s' * n)
+        return array.array ('l', list (map (int, st.unpack (entries))))
+    d = array.array ('l')
+    for pos in range (0, n * 12, 12):
+        tag = directory [pos:pos + 3]
+        if tag [:1] in (b'\x1d', b'\x1e'):
+            break
+        if not tag.isdigit ():
+            continue
+        d.append (int (tag))
+        d.append (_to_int (directory [pos + 3:pos + 7]))
+        d.append (_to_int (directory [pos + 7:pos + 12]))
+    return d
+
+def _to_int (b):
+    """int from ASCII digits in b, 0 if b is blank (like extract_int)"""
+    try:
+        return int (b)
+    except ValueError:
+        if not b.strip ():
+            return 0
+        raise MarcError ("Un-intable string: %r" % (b,))
+
+_dir_structs = {}
+
+def _decode_directory (directory):
+    """Decode a MARC directory to an array of tag, length and offset
+    triples.  The usual case, all digits, is done with one struct.unpack;
+    otherwise we go entry by entry, stopping at a terminator and
+    skipping non-numeric tags."""
+    n = len (directory) // 12
+    entries = directory [:n * 12]
+    if entries.isdigit ():
+        st = _dir_structs.get (n)
+        if st == None:
+            st = _dir_structs [n] = struct.Struct ('3s4s5s' * n)
+        return array.array ('l', list (map (int, st.unpack (entries))))
+    d = array.array ('l')
+    for pos in range (0, n * 12, 12):
+        tag = directory [pos:pos + 3]
+        if tag [:1] in (b'\x1d', b'\x1e'):
+            break
+        if not tag.isdigit ():
+            continue
+        d.append (int (tag))
+        d.append (_to_int (directory [pos + 3:pos + 7]))
+        d.append (_to_int (directory [pos + 7:pos + 12]))
+    return d
+
+class _LazyFields (MutableMapping):
+    """The 'fields' dict of a LazyMARC.  A tag's occurrences are parsed
+    the first time the tag is looked up, and cached; assignments and
+    deletions only affect the cache, as for an ordinary dict."""
+    def __init__ (self, rec, zerostr):
+        self._rec = rec
+        self._decoded = {0 : [zerostr]}
+        self._loaded = set ([0])
+        self._all = 0
+    def _load (self, tag):
+        if tag in self._loaded:
+            return
+        self._loaded.add (tag)
+        l = self._rec._parse_tag (tag)
+        if l:
+            self._decoded [tag] = l
+    def _load_all (self):
+        if self._all:
+            return
+        self._all = 1
+        ordered = {0 : self._decoded.pop (0, None)}
+        for tag in self._rec._tags: # keep directory order, as MARC does
+            self._load (tag)
+            if tag in self._decoded:
+                ordered [tag] = self._decoded.pop (tag)
+        if ordered [0] == None:
+            del ordered [0]
+        ordered.update (self._decoded)
+        self._decoded = ordered
+    def __getitem__ (self, tag):
+        self._load (tag)
+        return self._decoded [tag]
+    def __setitem__ (self, tag, val):
+        self._loaded.add (tag)
+        self._decoded [tag] = val
+    def __delitem__ (self, tag):
+        self._load (tag)
+        del self._decoded [tag]
+    def __contains__ (self, tag):
+        self._load (tag)
+        return tag in self._decoded
+    def __iter__ (self):
+        self._load_all ()
+        return iter (list (self._decoded.keys ()))
+    def __len__ (self):
+        self._load_all ()
+        return len (self._decoded)
+    def tags (self):
+        """Sorted list of the tags present, found without parsing any
+        fields (so a tag whose fields turn out empty may be listed)"""
+        tags = set (self._decoded)
+        for tag in self._rec._tags:
+            if tag not in self._loaded:
+                tags.add (tag)
+        return sorted (tags)
+    def __eq__ (self, other):
+        return dict (self.items ()) == other
+    def __ne__ (self, other):
+        return not self == other
+    def __repr__ (self):
+        return repr (dict (self.items ()))
+
+class LazyMARC (MARC):
+    """MARC parsed from bytes (or a memoryview, bytearray, or str with
+    one char per byte) without splitting it all up front: the directory
+    is decoded in one pass into an array of (tag, length, offset), and a
+    field is only split into subfields when its tag is first looked up
+    in 'fields', which otherwise behaves just like MARC's.  Much faster
+    and smaller when only a few fields of each record are wanted.  Field
+    data are str, one char per byte, as for MARC.  Tags which aren't
+    numeric can't be represented in 'fields', and are skipped."""
+    def __init__ (self, MARC = None, strict = 1):
+        if MARC == None:
+            self.fields = {}
+            self.ok = 0
+            self.marc = None
+            return
+        if isinstance (MARC, str):
+            MARC = MARC.encode ('latin-1')
+        self.marc = MARC
+        self.ok = 0
+        leader = bytes (MARC [:24]).decode ('latin-1')
+        if len (leader) < 24:
+            raise MarcError ("Short leader: %r" % (leader,))
+        self.reclen = _to_int (leader [0:5])
+        self._base = baseaddr = _to_int (leader [12:17])
+        if strict:
+            assert (leader [9] == ' ') # 'a' would be UCS/Unicode
+            assert (leader [10] == '2' and leader [11] == '2')
+            assert (leader [20:22] == '45')
+        self._dir = _decode_directory (bytes (MARC [24:baseaddr]))
+        zerostr = "".join ([leader [i] for i in self.hdrbits])
+        self.fields = _LazyFields (self, zerostr)
+        self.ok = 1
+    def _tags (self):
+        return self._dir [0::3]
+    _tags = property (_tags)
+    def _parse_tag (self, tag):
+        """Return the list MARC would have in fields [tag]"""
+        l = []
+        d = self._dir
+        for i in range (0, len (d), 3):
+            if d [i] != tag:
+                continue
+            start = self._base + d [i + 2]
+            line = bytes (self.marc [start:start + d [i + 1]])
+            line = line.decode ('latin-1')
+            if len (line) == 0:
+                continue
+            if line [-1] == fieldsep:
+                line = line [:-1]
+            if is_fixed (tag):
+                l = [line] # MARC keeps only the last occurrence
+            else:
+                ps = parse_sub (line)
+                if ps != None:
+                    l.append (ps)
+        return l
+
+
+MAX_RECORD_LENGTH = 99999
+"""ISO 2709 record lengths are 5 digits"""
+
+def _parse_record (args):
+    """Parse raw MARC bytes.  Module-level so that worker processes can
+    unpickle it."""
+    (data, strict, lazy) = args
+    if lazy:
+        return LazyMARC (data, strict = strict)
+    return MARC (data.decode ('latin-1'), strict = strict)
+
+_recsep_b = b'\x1d'
+
+_parse_errors = (MarcError, AssertionError, IndexError, ValueError)
+
+class _MmapSource:
+    def __init__ (self, f):
+        self._mm = mmap.mmap (f.fileno (), 0, access = mmap.ACCESS_READ)
+    def get (self, pos, n):
+        return self._mm [pos:pos + n]
+    def find (self, sub, pos, end):
+        return self._mm.find (sub, pos, end)
+    def release (self, pos):
+        pass
+    def close (self):
+        self._mm.close ()
+
+class _StreamSource:
+    """Buffered reads from a file object.  Bytes before the position
+    passed to release are dropped, so the buffer never holds much more
+    than a record."""
+    def __init__ (self, f, bufsize, start):
+        self._f = f
+        self._bufsize = bufsize
+        self._buf = bytearray ()
+        self._start = start # file offset of self._buf [0]
+        self._eof = 0
+    def _fill (self, end):
+        while not self._eof and self._start + len (self._buf) < end:
+            chunk = self._f.read (max (self._bufsize,
+                                       end - self._start - len (self._buf)))
+            if not chunk:
+                self._eof = 1
+            self._buf += chunk
+    def get (self, pos, n):
+        self._fill (pos + n)
+        i = pos - self._start
+        return bytes (self._buf [i:i + n])
+    def find (self, sub, pos, end):
+        self._fill (end)
+        i = self._buf.find (sub, pos - self._start, end - self._start)
+        if i < 0:
+            return i
+        return i + self._start
+    def release (self, pos):
+        if pos - self._start > self._bufsize:
+            del self._buf [:pos - self._start]
+            self._start = pos
+    def close (self):
+        pass
+
+class MARCReader:
+    """Iterates over the records in an ISO 2709 file, in constant
+    memory.  f is a filename or a file object opened in binary mode
+    (which close won't close).  Regular files are mmapped (unless
+    use_mmap is false); other streams are read bufsize bytes at a time.
+
+    Records are found by the record length in their leaders.  If a
+    leader is garbled, or the byte at the end of the record isn't a
+    record terminator, the data up to the next terminator is taken as
+    the record instead (counted in 'recovered', with its leader's
+    record length corrected); if it won't parse, it's skipped and
+    counted in 'errors', unless errors is 'strict', in which case the
+    exception is raised.  Data which can't be recovered (no
+    terminator within MAX_RECORD_LENGTH bytes, or too short to be a
+    record) is skipped and counted in 'skipped'.  Whitespace between
+    records is ignored.
+
+    Records are MARC objects, or LazyMARC if lazy is set.  With workers
+    greater than 0, parsing is done by that many processes, at most
+    window records in flight; records are still returned in file order.
+    """
+    def __init__ (self, f, strict = 1, lazy = 0, errors = 'skip',
+                  use_mmap = 1, bufsize = 1 << 16, workers = 0,
+                  window = 256):
+        if errors not in ('skip', 'strict'):
+            raise ValueError ("errors must be 'skip' or 'strict'")
+        if window < 1:
+            raise ValueError ("window must be at least 1")
+        self.strict = strict
+        self.lazy = lazy
+        self.errorMode = errors
+        self.workers = workers
+        self.window = window
+        self.name = getattr (f, 'name', f)
+        self._owned = not hasattr (f, 'read')
+        if self._owned:
+            f = open (f, 'rb')
+        self._f = f
+        self._source = None
+        if use_mmap:
+            try:
+                self._source = _MmapSource (f)
+            except (AttributeError, EnvironmentError, ValueError):
+                pass # not a regular file, or an empty one
+        try:
+            self._pos = f.tell ()
+        except (AttributeError, EnvironmentError):
+            self._pos = 0
+        if self._source == None:
+            self._source = _StreamSource (f, bufsize, self._pos)
+        self.records = 0
+        self.recovered = 0
+        self.skipped = 0
+        self.errors = 0
+    def _next_raw (self):
+        """Return (offset, bytes) of the next record, or None at the end"""
+        src = self._source
+        while 1:
+            pos = self._pos
+            src.release (pos)
+            leader = src.get (pos, 24)
+            if not leader:
+                return None
+            stripped = leader.lstrip ()
+            if len (stripped) < len (leader):
+                self._pos += len (leader) - len (stripped)
+                continue
+            length = 0
+            if leader [:5].isdigit ():
+                length = int (leader [:5])
+            if length >= 24:
+                data = src.get (pos, length)
+                if len (data) == length and data [-1:] == _recsep_b:
+                    self._pos = pos + length
+                    return (pos, data)
+            # Recover: take everything up to the next record terminator
+            end = src.find (_recsep_b, pos, pos + MAX_RECORD_LENGTH)
+            if end < 0:
+                # no terminator in reach: skip it all
+                data = src.get (pos, MAX_RECORD_LENGTH)
+                self._pos = pos + len (data)
+            else:
+                self._pos = end + 1
+            if end < 0 or end + 1 - pos < 24:
+                self.skipped += 1
+                if self.errorMode == 'strict':
+                    raise MarcError ("Unrecoverable data at offset %d" % pos)
+                continue
+            self.recovered += 1
+            data = src.get (pos, end + 1 - pos)
+            return (pos, ('%05d' % len (data)).encode ('ascii') + data [5:])
+    def iter_raw (self):
+        """Yield (offset, bytes) for each record, unparsed"""
+        while 1:
+            r = self._next_raw ()
+            if r == None:
+                return
+            yield r
+    def _parsed (self, data):
+        try:
+            return _parse_record ((data, self.strict, self.lazy))
+        except _parse_errors:
+            if self.errorMode == 'strict':
+                raise
+            self.errors += 1
+            return None
+    def __iter__ (self):
+        """Yield parsed records"""
+        if self.workers <= 0:
+            for (offset, data) in self.iter_raw ():
+                rec = self._parsed (data)
+                if rec != None:
+                    self.records += 1
+                    yield rec
+            return
+        pool = multiprocessing.Pool (self.workers)
+        pending = collections.deque ()
+        def drain_one ():
+            try:
+                return pending.popleft ().get ()
+            except _parse_errors:
+                if self.errorMode == 'strict':
+                    raise
+                self.errors += 1
+                return None
+        try:
+            for (offset, data) in self.iter_raw ():
+                pending.append (pool.apply_async (
+                    _parse_record, ((data, self.strict, self.lazy),)))
+                if len (pending) >= self.window:
+                    rec = drain_one ()
+                    if rec != None:
+                        self.records += 1
+                        yield rec
+            while pending:
+                rec = drain_one ()
+                if rec != None:
+                    self.records += 1
+                    yield rec
+        finally:
+            pool.terminate ()
+            pool.join ()
+    def close (self):
+        self._source.close ()
+        if self._owned:
+            self._f.close ()
+
+
+class MARCWriter:
+    """Writes records to a file as ISO 2709.  f is a filename or a file
+    object opened in binary mode (which close won't close).  Records
+    may be MARC objects, encoded with encoding (see MARC.as_bytes), or
+    raw records (bytes, or str with one char per byte) which are
+    written as they are.  Each record is written a field at a time, so
+    nothing the size of a record is built."""
+    def __init__ (self, f, encoding = 'latin-1'):
+        self.encoding = encoding
+        self.name = getattr (f, 'name', f)
+        self._owned = not hasattr (f, 'write')
+        if self._owned:
+            f = open (f, 'wb')
+        self._f = f
+        self.records = 0
+        self.bytes = 0
+    def _encode (self, s):
+        return s.encode (self.encoding)
+    def write (self, rec):
+        if isinstance (rec, MARC):
+            chunks = rec.chunks (self._encode)
+        elif isinstance (rec, str):
+            chunks = [rec.encode ('latin-1')]
+        else:
+            chunks = [rec]
+        self._f.writelines (chunks)
+        self.records += 1
+        self.bytes += sum ([len (c) for c in chunks])
+    def close (self):
+        if self._owned:
+            self._f.close ()
+        else:
+            self._f.flush ()
+
+def write_records (records, f, encoding = 'latin-1'):
+    """Write the records in iterable records (see MARCWriter) to f, and
+    return the number written"""
+    writer = MARCWriter (f, encoding)
+    try:
+        for rec in records:
+            writer.write (rec)
+    finally:
+        writer.close ()
+    return writer.records
+
+_xml_collections = {
+    # format : (header, footer, pieces method)
+    'MARCXML'  : ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<collection xmlns="http://www.loc.gov/MARC21/slim">\n',
+                  '</collection>\n', 'marcxml_pieces'),
+    'OAI-MARC' : ('<?xml version="1.0" encoding="UTF-8"?>\n<collection>\n',
+                  '</collection>\n', 'oaimarc_pieces')
+    }
+
+class MARCXMLWriter:
+    """Streams records to f as a MARCXML (or, if fmt is 'OAI-MARC',
+    OAI-MARC) <collection>, a record at a time.  f is a filename or a
+    file object opened in binary mode (which close won't close).
+    Records may be MARC objects, or raw ISO 2709 (bytes, or str with one
+    char per byte).  Text is encoded with encoding: the default,
+    latin-1, writes out the bytes of records parsed from raw MARC, which
+    has one char per byte, so UTF-8 records make UTF-8 XML.  close must
+    be called to finish the collection."""
+    def __init__ (self, f, fmt = 'MARCXML', encoding = 'latin-1'):
+        if fmt not in _xml_collections:
+            raise ValueError ("Unknown XML format %s" % fmt)
+        (header, self._footer, self._meth) = _xml_collections [fmt]
+        self.fmt = fmt
+        self.encoding = encoding
+        self.name = getattr (f, 'name', f)
+        self._owned = not hasattr (f, 'write')
+        if self._owned:
+            f = open (f, 'wb')
+        self._f = f
+        self.records = 0
+        self._f.write (header.encode ('ascii'))
+    def write (self, rec):
+        if not isinstance (rec, MARC):
+            rec = LazyMARC (rec, strict = 0)
+        encoding = self.encoding
+        self._f.writelines ([piece.encode (encoding) for piece in
+                             getattr (rec, self._meth) ()])
+        self._f.write (b"\n")
+        self.records += 1
+    def close (self):
+        self._f.write (self._footer.encode ('ascii'))
+        if self._owned:
+            self._f.close ()
+        else:
+            self._f.flush ()
+
+def _local_name (tag):
+    """Strip the namespace from an ElementTree tag"""
+    return tag.rsplit ('}', 1) [-1]
+
+_marcxml_ns = ('', '{http://www.loc.gov/MARC21/slim}')
+
+class MARCXMLReader:
+    """Iterates over the <record>s in a MARCXML file (a filename or file
+    object), returning MARC objects.  Records are parsed incrementally
+    and discarded once returned, so memory use doesn't depend on the
+    size of the file.  Only records in the MARC21 slim namespace (or no
+    namespace) are read, so MARCXML inside OAI-PMH responses works too.
+
+    As with records parsed from ISO 2709, field data are str with one
+    char per byte (here, the UTF-8 bytes), so the records can be written
+    out with MARCWriter and MARCXMLWriter unchanged; set unicode to get
+    the decoded text instead.  Tags which aren't numeric are skipped."""
+    def __init__ (self, f, unicode = 0):
+        self.name = getattr (f, 'name', f)
+        self.unicode = unicode
+        self._owned = not hasattr (f, 'read')
+        if self._owned:
+            f = open (f, 'rb')
+        self._f = f
+        self.records = 0
+    def _text (self, elem):
+        text = elem.text or ''
+        if not self.unicode:
+            text = text.encode ('utf-8').decode ('latin-1')
+        return text
+    def _marc (self, elem):
+        marc = MARC ()
+        marc.fields [0] = [' ' * len (MARC.hdrbits)]
+        for child in elem:
+            name = _local_name (child.tag)
+            if name == 'leader':
+                leader = self._text (child).ljust (24)
+                marc.fields [0] = ["".join ([leader [i] for i in
+                                             MARC.hdrbits])]
+                continue
+            tag = child.get ('tag', '')
+            if name not in ('controlfield', 'datafield') or not tag.isdigit ():
+                continue
+            if name == 'controlfield':
+                marc.fields [int (tag)] = [self._text (child)]
+            else:
+                subfields = [(sub.get ('code', ''), self._text (sub))
+                             for sub in child
+                             if _local_name (sub.tag) == 'subfield']
+                marc.fields.setdefault (int (tag), []).append (
+                    (child.get ('ind1') or ' ', child.get ('ind2') or ' ',
+                     subfields))
+        marc.ok = 1
+        return marc
+    def __iter__ (self):
+        root = None
+        for (event, elem) in ElementTree.iterparse (self._f,
+                                                    ('start', 'end')):
+            if event == 'start':
+                if root == None:
+                    root = elem
+                continue
+            if (_local_name (elem.tag) != 'record' or
+                elem.tag [:-len ('record')] not in _marcxml_ns):
+                continue
+            self.records += 1
+            yield self._marc (elem)
+            elem.clear ()
+            root.clear ()
+    def close (self):
+        if self._owned:
+            self._f.close ()
+
+def _normalize_035 (s):
+    s = s.strip ()
+    if s.startswith ('(OCoLC)'):
+        return '(OCoLC)' + normalize_oclc (s)
+    return s
+
+def _normalize_strip (s):
+    return s.strip ()
+
+_selector_normalizers = {10 : normalize_lccn, 20 : normalize_isbn,
+                         22 : normalize_issn, 35 : _normalize_035}
+
+_selector_re = re.compile (
+    '^([0-9]{1,3}|[0-9Xx]{3})'          # tag, X for any digit
+    '(?:\\[([^]]*)\\])?'                # indicator conditions
+    '((?:\\$[0-9a-z]+)*)'               # subfield codes
+    '(?:/([0-9]+)(?:-([0-9]+))?)?$')    # character positions
+_condition_re = re.compile ('^ind([12])=(.+)$')
+
+class Selector:
+    """A MARC field path, compiled once and then applied to any number
+    of MARC (or LazyMARC) records.  The syntax is
+
+        TAG[ind1=x,ind2=y]$codes/start-end
+
+    where everything but the tag is optional.  TAG is a field number,
+    or three characters with X standing for any digit ('6XX').  The
+    indicator conditions give the allowed values ('ind2=04' means 0 or
+    4; '#' or '_' is a blank).  Subfield codes may be written '$a$x' or
+    '$ax', and only apply to data fields: with none, all subfields are
+    selected.  Character positions (end inclusive) only apply to
+    control fields, so '008/07-10' is the date in the 008.
+
+    Sample usage:
+        sel = zmarc.selector ('650[ind2=0]$a$x')
+        headings = sel (marc)
+        titles = zmarc.selector ('245$ab').batch (raw_records)
+    """
+    def __init__ (self, spec):
+        m = _selector_re.match (spec)
+        if m == None:
+            raise ValueError ("Bad field selector %r" % (spec,))
+        (tag, conds, codes, start, end) = m.groups ()
+        self.spec = spec
+        self.ind1 = self.ind2 = None
+        if conds != None:
+            for cond in conds.split (','):
+                c = _condition_re.match (cond.strip ())
+                if c == None:
+                    raise ValueError ("Bad indicator condition %r in %r" %
+                                      (cond, spec))
+                vals = c.group (2).replace ('#', ' ').replace ('_', ' ')
+                setattr (self, 'ind' + c.group (1), vals)
+        self.codes = codes.replace ('$', '') or None
+        self.positions = None
+        if start != None:
+            if end == None:
+                end = start
+            self.positions = (int (start), int (end) + 1)
+        if 'X' in tag.upper ():
+            self.tag = None
+            pattern = tag.upper ()
+            self._tagset = frozenset (
+                [t for t in range (1, 1000)
+                 if [p for (p, d) in zip (pattern, '%03d' % t)
+                     if p != 'X' and p != d] == []])
+        else:
+            self.tag = int (tag)
+            self._tagset = frozenset ([self.tag])
+            if is_fixed (self.tag) and (self.codes != None or
+                                        conds != None):
+                raise ValueError ("Control field %r has no subfields or "
+                                  "indicators" % (spec,))
+            if not is_fixed (self.tag) and self.positions != None:
+                raise ValueError ("Data field %r has no character "
+                                  "positions" % (spec,))
+        self.select = self._compile_select ()
+        self.values = self._compile_values ()
+    def __repr__ (self):
+        return 'Selector(%r)' % (self.spec,)
+    def __call__ (self, marc):
+        return self.select (marc)
+
+    def _tag_lists (self, marc):
+        """[(tag, occurrences)] for the selected tags present in marc"""
+        fields = marc.fields
+        if self.tag != None:
+            occs = fields.get (self.tag)
+            if occs:
+                return [(self.tag, occs)]
+            return []
+        tags = getattr (fields, 'tags', None) # LazyMARC: no parsing
+        if tags != None:
+            tags = tags ()
+        else:
+            tags = sorted (fields)
+        tagset = self._tagset
+        out = []
+        for tag in tags:
+            if tag in tagset:
+                occs = fields.get (tag)
+                if occs:
+                    out.append ((tag, occs))
+        return out
+    def occurrences (self, marc):
+        """List of (tag, ind1, ind2, values) for each selected field of
+        marc which has any values.  Control fields have None for the
+        indicators and their text (or the selected positions of it) as
+        the only value."""
+        (codes, ind1, ind2, pos) = (self.codes, self.ind1, self.ind2,
+                                    self.positions)
+        out = []
+        for (tag, occs) in self._tag_lists (marc):
+            if is_fixed (tag):
+                if codes != None or ind1 != None or ind2 != None:
+                    continue # only reachable with a wildcard tag
+                for val in occs:
+                    if pos != None:
+                        val = val [pos [0]:pos [1]]
+                    out.append ((tag, None, None, [val]))
+                continue
+            if pos != None:
+                continue
+            for (i1, i2, subfields) in occs:
+                if ((ind1 != None and i1 not in ind1) or
+                    (ind2 != None and i2 not in ind2)):
+                    continue
+                if codes == None:
+                    vals = [v for (c, v) in subfields]
+                else:
+                    vals = [v for (c, v) in subfields if c in codes]
+                if vals:
+                    out.append ((tag, i1, i2, vals))
+        return out
+    def _compile_select (self):
+        """Return a function giving, for each selected field with any
+        values, the values joined by spaces.  The common cases get
+        their own closures, so nothing is tested per record that could
+        be decided here."""
+        (tag, codes, pos) = (self.tag, self.codes, self.positions)
+        if tag == None or self.ind1 != None or self.ind2 != None:
+            def select (marc):
+                return [' '.join (o [3]) for o in self.occurrences (marc)]
+        elif is_fixed (tag) and pos == None:
+            def select (marc):
+                return list (marc.fields.get (tag, ()))
+        elif is_fixed (tag):
+            (start, end) = pos
+            def select (marc):
+                return [v [start:end] for v in marc.fields.get (tag, ())]
+        elif codes == None:
+            def select (marc):
+                return [' '.join ([v for (c, v) in subfields])
+                        for (i1, i2, subfields) in marc.fields.get (tag, ())
+                        if subfields]
+        elif len (codes) == 1:
+            def select (marc):
+                out = []
+                for (i1, i2, subfields) in marc.fields.get (tag, ()):
+                    vals = [v for (c, v) in subfields if c == codes]
+                    if vals:
+                        out.append (' '.join (vals))
+                return out
+        else:
+            def select (marc):
+                out = []
+                for (i1, i2, subfields) in marc.fields.get (tag, ()):
+                    vals = [v for (c, v) in subfields if c in codes]
+                    if vals:
+                        out.append (' '.join (vals))
+                return out
+        return select
+    def _compile_values (self):
+        """Return a function giving the selected values, not grouped by
+        field"""
+        (tag, codes, pos) = (self.tag, self.codes, self.positions)
+        if tag == None or self.ind1 != None or self.ind2 != None:
+            def values (marc):
+                return [v for o in self.occurrences (marc) for v in o [3]]
+        elif is_fixed (tag):
+            return self.select
+        elif codes == None:
+            def values (marc):
+                return [v for (i1, i2, subfields) in marc.fields.get (tag, ())
+                        for (c, v) in subfields]
+        else:
+            def values (marc):
+                return [v for (i1, i2, subfields) in marc.fields.get (tag, ())
+                        for (c, v) in subfields if c in codes]
+        return values
+
+    def first (self, marc, default = None):
+        """The first value select would return, or default"""
+        vals = self.select (marc)
+        if vals:
+            return vals [0]
+        return default
+    def count (self, marc):
+        """Number of selected fields with any values"""
+        return len (self.select (marc))
+    def batch (self, records, strict = 0):
+        """Return [self.select (rec) for rec in records], where records
+        may hold MARC objects, raw records, or objects with the raw
+        record as 'data' (such as zoom Records).  Raw records are parsed
+        as LazyMARC, so only the selected fields are split up."""
+        select = self.select
+        return [select (_as_marc (rec, strict)) for rec in records]
+
+def _as_marc (rec, strict = 0):
+    if isinstance (rec, MARC):
+        return rec
+    return LazyMARC (getattr (rec, 'data', rec), strict = strict)
+
+_selector_cache = {}
+
+def selector (spec):
+    """Return the Selector for spec, compiling it only the first time
+    spec is seen.  A Selector is returned as is."""
+    if isinstance (spec, Selector):
+        return spec
+    sel = _selector_cache.get (spec)
+    if sel == None:
+        sel = _selector_cache [spec] = Selector (spec)
+    return sel
+
+def select_all (specs, records, strict = 0):
+    """Yield, for each of records (as for Selector.batch), the list of
+    results of each of specs, parsing each record only once."""
+    sels = [selector (spec) for spec in specs]
+    for rec in records:
+        marc = _as_marc (rec, strict)
+        yield [sel.select (marc) for sel in sels]
+
+def _tag_selector (spec):
+    """Return (select, normalize) for spec, a Selector spec (data fields
+    default to $a).  select returns the normalized values found in a
+    MARC record."""
+    sel = selector (spec)
+    if (sel.tag != None and not is_fixed (sel.tag) and
+        sel.codes == None):
+        sel = selector (spec + '$a')
+    norm = _selector_normalizers.get (sel.tag, _normalize_strip)
+    values = sel.values
+    def select (marc):
+        return [v for v in map (norm, values (marc)) if v != None]
+    return (select, norm)
+
+INDEX_VERSION = 2
+"""Version of the MARCIndex file format"""
+
+_index_magic = b'PYZMIDX\n'
+_index_entry = struct.Struct ('>QQI') # key hash, record offset, length
+_tail_bytes = 4096
+
+def _key_hash (val):
+    return struct.unpack ('>Q', hashlib.md5 (val.encode ('utf-8')).digest ()
+                          [:8]) [0]
+
+class MARCIndex:
+    """Random access to the records of an ISO 2709 file by key.
+
+    keys lists what to index: Selector specs such as '001' or
+    '650[ind2=0]$a' (subfield a if no codes are given for a data field;
+    control fields are indexed whole), or functions taking a MARC record
+    and returning a list of strings, either bare or as (name, function)
+    pairs.  A key is named by its spec, its given name, or (for a bare
+    function) 'fn' and its position in keys, e.g. 'fn2'; lookups take
+    the name, or the function itself.
+    Values of 010, 020, 022 and 035 (OCoLC) are normalized as by
+    normalize_lccn, normalize_isbn, normalize_issn and normalize_oclc,
+    both when indexing and when looking up; others are stripped.
+
+    The index is kept in a sidecar file (by default path + '.idx'):
+    for each key, a table of (hash of value, record offset, record
+    length) sorted by hash, so a lookup is a binary search in the mmapped table, then a
+    parse of each candidate record to weed out hash collisions.  The
+    sidecar records how much of the file it covers; when opened (or
+    when update is called) after records have been appended, only the
+    new records are scanned.  If the file has been rewritten, or the
+    keys differ, it's rebuilt from scratch.  Building sorts in chunks
+    of chunkEntries, spilled to temporary files, so memory use doesn't
+    grow with the size of the file.
+
+    Sample usage:
+        idx = zmarc.MARCIndex ('dump.mrc', keys = ['001', '020', '035'])
+        rec = idx.get ('ocm12345678')
+        recs = idx.lookup ('0-312-03309-5', key = '020')
+    """
+    def __init__ (self, path, keys = ('001',), indexPath = None,
+                  chunkEntries = 500000, strict = 0):
+        self.path = path
+        if indexPath == None:
+            indexPath = path + '.idx'
+        self.indexPath = indexPath
+        self.chunkEntries = chunkEntries
+        self.strict = strict
+        self.keys = []
+        self._selectors = {}
+        self._fnNames = {}
+        for (i, spec) in enumerate (keys):
+            if isinstance (spec, tuple):
+                (name, fn) = spec
+                sel = (fn, _normalize_strip)
+                self._fnNames [fn] = name
+            elif callable (spec):
+                name = 'fn%d' % i
+                sel = (spec, _normalize_strip)
+                self._fnNames [spec] = name
+            else:
+                name = spec
+                sel = _tag_selector (spec)
+            if name in self._selectors:
+                raise ValueError ("Duplicate MARCIndex key %s" % name)
+            self.keys.append (name)
+            self._selectors [name] = sel
+        self.records = 0
+        self.errors = 0
+        self._data_f = None
+        self._data = None
+        self._index_f = None
+        self._index = None
+        self._tables = {}
+        self.update ()
+
+    def _tail_check (self, f, size):
+        f.seek (max (0, size - _tail_bytes))
+        return hashlib.md5 (f.read (size - max (0, size - _tail_bytes))
+                            ).hexdigest ()
+    def _read_header (self):
+        try:
+            f = open (self.indexPath, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            if f.read (len (_index_magic)) != _index_magic:
+                return None
+            try:
+                (hlen,) = struct.unpack ('>I', f.read (4))
+                header = json.loads (f.read (hlen).decode ('utf-8'))
+            except (struct.error, ValueError):
+                return None
+        finally:
+            f.close ()
+        if not isinstance (header, dict) or header.get (
+            'version') != INDEX_VERSION:
+            return None
+        header ['tablesStart'] = len (_index_magic) + 4 + hlen
+        return header
+    def _open_maps (self, header):
+        self.records = header ['records']
+        self._data_f = open (self.path, 'rb')
+        try:
+            self._data = mmap.mmap (self._data_f.fileno (), 0,
+                                    access = mmap.ACCESS_READ)
+        except ValueError: # empty file
+            self._data = None
+        self._index_f = open (self.indexPath, 'rb')
+        self._index = mmap.mmap (self._index_f.fileno (), 0,
+                                 access = mmap.ACCESS_READ)
+        start = header ['tablesStart']
+        for (name, count) in zip (header ['keys'], header ['counts']):
+            self._tables [name] = (start, count)
+            start += count * _index_entry.size
+    def close (self):
+        for attr in ('_data', '_data_f', '_index', '_index_f'):
+            obj = getattr (self, attr)
+            if obj != None:
+                obj.close ()
+            setattr (self, attr, None)
+        self._tables = {}
+
+    def update (self):
+        """Bring the index up to date with the file, and return the
+        number of records scanned"""
+        self.close ()
+        f = open (self.path, 'rb')
+        try:
+            size = os.fstat (f.fileno ()).st_size
+            header = self._read_header ()
+            if (header != None and header ['keys'] == self.keys and
+                header ['size'] <= size and
+                self._tail_check (f, header ['size']) == header ['check']):
+                if header ['size'] == size:
+                    self._open_maps (header)
+                    return 0
+                start = header ['size']
+            else:
+                header = None
+                start = 0
+            f.seek (start)
+            runs = dict ([(name, []) for name in self.keys])
+            chunks = dict ([(name, []) for name in self.keys])
+            pending = 0
+            scanned = 0
+            reader = MARCReader (f, strict = self.strict)
+            for (offset, raw) in reader.iter_raw ():
+                scanned += 1
+                try:
+                    marc = LazyMARC (raw, strict = self.strict)
+                    for name in self.keys:
+                        select = self._selectors [name][0]
+                        for val in select (marc):
+                            # the real length: the leader's may be wrong
+                            # in a record MARCReader recovered
+                            chunks [name].append ((_key_hash (val), offset,
+                                                   len (raw)))
+                            pending += 1
+                except _parse_errors:
+                    self.errors += 1
+                    continue
+                if pending >= self.chunkEntries:
+                    for name in self.keys:
+                        chunks [name].sort ()
+                        runs [name].append (self._spill (chunks [name]))
+                        chunks [name] = []
+                    pending = 0
+            reader.close ()
+            for name in self.keys:
+                chunks [name].sort ()
+            records = scanned
+            if header != None:
+                records += header ['records']
+            self._write (header, size, self._tail_check (f, size), records,
+                         runs, chunks)
+        finally:
+            f.close ()
+        self._open_maps (self._read_header ())
+        return scanned
+
+    def _spill (self, chunk):
+        f = tempfile.TemporaryFile ()
+        f.write (b''.join ([_index_entry.pack (*entry) for entry in chunk]))
+        f.seek (0)
+        return f
+    def _read_run (self, f, count = None):
+        try:
+            while count == None or count > 0:
+                b = f.read (_index_entry.size)
+                if len (b) < _index_entry.size:
+                    return
+                if count != None:
+                    count -= 1
+                yield _index_entry.unpack (b)
+        finally:
+            f.close ()
+    def _old_table (self, header, name):
+        """Open the existing index file positioned at name's table"""
+        f = open (self.indexPath, 'rb')
+        start = header ['tablesStart']
+        for (n, count) in zip (header ['keys'], header ['counts']):
+            if n == name:
+                f.seek (start)
+                return self._read_run (f, count)
+            start += count * _index_entry.size
+    def _write (self, old, size, check, records, runs, chunks):
+        counts = []
+        for name in self.keys:
+            count = len (chunks [name])
+            for run in runs [name]:
+                run.seek (0, 2)
+                count += run.tell () // _index_entry.size
+                run.seek (0)
+            if old != None:
+                count += old ['counts'][old ['keys'].index (name)]
+            counts.append (count)
+        header = json.dumps ({'version' : INDEX_VERSION, 'size' : size,
+                              'check' : check, 'records' : records,
+                              'keys' : self.keys, 'counts' : counts})
+        header = header.encode ('utf-8')
+        def fill (out):
+            out.write (_index_magic + struct.pack ('>I', len (header)) + header)
+            for name in self.keys:
+                iters = [self._read_run (run) for run in runs [name]]
+                iters.append (iter (chunks [name]))
+                if old != None:
+                    iters.append (self._old_table (old, name))
+                buf = []
+                for entry in heapq.merge (*iters):
+                    buf.append (_index_entry.pack (*entry))
+                    if len (buf) >= 8192:
+                        out.write (b''.join (buf))
+                        buf = []
+                out.write (b''.join (buf))
+        atomicfile.write (self.indexPath, fill, binary = 1)
+
+    def _key_name (self, key):
+        if key == None:
+            return self.keys [0]
+        if callable (key):
+            return self._fnNames [key]
+        return key
+    def offsets (self, value, key = None):
+        """Return the offsets of records which may have value for key
+        (default the first of keys): all those whose value hashes the
+        same"""
+        return [offset for (offset, length) in self._entries (value, key)]
+    def _entries (self, value, key):
+        """Return (offset, length) for each record offsets would"""
+        key = self._key_name (key)
+        (start, count) = self._tables [key]
+        value = self._selectors [key][1] (value)
+        if value == None:
+            return []
+        h = _key_hash (value)
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _index_entry.unpack_from (
+                self._index, start + mid * _index_entry.size) [0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        l = []
+        while lo < count:
+            (eh, offset, length) = _index_entry.unpack_from (
+                self._index, start + lo * _index_entry.size)
+            if eh != h:
+                break
+            l.append ((offset, length))
+            lo += 1
+        return l
+    def record_at (self, offset, length = None):
+        """Return the LazyMARC at offset, length bytes long (by
+        default, as long as its leader says)"""
+        if length == None:
+            length = _to_int (self._data [offset:offset + 5])
+        return LazyMARC (self._data [offset:offset + length],
+                         strict = self.strict)
+    def lookup (self, value, key = None):
+        """Return a list of the records (as LazyMARC) with value for key
+        (default the first of keys), in file order"""
+        key = self._key_name (key)
+        (select, norm) = self._selectors [key]
+        value = norm (value)
+        if value == None:
+            return []
+        l = []
+        for (offset, length) in sorted (self._entries (value, key)):
+            rec = self.record_at (offset, length)
+            if value in select (rec):
+                l.append (rec)
+        return l
+    def get (self, value, key = None, default = None):
+        """Return the first record with value for key, or default"""
+        l = self.lookup (value, key)
+        if l:
+            return l [0]
+        return default
+    def __getitem__ (self, value):
+        rec = self.get (value)
+        if rec == None:
+            raise KeyError (value)
+        return rec
+    def __contains__ (self, value):
+        return self.get (value) != None
+    def __len__ (self):
+        return self.records
+
+
+from PyZ3950 import zcrosswalk # imports zmarc, so only after MARC
 from PyZ3950 import marc_to_unicode
+from PyZ3950 import marc8
 
 # see http://www.loc.gov/marc/specifications/speccharmarc8.html
 
 import unicodedata
 
+_marc8_control_re = re.compile ('[\x00-\x1f\x7f-\x9f]')
+_printable_ascii_re = re.compile ('[ -~]*\\Z') # str.isascii is 3.7+
+
 class MARC8_to_Unicode:
-    """Converts MARC-8 to Unicode.  Note that currently, unicode strings
-    aren't normalized, and some codecs (e.g. iso8859-1) will fail on
-    such strings.  When I can require python 2.3, this will go away.
+    """Converts MARC-8 to Unicode, normalized to NFC.
 
     Warning: MARC-8 EACC (East Asian characters) makes some
     distinctions which aren't captured in Unicode.  The LC tables give
@@ -1182,10 +2205,14 @@ class MARC8_to_Unicode:
     with LC's private-use Unicode assignments, or of attempts to
     standardize Unicode characters to allow round-trips from EACC,
     or if you need the private-use Unicode character translations,
-    please inform me, asl2@pobox.com."""
+    please inform me, asl2@pobox.com.
 
+    Text between escape sequences is translated a run at a time:
+    printable ASCII in the basic Latin set is returned as is, other
+    single byte sets go through str.translate, and only multibyte
+    (EACC) text is done a character at a time.  NFC normalization is
+    only done if some character could need it."""
 
-    
     basic_latin = 0x42
     ansel = 0x45
     def __init__ (self, G0 = basic_latin, G1 = ansel):
@@ -1194,58 +2221,97 @@ class MARC8_to_Unicode:
 
     def is_multibyte (self, charset):
         return charset == 0x31
-        
+
+    def _translate_single (self, seg, out, pending):
+        """Append the translation of seg (containing no escapes) from
+        single byte sets to out.  pending holds combining marks from
+        earlier, to go after the next base character.  Returns the
+        marks now pending, and whether out needs normalizing."""
+        (table, ascii, invalid, reorder, trailing, nfc) = (
+            marc8.single_byte_tables (self.g0, self.g1, 0))
+        if ascii and not pending and _printable_ascii_re.match (seg):
+            text = seg
+            need = 0
+        else:
+            bad = invalid.search (seg)
+            if bad != None:
+                raise KeyError (ord (bad.group ()))
+            need = nfc != None and nfc.search (seg) != None
+            tail = ''
+            if need and reorder != None:
+                # MARC-8 puts combining marks before the base character,
+                # Unicode after; controls don't separate them
+                if not seg.isprintable ():
+                    seg = _marc8_control_re.sub ('', seg)
+                m = trailing.search (seg)
+                if m != None:
+                    tail = m.group ().translate (table)
+                    seg = seg [:m.start ()]
+                seg = reorder (seg)
+            text = seg.translate (table)
+            if pending and text:
+                text = text [0] + pending + text [1:]
+                pending = ''
+            pending += tail
+        out.append (text)
+        return (pending, need)
+
+    def _translate_multibyte (self, seg, out, pending):
+        """As _translate_single, for a multibyte G0 set"""
+        codeset = marc_to_unicode.codesets [self.g0]
+        for pos in range (0, len (seg), 3):
+            d = (ord (seg[pos]) * 65536 +
+                 ord (seg[pos+1]) * 256 +
+                 ord (seg[pos+2]))
+            if d < 0x20 or (d > 0x80 and d < 0xa0):
+                continue
+            (uni, cflag) = codeset [d]
+            if cflag:
+                pending += chr (uni)
+            else:
+                out.append (chr (uni))
+                if pending:
+                    out.append (pending)
+                    pending = ''
+        return (pending, 1)
+
     def translate (self, s):
-        uni_list = []
-        combinings = []
+        if (_printable_ascii_re.match (s) and
+            not self.is_multibyte (self.g0) and
+            marc8.single_byte_tables (self.g0, self.g1, 0) [1]):
+            return s
+        out = []
+        pending = ''
+        nfc = 0
         pos = 0
         while pos < len (s):
-            if s[pos] == '\x1b':
-                if (s[pos +1] == s[pos+2] and
-                    (s[pos +1] == '$' or s[pos+1] == '(')):
-                    # '$' for multiple bytes/char, '(' for single
-                    # XXX note that ',' is also acceptable for single, and
-                    # '$' for double.
-                    self.g0 = ord (s[pos+3])
-                    # XXX or !E two-char seq for ANSEL?
-                    # XXX or ')', '-', 1-char or '$)', '$-' for G1
-                    pos = pos + 4
-                    continue
-            mb_flag = self.is_multibyte (self.g0)
-                
-            if mb_flag:
-                d = (ord (s[pos]) * 65536 +
-                     ord (s[pos+1]) * 256 +
-                     ord (s[pos+2]))
-                pos += 3
-            else:
-                d = ord (s[pos])
-                pos += 1
-                
-            if (d < 0x20 or
-                (d > 0x80 and d < 0xa0)):
-                uni = chr (d)
-                continue
-            
-            if d > 0x80 and not mb_flag:
-                (uni, cflag) = marc_to_unicode.codesets [self.g1] [d]
-            else:
-                (uni, cflag) = marc_to_unicode.codesets [self.g0] [d]
-                
-            if cflag:
-                combinings.append (chr (uni))
+            esc = s.find ('\x1b', pos)
+            if esc == -1:
+                esc = len (s)
+            if esc > pos:
+                if self.is_multibyte (self.g0):
+                    translate = self._translate_multibyte
+                else:
+                    translate = self._translate_single
+                (pending, need) = translate (s [pos:esc], out, pending)
+                nfc = nfc or need
+            if esc == len (s):
+                break
+            seq = s [esc + 1:esc + 4]
+            if len (seq) == 3 and seq [0] == seq [1] and seq [0] in '$(':
+                # '$' for multiple bytes/char, '(' for single
+                # XXX note that ',' is also acceptable for single, and
+                # '$' for double.
+                self.g0 = ord (seq [2])
+                # XXX or !E two-char seq for ANSEL?
+                # XXX or ')', '-', 1-char or '$)', '$-' for G1
+                pos = esc + 4
             else:
-                uni_list.append (chr (uni))
-                if len (combinings) > 0:
-                    uni_list += combinings
-                    combinings = []
+                pos = esc + 1 # not a designation: a control, so dropped
         # what to do if combining chars left over?
-        uni_str = "".join (uni_list)
-        
-        # unicodedata.normalize not available until Python 2.3        
-        if hasattr (unicodedata, 'normalize'):
+        uni_str = ''.join (out)
+        if nfc:
             uni_str = unicodedata.normalize ('NFC', uni_str)
-            
         return uni_str
 
 def test_convert (s, enc):
@@ -1270,9 +2336,9 @@ if __name__ == '__main__':
     
 
     for f in sys.argv[1:]:
-        marc_file = open(f, 'rb')
-        marc_text = marc_file.read ()
-        while 1:
+        reader = MARCReader (f)
+        for (offset, raw) in reader.iter_raw ():
+            marc_text = raw.decode ('latin-1')
             marc_data1 = MARC(marc_text)
             print(str (marc_data1))
             new = marc_data1.get_MARC ()
@@ -1284,9 +2350,4 @@ if __name__ == '__main__':
                 same = (marc_data1.fields [field] ==
                         marc_data2.fields [field])
                 assert (same)
-            marc_text = marc_text[marc_data1.reclen:]
-            if len (marc_text) == 0:
-                break
-        marc_file.close ()
-
-
+        reader.close ()
@@ -26,6 +26,12 @@ For Record, Render_Record is implemented as Python __str__.  The
 'syntax' member contains the string-format record syntax, and the
 'data' member contains the raw data.
 
+Besides the syntaxes requested from the server, ResultSet can produce
+'MARCXML', 'OAI-MARC', 'MODS' and 'DC' (simple Dublin Core) records
+locally from USMARC ones.  Setting preferredRecordSyntax to one of
+these converts records already retrieved as USMARC rather than sending
+new present requests, and retrieves USMARC for any that aren't.
+
 The following query types are supported:
 - "CCL", ISO 8777, (http://www.indexdata.dk/yaz/doc/tools.tkl#CCL)
 - "S-CCL", the same, but interpreted on the server side
@@ -38,6 +44,9 @@ The following query types are supported:
 
 ScanSet, like ResultSet, has a sequence interface.  The i-th element
 is a dictionary.  See the ScanSet documentation for supported keys.
+To walk a whole index rather than one window of it, use
+Connection.scan_all, or Connection.scan_partitioned to split the work
+across several connections.
 
 Sample usage:
     from PyZ3950 import zoom
@@ -53,7 +62,39 @@ I hope everything else is clear from the docstrings and the abstract
 API: let me know if that's wrong, and I'll try to do better.
 
 For some purposes (I think the only one is writing Z39.50 servers),
-you may want to use the functions in the z3950 module instead.  """
+you may want to use the functions in the z3950 module instead.
+
+Thread safety: a Connection, and the ResultSets and ScanSets it
+returns, may be shared by any number of threads.  Each Connection
+holds a reentrant lock for the duration of every Z39.50 operation
+(and the sequence of bookkeeping around it, e.g. choosing a result set
+name), so requests from different threads are serialized on the
+connection rather than interleaved.  For parallelism, use several
+Connections.  The query parsers are thread-safe too: CCL keeps one
+lexer and parser per thread, and CQL, PQF and C2 build a new
+tokenizer for every query and share no state.  Options (attributes)
+should be set before the Connection is shared.
+
+Result sets: each Connection's ResultSetManager tracks the server-side
+named result sets it has created.  When a ResultSet is garbage
+collected, its name is reused for a later search (which replaces the
+set on the server) and, unless deleteResultSets is false, deleted on
+the server in a batched deleteResultSetRequest sent before the next
+search.  If maxResultSets is set (or learned from a "too many result
+sets" diagnostic), the least recently used sets are evicted to make
+room for new ones; using an evicted ResultSet raises ConnectionError,
+except for records already retrieved.
+
+Profiles: a Connection with a profileStore remembers what it learns
+about a target (limits, quirks, unsupported syntaxes and indexes)
+between sessions, and uses it to pick parameters and skip requests
+bound to fail.  See zprofile.
+
+Harvesting: Connections given the same limiter (see target_limiter)
+adapt how many requests they have in progress at once to how well the
+target copes, backing off when it shows signs of overload.  A MirrorGroup sends
+slow searches to a second replica of a target, and takes the first
+answer.  """
 
     
 
@@ -62,6 +103,19 @@ __version__ = '1.0' # XXX
 
 import getopt
 import sys 
+import threading
+import re
+import array
+import heapq
+import pickle
+import tempfile
+import time
+import weakref
+import collections
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
 
 # TODO:
 # finish lang/charset (requires charset normalization, confer w/ Adam)
@@ -76,6 +130,7 @@ from PyZ3950 import zmarc
 from PyZ3950 import bib1msg
 from PyZ3950 import grs1
 from PyZ3950 import oids
+from PyZ3950 import zprofile
 
 # Azaroth 2003-12-04:
 from PyZ3950 import CQLParser, SRWDiagnostics, pqf
@@ -180,6 +235,356 @@ class _AttrCheck:
         else:
             raise AttributeError (attr, val)
     
+def _canonical (val):
+    """Return a hashable canonical form of val, which may be built of
+    asn1 structures, lists and tuples (e.g. a Query's query member)"""
+    if isinstance (val, asn1.StructBase):
+        items = [(k, _canonical (v)) for (k, v) in list(val.__dict__.items ())
+                 if k[0] != '_']
+        items.sort ()
+        return (val.__class__.__name__, tuple (items))
+    if isinstance (val, (list, tuple)):
+        return tuple ([_canonical (v) for v in val])
+    if isinstance (val, dict):
+        items = [(k, _canonical (v)) for (k, v) in list(val.items ())]
+        items.sort ()
+        return tuple (items)
+    return val
+
+class _Flight:
+    def __init__ (self):
+        self.done = threading.Event ()
+        self.result = None
+        self.exc = None
+
+class SingleFlight:
+    """Coalesce concurrent identical operations: while a call for some
+    key is in progress, other callers asking for the same key wait for
+    it and get its result (or exception) instead of repeating the work.
+    Nothing is remembered once a call completes.
+
+    Each Connection has one (its singleFlight option), used for search
+    and present requests.  Connections to the same target can share one,
+    so that a burst of identical searches across a pool of connections
+    results in a single searchRequest."""
+    def __init__ (self):
+        self._lock = threading.Lock ()
+        self._flights = {}
+    def do (self, key, fn, *args, **kw):
+        self._lock.acquire ()
+        flight = self._flights.get (key)
+        if flight != None:
+            self._lock.release ()
+            flight.done.wait ()
+            if flight.exc != None:
+                raise flight.exc
+            return flight.result
+        flight = _Flight ()
+        self._flights [key] = flight
+        self._lock.release ()
+        try:
+            flight.result = fn (*args, **kw)
+        except BaseException as err:
+            flight.exc = err
+            raise
+        finally:
+            self._lock.acquire ()
+            del self._flights [key]
+            self._lock.release ()
+            flight.done.set ()
+        return flight.result
+
+class ResultSetManager:
+    """Keep track of the live named result sets of one Connection's
+    session, so that server-side sets don't pile up.  ResultSets are
+    held by weak reference: when one is garbage collected, its name
+    becomes free for reuse and is queued for deletion (deletions are
+    batched, and sent by the Connection before its next search).
+    Connection.maxResultSets bounds the number of live sets, least
+    recently used first out."""
+    def __init__ (self):
+        self._lock = threading.Lock ()
+        self._live = collections.OrderedDict () # name -> weakref, LRU first
+        self._free = []
+        self._doomed = []
+        self._collected = collections.deque ()
+        self._ctr = 0
+    def _gone (self, name, ref):
+        # Called by the garbage collector, maybe while this thread
+        # holds self._lock, so just queue the name for _reap.
+        self._collected.append ((name, ref))
+    def _reap (self):
+        while self._collected:
+            (name, ref) = self._collected.popleft ()
+            if self._live.get (name) is ref:
+                del self._live [name]
+                self._free.append (name)
+                self._doomed.append (name)
+    def allocate (self):
+        """Return a name for a new result set, reusing a free one if
+        possible.  Pass it to register or abandon once the search is done."""
+        self._lock.acquire ()
+        try:
+            self._reap ()
+            if self._free:
+                name = self._free.pop ()
+                # searching with it replaces the old set anyway
+                if name in self._doomed:
+                    self._doomed.remove (name)
+                return name
+            self._ctr += 1
+            return "rs%d" % self._ctr
+        finally:
+            self._lock.release ()
+    def abandon (self, name):
+        """Give back a name from allocate which wasn't used after all"""
+        self._lock.acquire ()
+        try:
+            self._free.append (name)
+        finally:
+            self._lock.release ()
+    def register (self, rs):
+        self._lock.acquire ()
+        try:
+            name = rs._resultSetName
+            ref = weakref.ref (rs, lambda ref, name = name:
+                               self._gone (name, ref))
+            self._live [name] = ref
+        finally:
+            self._lock.release ()
+    def touch (self, name):
+        """Mark name as most recently used"""
+        self._lock.acquire ()
+        try:
+            ref = self._live.pop (name, None)
+            if ref != None:
+                self._live [name] = ref
+        finally:
+            self._lock.release ()
+    def release (self, name):
+        """Forget name, which has been deleted on the server"""
+        self._lock.acquire ()
+        try:
+            self._reap ()
+            if self._live.pop (name, None) != None:
+                self._free.append (name)
+        finally:
+            self._lock.release ()
+    def evict (self, keep):
+        """Evict least recently used sets until at most keep are live"""
+        self._lock.acquire ()
+        try:
+            self._reap ()
+            while len (self._live) > max (keep, 0):
+                (name, ref) = self._live.popitem (last = False)
+                rs = ref ()
+                if rs != None:
+                    rs._evicted = 1
+                self._free.append (name)
+                self._doomed.append (name)
+        finally:
+            self._lock.release ()
+    def take_doomed (self):
+        """Return (and forget) the names waiting to be deleted"""
+        self._lock.acquire ()
+        try:
+            self._reap ()
+            doomed = self._doomed
+            self._doomed = []
+            return doomed
+        finally:
+            self._lock.release ()
+    def live_count (self):
+        self._lock.acquire ()
+        try:
+            self._reap ()
+            return len (self._live)
+        finally:
+            self._lock.release ()
+    def reset (self):
+        """Forget everything: the session has been (re)established, so
+        the server has no result sets."""
+        self._lock.acquire ()
+        try:
+            self._collected.clear ()
+            self._live.clear ()
+            self._free = []
+            self._doomed = []
+        finally:
+            self._lock.release ()
+
+_congestion_close_reasons = (2, 4) # systemProblem, resources
+_congestion_conditions = (2, 31, 32, 33, 240, 1018, 1020)
+"""BIB-1 diagnostics meaning the target is short of resources"""
+
+def _is_congestion (err):
+    """Does err (an exception from a request) mean the target is
+    overloaded?  Returns None if it says nothing either way."""
+    if isinstance (err, UnexpectedCloseError):
+        return getattr (err, 'closeReason', None) in _congestion_close_reasons
+    if isinstance (err, ConnectionError): # refused, reset, timed out
+        return 1
+    if isinstance (err, Bib1Err):
+        return err.condition in _congestion_conditions
+    return None
+
+class AIMDLimiter:
+    """Adaptive limit on the requests in progress at once against one
+    target (and on the rate they're started), for harvesting with many
+    sessions.  The limit grows additively (by 'increase' per limit's
+    worth of healthy requests, so by about 'increase' per round trip)
+    and is cut multiplicatively (times 'decrease') when a request
+    fails with a sign of overload: a connection failure or timeout
+    (see the Connection's timeout option), a close with reason
+    resources or systemProblem, or a resource-control diagnostic.  A
+    request is also counted as a sign of overload if it takes more than
+    latencyFactor times the lowest smoothed latency seen for its kind
+    of request.  Once the limit is at 'minimum', further overload
+    spaces out request starts instead (doubling the interval, up to
+    maxInterval, then shrinking it by intervalStep per healthy
+    request).  As in TCP, only one cut is made per round of requests:
+    failures of requests started before the last cut are counted but
+    don't cut again.
+
+    Requests by a thread already holding a slot (e.g. the connect
+    done by a search) don't need another."""
+    def __init__ (self, initial = 2, minimum = 1, maximum = 32,
+                  increase = 1.0, decrease = 0.5, latencyFactor = 4.0,
+                  maxInterval = 30.0, intervalStep = 0.1):
+        self.limit = float (initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latencyFactor = latencyFactor
+        self.maxInterval = maxInterval
+        self.intervalStep = intervalStep
+        self.interval = 0.0
+        self.requests = 0
+        self.congestions = 0
+        self.failures = 0
+        self._inflight = 0
+        self._epoch = 0
+        self._nextStart = 0.0
+        self._latency = {} # kind -> smoothed latency
+        self._baseline = {} # kind -> lowest smoothed latency
+        self._cond = threading.Condition ()
+        self._local = threading.local ()
+    def inflight (self):
+        self._cond.acquire ()
+        try:
+            return self._inflight
+        finally:
+            self._cond.release ()
+    def stats (self):
+        """Return a consistent snapshot of the limiter's state, a dict
+        with keys limit, inflight, interval, requests, congestions and
+        failures"""
+        self._cond.acquire ()
+        try:
+            return {'limit' : self.limit, 'inflight' : self._inflight,
+                    'interval' : self.interval, 'requests' : self.requests,
+                    'congestions' : self.congestions,
+                    'failures' : self.failures}
+        finally:
+            self._cond.release ()
+    def _acquire (self):
+        self._cond.acquire ()
+        try:
+            while 1:
+                now = time.time ()
+                if (self._inflight < max (int (self.limit), self.minimum)
+                    and now >= self._nextStart):
+                    break
+                if now < self._nextStart:
+                    self._cond.wait (self._nextStart - now)
+                else:
+                    self._cond.wait ()
+            self._inflight += 1
+            self._nextStart = now + self.interval
+            return (now, self._epoch)
+        finally:
+            self._cond.release ()
+    def _release (self, kind, token, congested):
+        (start, epoch) = token
+        latency = time.time () - start
+        self._cond.acquire ()
+        try:
+            self._inflight -= 1
+            self.requests += 1
+            if congested == None:
+                self.failures += 1
+            elif not congested:
+                smoothed = self._latency.get (kind)
+                if smoothed == None:
+                    smoothed = latency
+                else:
+                    smoothed = 0.8 * smoothed + 0.2 * latency
+                self._latency [kind] = smoothed
+                baseline = self._baseline.get (kind, smoothed)
+                self._baseline [kind] = min (baseline, smoothed)
+                # a single slow request shouldn't count against the target
+                congested = (latency > self.latencyFactor * baseline and
+                             smoothed > self.latencyFactor * baseline)
+            if congested:
+                self.congestions += 1
+                if epoch == self._epoch: # once per round
+                    self._epoch += 1
+                    if self.limit > self.minimum:
+                        self.limit = max (self.minimum,
+                                          self.limit * self.decrease)
+                    else:
+                        self.interval = min (self.maxInterval,
+                                             max (self.interval * 2,
+                                                  self.intervalStep))
+            elif congested != None:
+                if self.interval > 0:
+                    self.interval = max (0.0,
+                                         self.interval - self.intervalStep)
+                elif self._inflight + 1 >= int (self.limit):
+                    # only grow a limit we're actually using
+                    self.limit = min (self.maximum,
+                                      self.limit + self.increase / self.limit)
+            self._cond.notify_all ()
+        finally:
+            self._cond.release ()
+    def call (self, kind, fn, *args, **kw):
+        """Call fn (a request of the given kind, e.g. 'search') when a
+        slot is free, and adjust the limit according to how it went"""
+        if getattr (self._local, 'held', 0):
+            return fn (*args, **kw)
+        token = self._acquire ()
+        self._local.held = 1
+        try:
+            try:
+                ret = fn (*args, **kw)
+            except Exception as err:
+                self._release (kind, token, _is_congestion (err))
+                raise
+            self._release (kind, token, 0)
+            return ret
+        finally:
+            self._local.held = 0
+    def __str__ (self):
+        return ("limit %(limit).1f, %(inflight)d in flight, interval "
+                "%(interval).1fs, %(requests)d requests, %(congestions)d "
+                "congested, %(failures)d failed" % self.stats ())
+
+_target_limiters = {}
+_target_limiters_lock = threading.Lock ()
+
+def target_limiter (host, port, **kw):
+    """Return the AIMDLimiter shared by everything talking to host:port
+    (made with kw as constructor arguments the first time)"""
+    _target_limiters_lock.acquire ()
+    try:
+        key = (host, port)
+        if key not in _target_limiters:
+            _target_limiters [key] = AIMDLimiter (**kw)
+        return _target_limiters [key]
+    finally:
+        _target_limiters_lock.release ()
+
 class Connection(_AttrCheck, _ErrHdlr):
     """Connection object"""
 
@@ -201,7 +606,8 @@ class Connection(_AttrCheck, _ErrHdlr):
                   'charset',
                   'implementationId',
                   'implementationName',
-                  'implementationVersion'
+                  'implementationVersion',
+                  'timeout'
                   ]
     scan_zoom_to_z3950 = {
         # translate names from ZOOM spec to Z39.50 spec names
@@ -213,14 +619,20 @@ class Connection(_AttrCheck, _ErrHdlr):
     attrlist = search_attrs + init_attrs + list(scan_zoom_to_z3950.keys ()) + [
         'databaseName',
         'namedResultSets',
+        'maxResultSets',
+        'deleteResultSets',
         'preferredRecordSyntax', # these three inheritable by RecordSet
         'elementSetName',
         'presentChunk',
+        'maxQueryTerms',
         'targetImplementationId',
         'targetImplementationName',
         'targetImplementationVersion',
         'host',
         'port',
+        'singleFlight',
+        'profileStore',
+        'limiter',
 
         ] + _ErrHdlr.err_attrslist
 
@@ -231,6 +643,13 @@ class Connection(_AttrCheck, _ErrHdlr):
 
     # and now, some defaults
     namedResultSets = 1
+    maxResultSets = 0 # no limit, unless the target tells us otherwise
+    deleteResultSets = 1 # 0 for targets which close on delete (Oxford)
+    profileStore = None
+    limiter = None
+    _profile = None
+    _profiled_attrs = ['presentChunk', 'maxQueryTerms', 'maxResultSets',
+                       'deleteResultSets']
     elementSetName = 'F' 
     preferredRecordSyntax = 'USMARC'
     preferredMessageSize = 0x100000
@@ -247,7 +666,9 @@ class Connection(_AttrCheck, _ErrHdlr):
     user = None
     password = None
     group = None
+    timeout = None # seconds per socket operation; None waits forever
     presentChunk = 20 # for result sets
+    maxQueryTerms = 50 # for lookup_many, lowered if the target complains
 
     def __init__(self, host, port, connect=True, **kw):
         """Establish connection to hostname:port.  kw contains initial
@@ -264,18 +685,45 @@ class Connection(_AttrCheck, _ErrHdlr):
         implementationId       Id for client implementation
         implementationName     Name for client implementation
         implementationVersion  Version of client implementation
+        timeout                Seconds to wait for the target to accept
+                               the connection or answer a request
+                               before raising ConnectionError (None,
+                               the default, to wait forever)
+        singleFlight           SingleFlight to coalesce identical
+                               concurrent searches and presents (by
+                               default, one per Connection; None
+                               turns coalescing off)
+        maxResultSets          Most named result sets to keep open on
+                               the server (0, the default, for no limit)
+        deleteResultSets       Whether to delete result sets on the
+                               server when they're no longer used
+        profileStore           zprofile store to keep what we learn
+                               about the target in (see zprofile)
+        limiter                AIMDLimiter to run requests through,
+                               usually shared by all Connections to
+                               the target (see target_limiter)
         
         """
 
         self.host = host
         self.port = port
         self._resultSetCtr = 0
+        self._lock = threading.RLock ()
+        self.singleFlight = SingleFlight ()
+        self._resultSets = ResultSetManager ()
+        self._explicit = list(kw.keys ())
         for (k,v) in list(kw.items ()):
             setattr (self, k, v)
         if (connect):
             self.connect()
 
     def connect(self):
+        self._lock.acquire ()
+        try:
+            self._limited ('connect', self._connect)
+        finally:
+            self._lock.release ()
+    def _connect(self):
         self._resultSetCtr += 1
         self._lastConnectCtr = self._resultSetCtr
         
@@ -300,10 +748,15 @@ class Connection(_AttrCheck, _ErrHdlr):
         initkw ['UnexpectedCloseError'] = UnexpectedCloseError
         self._cli = z3950.Client (self.host, self.port,
                                   optionslist = options, **initkw)
+        self._resultSets.reset ()
         self.namedResultSets = self._cli.get_option ('namedResultSets')
         self.targetImplementationId = getattr (self._cli.initresp, 'implementationId', None)
         self.targetImplementationName = getattr (self._cli.initresp, 'implementationName', None)
         self.targetImplementationVersion  = getattr (self._cli.initresp, 'implementationVersion', None)
+        if self.profileStore != None:
+            self._profile = self.profileStore.lookup (self.host, self.port,
+                                                      self._cli.initresp)
+            self._apply_profile ()
         if (hasattr (self._cli.initresp, 'userInformationField')):
             # weird.  U of Chicago returns an EXTERNAL with nothing
             # but 'encoding', ('octet-aligned', '2545') filled in.
@@ -325,54 +778,392 @@ class Connection(_AttrCheck, _ErrHdlr):
         
 
     def search (self, query):
-        """Search, taking Query object, returning ResultSet"""
+        """Search, taking Query object, returning ResultSet.  If an
+        identical search is already in progress (see SingleFlight),
+        wait for it and return its ResultSet instead."""
+        if self.singleFlight == None:
+            return self._search (query)
+        key = ('search', self.host, self.port, self.databaseName,
+               query.typ, _canonical (query.query),
+               _canonical (_extract_attrs (self, self.search_attrs)))
+        return self.singleFlight.do (key, self._search, query)
+    def _search (self, query):
+        self._lock.acquire ()
+        try:
+            return self._limited ('search', self._search_1, query)
+        finally:
+            self._lock.release ()
+    def _search_1 (self, query):
         if (not self._cli):
             self.connect()
         assert (query.typ in self._queryTypes)
         dbnames = self.databaseName.split ('+')
-        self._cli.set_dbnames (dbnames)
-        cur_rsn = self._make_rsn ()
-        recv = self._cli.search_2 (query.query,
-                                   rsn = cur_rsn,
-                                   **_extract_attrs (self, self.search_attrs))
-        self._resultSetCtr += 1
-        rs = ResultSet (self, recv, cur_rsn, self._resultSetCtr)
-        return rs        
+        self._check_use_attrs (query, dbnames)
+        retried = 0
+        while 1:
+            cur_rsn = self._make_rsn ()
+            self._cli.set_dbnames (dbnames)
+            try:
+                recv = self._cli.search_2 (query.query,
+                                           rsn = cur_rsn,
+                                           **_extract_attrs (self, self.search_attrs))
+                self._resultSetCtr += 1
+                rs = ResultSet (self, recv, cur_rsn, self._resultSetCtr)
+            except Bib1Err as err:
+                self._result_set_failed (cur_rsn)
+                if err.condition == 114: # Unsupported Use attribute
+                    self._learn_bad_use (err, dbnames)
+                live = self._resultSets.live_count ()
+                # 112 is "Too many result sets created"
+                if (err.condition != 112 or retried or live == 0 or
+                    not self.namedResultSets):
+                    raise
+                self._learn ('maxResultSets', live)
+                retried = 1
+                continue
+            except:
+                self._result_set_failed (cur_rsn)
+                raise
+            self._result_set_made (rs)
+            return rs
     # and 'Error Code', 'Error Message', and 'Addt'l Info' methods still
     # eeded
     def scan (self, query):
+        return self._scan (query.query)
+    def _scan (self, q, **overrides):
+        """Scan from q, a query tuple; overrides are ZOOM scan option
+        names and values to use instead of our own."""
+        self._lock.acquire ()
+        try:
+            return self._limited ('scan', self._scan_1, q, **overrides)
+        finally:
+            self._lock.release ()
+    def _scan_1 (self, q, **overrides):
         if (not self._cli):
             self.connect()
         self._cli.set_dbnames ([self.databaseName])
         kw = {}
         for k, xl in list(self.scan_zoom_to_z3950.items ()):
-            if hasattr (self, k):
+            if k in overrides:
+                kw [xl] = overrides [k]
+            elif hasattr (self, k):
                 kw [xl] = getattr (self, k)
-        return ScanSet (self._cli.scan (query.query, **kw))
+        return ScanSet (self._cli.scan (q, **kw))
+    def scan_all (self, query, numberOfEntries = 200, stop = None):
+        """Walk the index forward from query's term to the end (or until
+        the callable stop returns true for a term), re-issuing scans of
+        numberOfEntries terms each from the last term seen.  Yields the
+        same dictionaries as ScanSet[i]."""
+        q = query.query
+        last = None
+        while 1:
+            ss = self._scan (q, numberOfEntries = numberOfEntries,
+                             responsePosition = 1, stepSize = 0)
+            new = 0
+            for i in range (len (ss)):
+                d = ss [i]
+                if last != None and d['term'] == last:
+                    continue # window starts with the term we stopped at
+                if stop != None and stop (d['term']):
+                    return
+                new += 1
+                yield d
+            if len (ss) < numberOfEntries or new == 0:
+                return
+            last = d['term']
+            q = _scan_query_from_term (q, last)
+    def _clone (self):
+        """Return a new Connection to the same target with our options"""
+        kw = {}
+        for attr in self.init_attrs + self.search_attrs + [
+            'databaseName', 'preferredRecordSyntax', 'elementSetName',
+            'presentChunk'] + list(self.scan_zoom_to_z3950.keys ()):
+            if hasattr (self, attr):
+                kw [attr] = getattr (self, attr)
+        return Connection (self.host, self.port, **kw)
+    def scan_partitioned (self, query, boundaries =
+                          '0123456789abcdefghijklmnopqrstuvwxyz',
+                          connections = 4, numberOfEntries = 200):
+        """Dump the whole index from query's term onwards, splitting it
+        at boundaries (a sequence of start terms, in index order) and
+        scanning the partitions concurrently over up to connections
+        extra connections to the same target.  Yields the same
+        dictionaries as scan_all, in index order.
+
+        A partition ends at the first term which compares >= the next
+        boundary (ignoring case), so this assumes the target collates
+        the index in roughly that order, as most do.  If the generator
+        is abandoned (or fails), the connections are closed once their
+        current scan returns."""
+        start = _scan_start_term (query.query)
+        starts = [start] + [('general', b) for b in boundaries
+                            if b.lower () > start[1].lower ()]
+        results = {}
+        todo = queue.Queue ()
+        for i in range (len (starts)):
+            todo.put (i)
+        cond = threading.Condition ()
+        halted = []
+
+        def walk_partition (conn, i):
+            if i + 1 < len (starts):
+                limit = starts [i + 1][1].lower ()
+                stop = lambda term: halted or term[1].lower () >= limit
+            else:
+                stop = lambda term: halted
+            q = _scan_query_from_term (query.query, starts [i])
+            return list (conn.scan_all (_QueryFromTuple (q),
+                                        numberOfEntries, stop))
+
+        def worker ():
+            conn = None
+            try:
+                while not halted:
+                    try:
+                        i = todo.get_nowait ()
+                    except queue.Empty:
+                        return
+                    try:
+                        if conn == None:
+                            conn = self._clone ()
+                        rv = walk_partition (conn, i)
+                    except Exception as err:
+                        rv = err
+                    cond.acquire ()
+                    results [i] = rv
+                    cond.notify ()
+                    cond.release ()
+            finally:
+                if conn != None:
+                    conn.close ()
+
+        threads = []
+        for t in range (min (connections, len (starts))):
+            th = threading.Thread (target = worker)
+            th.daemon = True
+            th.start ()
+            threads.append (th)
+        try:
+            for i in range (len (starts)):
+                cond.acquire ()
+                while i not in results:
+                    cond.wait ()
+                rv = results.pop (i)
+                cond.release ()
+                if isinstance (rv, Exception):
+                    raise rv
+                for d in rv:
+                    yield d
+        finally:
+            # also on GeneratorExit: stop the workers, which close their
+            # connections as they return
+            halted.append (1)
+            while not todo.empty ():
+                try:
+                    todo.get_nowait ()
+                except queue.Empty:
+                    break
+    def lookup_many (self, ids, attr = (1,7)):
+        """Look up many identifiers (by default ISBNs; attr is the BIB-1
+        (type, value) use attribute to search, e.g. (1,9) for LCCN or
+        (1,1211) for OCLC number) with as few round trips as possible.
+        Identifiers are ORed together, maxQueryTerms per search; if
+        the target returns a diagnostic saying the query was too big,
+        maxQueryTerms is lowered (to the limit given in the
+        diagnostic, if any, else halved) and the chunk retried.
+
+        Returns a dictionary mapping each identifier to the list of
+        Records which matched it.  Records must be MARC: matches are
+        worked out by normalizing the identifiers in the 020, 022, 010
+        or 035/001 fields and comparing them with the normalized inputs."""
+        (attrType, attrVal) = attr
+        norm = _id_normalizers.get (attrVal, _norm_plain)
+        results = {}
+        for i in ids:
+            results [i] = []
+        ids = list(results.keys ())
+        pos = 0
+        while pos < len (ids):
+            chunk = ids [pos:pos + max (1, self.maxQueryTerms)]
+            try:
+                rs = self.search (_QueryFromTuple (
+                    _mk_or_query (chunk, attrType, attrVal)))
+            except Bib1Err as err:
+                if (err.condition not in _too_big_conditions or
+                    len (chunk) == 1):
+                    raise
+                self._learn ('maxQueryTerms',
+                             _learn_max_terms (err, len (chunk)))
+                continue
+            wanted = {}
+            for i in chunk:
+                key = norm (i)
+                if key != None: # not a valid identifier: matches nothing
+                    wanted.setdefault (key, []).append (i)
+            for j in range (len (rs)):
+                try:
+                    rec = rs [j]
+                except Bib1Err:
+                    continue
+                marc = rec._get_parsed ()
+                if not isinstance (marc, zmarc.MARC):
+                    raise ClientNotImplError ('lookup_many of %s records' %
+                                              rec.syntax)
+                for key in _marc_ids (marc, attrVal):
+                    for i in wanted.get (key, ()):
+                        if rec not in results [i]:
+                            results [i].append (rec)
+            pos += len (chunk)
+        return results
     def _make_rsn (self):
-        """Return result set name"""
-        if self.namedResultSets:
-            return "rs%d" % self._resultSetCtr
-        else:
+        """Return result set name, first making room for another
+        result set on the server if need be.  Must be followed by
+        _result_set_made or _result_set_failed."""
+        if not self.namedResultSets:
             return z3950.default_resultSetName
+        if self.maxResultSets > 0:
+            self._resultSets.evict (self.maxResultSets - 1)
+        rsn = self._resultSets.allocate ()
+        self._delete_doomed ()
+        return rsn
+    def _result_set_made (self, rs):
+        if self.namedResultSets:
+            self._resultSets.register (rs)
+    def _result_set_failed (self, rsn):
+        if self.namedResultSets:
+            self._resultSets.abandon (rsn)
+    def _delete_doomed (self):
+        """Delete the result sets which have been garbage collected or
+        evicted, in one request"""
+        names = self._resultSets.take_doomed ()
+        if names == [] or self._cli == None or self._cli.sock == None:
+            return
+        for name in names:
+            self._cli.search_results.pop (name, None)
+        if self.deleteResultSets:
+            try:
+                self._cli.delete_many (names)
+            except (ConnectionError, UnexpectedCloseError):
+                # it claimed delSet, but closed on us (Oxford does this)
+                self._learn ('deleteResultSets', 0)
+                try:
+                    self._cli.close () # at least free the socket
+                except (ConnectionError, UnexpectedCloseError):
+                    pass
+                self._cli = None
+                self._connect ()
+    def _limited (self, kind, fn, *args, **kw):
+        """Call fn, through our limiter if we have one"""
+        if self.limiter == None:
+            return fn (*args, **kw)
+        return self.limiter.call (kind, fn, *args, **kw)
+    def _apply_profile (self):
+        """Use the values in our profile for options not passed to
+        the constructor"""
+        for attr in self._profiled_attrs:
+            val = self._profile.get (attr)
+            if val != None and attr not in self._explicit:
+                setattr (self, attr, val)
+    def _remember (self, meth, *args):
+        """Call meth of our profile with args, and save it"""
+        if self._profile != None:
+            getattr (self._profile, meth) (*args)
+            self.profileStore.save (self._profile)
+    def _learn (self, attr, val):
+        """Set option attr to val, which we've learned is what works
+        with this target, and remember it in our profile"""
+        setattr (self, attr, val)
+        self._remember ('learn', attr, val)
+    def _check_use_attrs (self, query, dbnames):
+        """Raise the diagnostic the target would, without asking it, if
+        our profile says query uses a use attribute it doesn't support"""
+        if self._profile == None:
+            return
+        for val in _use_attrs (query.query):
+            for db in dbnames:
+                if self._profile.supports_use (db, val) == 0:
+                    self.err (114, str (val), z3950.Z3950_DIAG_BIB1_ov)
+    def _learn_bad_use (self, err, dbnames):
+        try:
+            val = int (str (err.addtlInfo).strip ())
+        except ValueError:
+            return
+        for db in dbnames:
+            self._remember ('reject_use', db, val)
+    def explain_indexes (self, dbname = None):
+        """Return a list of the use attributes database dbname (by
+        default, databaseName) supports, according to the target's
+        Explain database.  The answer is kept in our profile, if we
+        have one, and subsequent calls don't ask the target again."""
+        if dbname == None:
+            dbname = self.databaseName
+        self._lock.acquire ()
+        try:
+            if not self._cli:
+                self.connect ()
+            prof = self._profile
+            if prof == None:
+                prof = zprofile.Profile (None)
+            if dbname not in prof.indexesExplained:
+                saved = self.databaseName
+                self.databaseName = 'IR-Explain-1'
+                try:
+                    rs = self._search (Query ('PQF',
+                        '@attrset exp1 @and @attr 1=1 AttributeDetails '
+                        '@attr 1=3 "%s"' % dbname))
+                finally:
+                    self.databaseName = saved
+                rs.preferredRecordSyntax = 'EXPLAIN'
+                for i in range (len (rs)):
+                    prof.learn_explain (dbname, rs [i].data)
+                if prof is self._profile:
+                    self.profileStore.save (prof)
+        finally:
+            self._lock.release ()
+        uses = prof.indexes.get (dbname, {})
+        l = [u for (u, ok) in list (uses.items ()) if ok]
+        l.sort ()
+        return l
     def close (self):
         """Close connection"""
-        self._cli.close ()
+        self._lock.acquire ()
+        try:
+            self._cli.close ()
+        finally:
+            self._lock.release ()
         
     def sort (self, sets, keys):
         """ Sort sets by keys, return resultset interface """
+        self._lock.acquire ()
+        try:
+            return self._limited ('sort', self._sort, sets, keys)
+        finally:
+            self._lock.release ()
+    def _sort (self, sets, keys):
         if (not self._cli):
             self.connect()
 
-        # XXX This should probably be shuffled down into z3950.py
-        sortrelations = ['ascending', 'descending', 'ascendingByFrequency', 'descendingByFrequency']
-
         req = z3950.SortRequest()
         req.inputResultSetNames = []
         for s in sets:
             s._check_stale ()
+            if self.namedResultSets: # so _make_rsn won't evict it
+                self._resultSets.touch (s._resultSetName)
             req.inputResultSetNames.append(s._resultSetName)
         cur_rsn = self._make_rsn()
+        try:
+            for s in sets: # _make_rsn may have had to reconnect
+                s._check_stale ()
+            rs = self._sort_to (sets, keys, req, cur_rsn)
+        except:
+            self._result_set_failed (cur_rsn)
+            raise
+        self._result_set_made (rs)
+        return rs
+    def _sort_to (self, sets, keys, req, cur_rsn):
+        # XXX This should probably be shuffled down into z3950.py
+        sortrelations = ['ascending', 'descending', 'ascendingByFrequency', 'descendingByFrequency']
+
         req.sortedResultSetName = cur_rsn
 
         zkeys = []
@@ -428,7 +1219,295 @@ class Connection(_AttrCheck, _ErrHdlr):
         return rs
 
 
+class MirrorGroup:
+    """Hedged requests over replicas of one target.  targets is a
+    list of (host, port); other keyword arguments are options for the
+    Connections (one per replica, made as needed).
+
+    An operation goes to the first replica.  If it hasn't answered
+    after the hedge delay (the percentile'th percentile of recent
+    latencies, at least minDelay, or initialDelay until there are ten
+    to go on), it's also sent to the next replica, up to 'hedges'
+    extra replicas; the first answer wins and the others are
+    abandoned (their Connections finish the request in the
+    background, and stay usable).  A replica which fails with a
+    connection or protocol error, or a resource diagnostic, is failed
+    over to at once.  Other diagnostics are raised, since every replica
+    would give the same one.
+
+    Since a result set only exists on the replica which made it,
+    search returns a ResultSet tied to the winner, whose presents are
+    not hedged.  fetch hedges the search and present together,
+    replaying the search on each replica, so it's the one to use
+    when only the records are needed."""
+    def __init__ (self, targets, hedges = 1, percentile = 95,
+                  minDelay = 0.05, initialDelay = 1.0, history = 200, **kw):
+        self.targets = list (targets)
+        self.hedges = hedges
+        self.percentile = percentile
+        self.minDelay = minDelay
+        self.initialDelay = initialDelay
+        self.hedged = 0
+        self.hedgeWins = 0
+        self._kw = kw
+        self._conns = {}
+        self._lock = threading.Lock ()
+        self._latencies = collections.deque (maxlen = history)
+    def _conn (self, i):
+        self._lock.acquire ()
+        try:
+            if i not in self._conns:
+                (host, port) = self.targets [i]
+                self._conns [i] = Connection (host, port, connect = False,
+                                              **self._kw)
+            return self._conns [i]
+        finally:
+            self._lock.release ()
+    def hedge_delay (self):
+        """Seconds to wait for a replica before trying another"""
+        self._lock.acquire ()
+        try:
+            l = list (self._latencies)
+        finally:
+            self._lock.release ()
+        if len (l) < 10:
+            return self.initialDelay
+        l.sort ()
+        ind = min (len (l) - 1, int (len (l) * self.percentile / 100.0))
+        return max (self.minDelay, l [ind])
+    def _run (self, fn):
+        """Return fn (conn) for the Connection to whichever replica
+        answers first"""
+        results = queue.Queue ()
+        def attempt (i):
+            start = time.time ()
+            try:
+                results.put ((i, 1, fn (self._conn (i)), time.time () - start))
+            except Exception as err:
+                results.put ((i, 0, err, None))
+        def launch (i):
+            th = threading.Thread (target = attempt, args = (i,))
+            th.daemon = True
+            th.start ()
+        launch (0)
+        started = 1
+        outstanding = 1
+        failed = 0
+        err = None
+        deadline = time.time () + self.hedge_delay ()
+        while outstanding:
+            try:
+                if started < min (len (self.targets),
+                                  self.hedges + failed + 1):
+                    (i, ok, val, latency) = results.get (
+                        True, max (0, deadline - time.time ()))
+                else:
+                    (i, ok, val, latency) = results.get ()
+            except queue.Empty:
+                launch (started)
+                started += 1
+                outstanding += 1
+                self.hedged += 1
+                deadline = time.time () + self.hedge_delay ()
+                continue
+            outstanding -= 1
+            if ok:
+                self._lock.acquire ()
+                try:
+                    self._latencies.append (latency)
+                finally:
+                    self._lock.release ()
+                if i != 0:
+                    self.hedgeWins += 1
+                return val
+            err = val
+            if (isinstance (err, Bib1Err) and not _is_congestion (err) or
+                isinstance (err, QuerySyntaxError)):
+                raise err
+            failed += 1
+            if started < len (self.targets): # fail over
+                launch (started)
+                started += 1
+                outstanding += 1
+        raise err
+    def search (self, query):
+        """Hedged search, returning a ResultSet on the winning replica"""
+        return self._run (lambda conn: conn.search (query))
+    def fetch (self, query, start = 0, count = None):
+        """Hedged search and present, returning a list of count
+        Records (or all of them, if count is None) starting at start"""
+        def search_and_present (conn):
+            rs = conn.search (query)
+            if count == None:
+                end = len (rs)
+            else:
+                end = min (len (rs), start + count)
+            return rs [start:end]
+        return self._run (search_and_present)
+    def close (self):
+        self._lock.acquire ()
+        try:
+            conns = list (self._conns.values ())
+            self._conns = {}
+        finally:
+            self._lock.release ()
+        for conn in conns:
+            if conn._cli != None:
+                conn.close ()
+
+
+def _scan_start_term (q):
+    """Return the term of q, a query tuple for scan, e.g. ('general',
+    'foo'); only a single attributes-plus-term with a general term will
+    do"""
+    try:
+        (typ, rpnq) = q
+        ok = (typ == 'type_1' and rpnq.rpn[0] == 'op' and
+              rpnq.rpn[1][0] == 'attrTerm')
+        if ok:
+            term = rpnq.rpn[1][1].term
+            ok = (term[0] == 'general' and isinstance (term[1], str))
+    except (AttributeError, TypeError, ValueError, IndexError):
+        ok = 0
+    if not ok:
+        raise ClientNotImplError (
+            'Partitioned scan needs a single-term RPN query')
+    return term
+
+def _scan_query_from_term (q, term):
+    """Return copy of query tuple q (as used for scan) with its term
+    replaced by term, e.g. ('general', 'foo')"""
+    (typ, rpnq) = q
+    old_apt = rpnq.rpn[1][1]
+    apt = z3950.AttributesPlusTerm ()
+    apt.attributes = old_apt.attributes
+    apt.term = term
+    new_rpnq = z3950.RPNQuery (attributeSet = rpnq.attributeSet)
+    new_rpnq.rpn = ('op', ('attrTerm', apt))
+    return (typ, new_rpnq)
+
+_too_big_conditions = (5, 6, 11, 234)
+"""BIB-1 diagnostics meaning a query had too many terms/operators/chars"""
+
+def _learn_max_terms (err, tried):
+    """Work out a smaller maxQueryTerms after err, a Bib1Err for a
+    query of tried ORed terms"""
+    try:
+        limit = int (str (err.addtlInfo).strip ())
+    except ValueError:
+        limit = 0
+    if err.condition == 6: # limit is on operators, not terms
+        limit += 1
+    if 0 < limit < tried:
+        return limit
+    return max (1, tried // 2)
+
+def _mk_or_query (terms, attrType, attrVal):
+    """Return RPN query tuple ORing terms searched with the given use
+    attribute.  The tree is balanced, to keep its depth down."""
+    def mk_tree (terms):
+        if len (terms) == 1:
+            apt = z3950.AttributesPlusTerm ()
+            apt.attributes = [z3950.AttributeElement (
+                attributeType = attrType,
+                attributeValue = ('numeric', attrVal))]
+            apt.term = ('general', terms [0])
+            return ('op', ('attrTerm', apt))
+        mid = len (terms) // 2
+        op = z3950.RpnRpnOp ()
+        op.rpn1 = mk_tree (terms [:mid])
+        op.rpn2 = mk_tree (terms [mid:])
+        op.op = ('or', None)
+        return ('rpnRpnOp', op)
+    rpnq = z3950.RPNQuery (attributeSet = oids.Z3950_ATTRS_BIB1_ov)
+    rpnq.rpn = mk_tree (terms)
+    return ('type_1', rpnq)
+
+_norm_plain = zmarc.normalize_plain
+_norm_isbn = zmarc.normalize_isbn
+_norm_lccn = zmarc.normalize_lccn
+_norm_oclc = zmarc.normalize_oclc
+
+_id_normalizers = {7 : _norm_isbn, 8 : _norm_plain, 9 : _norm_lccn,
+                   1211 : _norm_oclc}
+
+def _marc_ids (marc, attrVal):
+    """Return normalized identifiers of the kind searched by BIB-1 use
+    attribute attrVal found in zmarc.MARC marc"""
+    l = []
+    if attrVal == 1211:
+        return zmarc.oclc_numbers (marc)
+    tag = {7 : 20, 8 : 22, 9 : 10}.get (attrVal)
+    if tag == None:
+        return l
+    norm = _id_normalizers [attrVal]
+    for (ind1, ind2, subfields) in marc.fields.get (tag, []):
+        for (code, val) in subfields:
+            if code in 'az': # z is cancelled/invalid, still worth matching
+                val = norm (val)
+                if val != None:
+                    l.append (val)
+    return l
+
+def _use_attrs (q):
+    """Return the numeric BIB-1 use attributes in query tuple q"""
+    if (not isinstance (q, tuple) or q [0] != 'type_1' or
+        q [1].attributeSet != oids.Z3950_ATTRS_BIB1_ov):
+        return []
+    l = []
+    def walk (rpn):
+        (typ, val) = rpn
+        if typ == 'rpnRpnOp':
+            walk (val.rpn1)
+            walk (val.rpn2)
+        elif val [0] == 'attrTerm':
+            for attr in val [1].attributes:
+                if (attr.attributeType == 1 and
+                    getattr (attr, 'attributeSet', oids.Z3950_ATTRS_BIB1_ov)
+                    == oids.Z3950_ATTRS_BIB1_ov and
+                    attr.attributeValue [0] == 'numeric'):
+                    l.append (attr.attributeValue [1])
+    walk (q [1].rpn)
+    return l
+
+class _QueryFromTuple:
+    """Wrap an already-built query tuple so it can be used like Query"""
+    def __init__ (self, q, typ = 'RPN'):
+        self.typ = typ
+        self.query = q
+
+def date_restricted (query, since, use = 1012):
+    """Return a query for the records matching query (a Query which
+    is, or compiles to, BIB-1 RPN) whose date (by default BIB-1 1012,
+    date/time last modified) is on or after since, a 'YYYYMMDD' string.
+    Raises ClientNotImplError for other kinds of query."""
+    q = query.query
+    if (not isinstance (q, tuple) or q [0] != 'type_1' or
+        q [1].attributeSet != oids.Z3950_ATTRS_BIB1_ov):
+        raise ClientNotImplError ('Date restriction of %s query' % query.typ)
+    apt = z3950.AttributesPlusTerm ()
+    apt.attributes = [
+        z3950.AttributeElement (attributeType = 1,
+                                attributeValue = ('numeric', use)),
+        z3950.AttributeElement (attributeType = 2, # >=
+                                attributeValue = ('numeric', 4)),
+        z3950.AttributeElement (attributeType = 4, # date
+                                attributeValue = ('numeric', 5))]
+    apt.term = ('general', since)
+    op = z3950.RpnRpnOp ()
+    op.rpn1 = q [1].rpn
+    op.rpn2 = ('op', ('attrTerm', apt))
+    op.op = ('and', None)
+    rpnq = z3950.RPNQuery (attributeSet = oids.Z3950_ATTRS_BIB1_ov)
+    rpnq.rpn = ('rpnRpnOp', op)
+    return _QueryFromTuple (('type_1', rpnq))
+
 class SortKey(_AttrCheck):
+    """Sort key for Connection.sort and ResultSet.sort.  type is one of
+    'accessPoint' (sequence is an RPN Query), 'private', 'elementSetName'
+    (sent to the server), or 'marc', for which sequence is a MARC field
+    spec such as '245$a', '100$abc', '260$c' or '008/07-10' and the
+    sort is done locally (see ResultSet.sort)."""
     attrlist = ['relation', 'caseInsensitive', 'missingValueAction', 'missingValueData', 'type', 'sequence']
     relation = "ascending"
     caseInsensitive = 1
@@ -535,12 +1614,15 @@ class ResultSet(_AttrCheck, _ErrHdlr):
         self._ctr = ctr
         # _records is a dict indexed by preferredRecordSyntax of
         # dicts indexed by elementSetName of lists of records
-        self._ensure_recs ()
+        syn = self.preferredRecordSyntax
+        if syn in _transcoder_dict: # piggybacked records are the source
+            syn = _transcoder_dict [syn].sources [0]
+        self._ensure_recs (syn)
         
         # whether there are any records or not, there may be
         # nonsurrogate diagnostics.  _extract_recs will get them.
         if hasattr (self._searchResult, 'records'):
-            self._extract_recs (self._searchResult.records, 0)
+            self._extract_recs (self._searchResult.records, 0, syn)
     def __getattr__ (self, key):
         """Forward attribute access to Connection if appropriate"""
         if key in self.__dict__:
@@ -548,18 +1630,18 @@ class ResultSet(_AttrCheck, _ErrHdlr):
         if key in self.inherited_elts:
             return getattr (self._conn, key) # may raise AttributeError
         raise AttributeError (key)
-    def _make_keywords (self):
+    def _make_keywords (self, syn = None):
         """Set up dict of parameters for present request"""
         kw = {}
         # need for translation here from preferredRecordSyntax to recsyn
         # is kinda pointless
-        if hasattr (self, 'preferredRecordSyntax'):
+        if syn == None and hasattr (self, 'preferredRecordSyntax'):
+            syn = self.preferredRecordSyntax
+        if syn != None:
             try:
-                kw['recsyn'] = _record_type_dict [
-                    self.preferredRecordSyntax].oid
+                kw['recsyn'] = _record_type_dict [syn].oid
             except KeyError as err:
-                raise ClientNotImplError ('Unknown record syntax ' +
-                                          self.preferredRecordSyntax)
+                raise ClientNotImplError ('Unknown record syntax ' + syn)
         if hasattr (self, 'elementSetName'):
             kw['esn'] = ('genericElementSetName', self.elementSetName)
         return kw
@@ -571,32 +1653,63 @@ class ResultSet(_AttrCheck, _ErrHdlr):
         if i < 0:
             return i + len (self)
         return i
-    def _ensure_recs (self):
-        if self.preferredRecordSyntax not in self._records:
-            self._records [self.preferredRecordSyntax] = {}
-            self._records [self.preferredRecordSyntax][
-                self.elementSetName] = [None] * len (self)
-        if self.elementSetName not in self._records[self.preferredRecordSyntax]:
-            self._records [self.preferredRecordSyntax][
-                self.elementSetName] = [None] * len (self)
-
-    def _get_rec (self, i):
-        return self._records [self.preferredRecordSyntax][
+    def _ensure_recs (self, syn = None):
+        if syn == None:
+            syn = self.preferredRecordSyntax
+        # setdefault, so that threads racing to create the cache can't
+        # throw away each other's records
+        by_esn = self._records.setdefault (syn, {})
+        if self.elementSetName not in by_esn:
+            by_esn.setdefault (self.elementSetName, [None] * len (self))
+
+    def _get_rec (self, i, syn = None):
+        if syn == None:
+            syn = self.preferredRecordSyntax
+        return self._records [syn][
             self.elementSetName][i]
 
     def _check_stale (self):
         if self._ctr < self._conn._lastConnectCtr:
             raise ConnectionError ('Stale result set used')
+        if self.__dict__.get ('_evicted'):
+            raise ConnectionError ('Result set %s evicted (see maxResultSets)'
+                                   % self._resultSetName)
         # XXX is this right?
         if (not self._conn.namedResultSets) and \
            self._ctr != self._conn._resultSetCtr:
             raise ServerNotImplError ('Multiple Result Sets')
         # XXX or this?
     
-    def _ensure_present (self, i):
-        self._ensure_recs ()
-        if self._get_rec (i) == None:
+    def _cached (self):
+        """Return the set of (syntax, elementSetName, i) of the records
+        cached now"""
+        cached = set ()
+        for (syn, by_esn) in list (self._records.items ()):
+            for (esn, recs) in list (by_esn.items ()):
+                for i in range (len (recs)):
+                    if recs [i] != None:
+                        cached.add ((syn, esn, i))
+        return cached
+    def _evict (self, i, keep):
+        """Drop the i-th record from the cache, in every syntax and
+        element set, except as kept by keep (from _cached)"""
+        for (syn, by_esn) in list (self._records.items ()):
+            for (esn, recs) in list (by_esn.items ()):
+                if recs [i] != None and (syn, esn, i) not in keep:
+                    recs [i] = None
+
+    def _ensure_present (self, i, syn = None):
+        if syn == None:
+            syn = self.preferredRecordSyntax
+        if syn in _transcoder_dict:
+            self._ensure_transcoded (i, syn)
+            return
+        self._ensure_recs (syn)
+        if self._get_rec (i, syn) == None:
             self._check_stale ()
+            prof = self._conn._profile
+            if prof != None and syn in prof.rejectedSyntaxes:
+                self.err (239, syn, z3950.Z3950_DIAG_BIB1_ov)
             maxreq = self.presentChunk
             if maxreq == 0: # get everything at once
                 lbound = i
@@ -604,33 +1717,94 @@ class ResultSet(_AttrCheck, _ErrHdlr):
             else:
                 lbound = (i // maxreq) * maxreq
                 count = min (maxreq, len (self) - lbound)
-            kw = self._make_keywords ()
-            if self._get_rec (lbound) == None:
-                presentResp = self._conn._cli.present (
-                    start = lbound + 1,  # + 1 b/c 1-based
-                    count = count,
-                    rsn = self._resultSetName,
-                    **kw)
-                if not hasattr (presentResp, 'records'):
-                    raise ProtocolError (str (presentResp))
-                self._extract_recs (presentResp.records, lbound)
+            kw = self._make_keywords (syn)
+            if self._get_rec (lbound, syn) == None:
+                flights = self._conn.singleFlight
+                if flights == None:
+                    self._present_chunk (lbound, count, syn, kw)
+                else:
+                    key = ('present', id (self), syn, self.elementSetName,
+                           lbound, count)
+                    flights.do (key, self._present_chunk, lbound, count,
+                                syn, kw)
             # Maybe there was too much data to fit into
             # range (lbound, lbound + count).  If so, try
             # retrieving just one record. XXX could try
             # retrieving more, up to next cache bdary.
-            if i != lbound and self._get_rec (i) == None:
-                presentResp  = self._conn._cli.present (
-                    start = i + 1,
-                    count = 1,
-                    rsn = self._resultSetName,
-                    **kw)
-                self._extract_recs (presentResp.records, i)
-        rec = self._records [self.preferredRecordSyntax][
-            self.elementSetName][i]
+            if i != lbound and self._get_rec (i, syn) == None:
+                self._present_chunk (i, 1, syn, kw)
+        rec = self._get_rec (i, syn)
+        if rec != None and rec.is_surrogate_diag ():
+            rec.raise_exn ()
+    def _present_chunk (self, lbound, count, syn, kw):
+        self._conn._lock.acquire ()
+        try:
+            return self._conn._limited ('present', self._present_chunk_1,
+                                        lbound, count, syn, kw)
+        finally:
+            self._conn._lock.release ()
+    def _present_chunk_1 (self, lbound, count, syn, kw):
+        self._check_stale () # again, now nobody can evict us
+        if self._conn.namedResultSets:
+            self._conn._resultSets.touch (self._resultSetName)
+        presentResp = self._conn._cli.present (
+            start = lbound + 1,  # + 1 b/c 1-based
+            count = count,
+            rsn = self._resultSetName,
+            **kw)
+        if not hasattr (presentResp, 'records'):
+            raise ProtocolError (str (presentResp))
+        try:
+            self._extract_recs (presentResp.records, lbound, syn)
+        except Bib1Err as err:
+            if err.condition == 239: # Record syntax not supported
+                self._conn._remember ('reject_syntax', syn)
+            raise
+        # partial_2, _3, _4: message size or resource limits
+        returned = getattr (presentResp, 'numberOfRecordsReturned', count)
+        status = getattr (presentResp, 'presentStatus', 0)
+        if (0 < returned < count and status in (2, 3, 4)
+            and (self._conn.presentChunk == 0 or
+                 returned < self._conn.presentChunk)):
+            self._conn._learn ('presentChunk', returned)
+    def _ensure_transcoded (self, i, syn):
+        """Make the i-th record available in syn by converting it from
+        one of the transcoder's source syntaxes, using a cached
+        source record if there is one, and presenting the first source
+        syntax only if there isn't."""
+        tc = _transcoder_dict [syn]
+        self._ensure_recs (syn)
+        rec = self._get_rec (i, syn)
+        if rec == None:
+            src = None
+            for s in tc.sources:
+                if (s in self._records and
+                    self.elementSetName in self._records [s] and
+                    self._get_rec (i, s) != None):
+                    src = s
+                    break
+            if src == None:
+                src = tc.sources [0]
+                try:
+                    self._ensure_present (i, src)
+                except Bib1Err:
+                    pass # cache the diagnostic below
+            src_rec = self._get_rec (i, src)
+            if src_rec == None or src_rec.is_surrogate_diag ():
+                rec = src_rec
+            else:
+                rec = Record (None, src_rec, src_rec.databaseName, syn)
+            self._records [syn][self.elementSetName][i] = rec
         if rec != None and rec.is_surrogate_diag ():
             rec.raise_exn ()
     def __getitem__ (self, i):
-        """Ensure item is present, and return a Record"""
+        """Ensure item is present, and return a Record (or a list of
+        them, for a slice)"""
+        if isinstance (i, slice):
+            (start, stop, step) = i.indices (len (self))
+            if step == 1:
+                return self.__getslice__ (start, stop)
+            return [self [k] for k in range (start, stop, step)]
         i = self._pin (i)
         if i >= len (self):
             raise IndexError
@@ -648,12 +1822,15 @@ class ResultSet(_AttrCheck, _ErrHdlr):
             return []
         return self._records[self.preferredRecordSyntax][
             self.elementSetName] [i:j]
-    def _extract_recs (self, records, lbound):
+    def _extract_recs (self, records, lbound, syn = None):
+        if syn == None:
+            syn = self.preferredRecordSyntax
         (typ, recs) = records
         if trace_extract:
             print(("Extracting", len (recs), "starting at", lbound))
         if typ == 'nonSurrogateDiagnostic':
-            self.err (recs.condition, "", recs.diagnosticSetId)
+            addinfo = getattr (recs, 'addinfo', (None, ""))[1]
+            self.err (recs.condition, addinfo, recs.diagnosticSetId)
         elif typ == 'multipleNonSurDiagnostics':
             # see Zoom mailing list discussion of 2002/7/24 to justify
             # ignoring all but first error.
@@ -680,18 +1857,212 @@ class ResultSet(_AttrCheck, _ErrHdlr):
             else:
                 raise ProtocolError ("Bad typ %s data %s" %
                                      (str (typ), str(data)))
-            self._records[self.preferredRecordSyntax][
-                self.elementSetName][lbound + i] = rec
+            self._records[syn][self.elementSetName][lbound + i] = rec
     def delete (self): # XXX or can I handle this w/ a __del__ method?
-        """Delete result set"""
-        res = self._conn._cli.delete (self._resultSetName)
+        """Delete result set.  If deleteResultSets is false, only
+        frees its name for reuse (see ResultSetManager)."""
+        conn = self._conn
+        conn._lock.acquire ()
+        try:
+            if conn.deleteResultSets:
+                try:
+                    res = conn._cli.delete (self._resultSetName)
+                except (ConnectionError, UnexpectedCloseError):
+                    conn._learn ('deleteResultSets', 0)
+                    raise
+            else:
+                res = None
+            if conn.namedResultSets:
+                conn._resultSets.release (self._resultSetName)
+        finally:
+            conn._lock.release ()
         if res == None: return # server doesn't support Delete
         # XXX should I throw an exn for delete errors?  Probably.
 
     # and 'Error Code', 'Error Message', and 'Addt'l Info' methods
 
-    def sort(self, keys):
-        return self._conn.sort([self], keys)
+    def sort(self, keys, local = None):
+        """Sort by keys, returning a new result set.  If local is
+        false, the server sorts.  If true, we retrieve the records and
+        sort them here, returning a SortedResultSet.  If None (the
+        default), we sort here if all the keys are of type 'marc',
+        which only we understand, and otherwise the server sorts.  A
+        diagnostic from the server is raised; if it says the server
+        can't sort at all, the Connection's profile remembers that."""
+        if local == None:
+            local = len (keys) > 0 and \
+                    [k for k in keys if k.type != 'marc'] == []
+        if local:
+            return SortedResultSet (self, keys)
+        try:
+            return self._conn.sort([self], keys)
+        except Bib1Err as err:
+            if err.condition in _sort_unsupported:
+                self._conn._remember ('learn', 'serverSort', 0)
+            raise
+
+
+_sort_unsupported = (209, 210)
+"""Bib-1 diagnostics saying a target doesn't sort (generically, or by
+database-specific keys), rather than rejecting some key"""
+
+_marc_date_subfields = {260 : 'c', 264 : 'c'}
+"""Subfields holding dates: we sort on the first 4-digit year in them"""
+_year_re = re.compile ('[0-9]{4}')
+_sort_strip = ' /:;,.=[]'
+
+def _marc_sort_value (marc, sel):
+    """Return sort string for the first occurrence with any values of
+    zmarc.Selector sel in zmarc.MARC marc, or None if there's none.
+    Nonfiling characters (as given by the indicators, see
+    zmarc.attrHash) are skipped, and date subfields reduced to the year."""
+    occurrences = sel.occurrences (marc)
+    if not occurrences:
+        return None
+    (tag, ind1, ind2, vals) = occurrences [0]
+    if zmarc.is_fixed (tag):
+        return vals [0].strip () or None
+    codes = sel.codes
+    if codes and tag in _marc_date_subfields and \
+       _marc_date_subfields [tag] in codes:
+        m = _year_re.search (" ".join (vals))
+        if m != None:
+            return m.group (0)
+    val = " ".join (vals)
+    inds = zmarc.attrHash.get (tag, ())
+    if 'NFChars' in inds:
+        nf = (ind1, ind2) [list (inds).index ('NFChars')]
+        if nf.isdigit ():
+            val = val [int (nf):]
+    return val.strip (_sort_strip) or None
+
+class _Reversed:
+    """Invert the ordering of a sort key component for descending keys"""
+    def __init__ (self, val):
+        self.val = val
+    def __lt__ (self, other):
+        return other.val < self.val
+    def __eq__ (self, other):
+        return self.val == other.val
+    def __repr__ (self):
+        return '_Reversed(%r)' % (self.val,)
+
+class SortedResultSet:
+    """Read-only sequence view of a ResultSet, sorted locally by
+    SortKeys of type 'marc'.  Element i is base_rs[order[i]], so records
+    are shared with (and fetched through) the base result set's cache.
+
+    Sort keys are extracted from every record in the base set, each
+    record being dropped from the base set's cache once its key is
+    taken (unless it was cached before), so only a present's worth of
+    records is held at a time.  At most memorySortLimit keys are held
+    in memory at once: beyond that, sorted runs are spilled to
+    temporary files and merged."""
+
+    memorySortLimit = 100000
+
+    def __init__ (self, base_rs, keys, memorySortLimit = None):
+        self._base = base_rs
+        if memorySortLimit != None:
+            self.memorySortLimit = memorySortLimit
+        for k in keys:
+            if k.type != 'marc':
+                raise ClientNotImplError (
+                    'Local sort only supports marc sort keys, not ' + k.type)
+            if k.relation not in ('ascending', 'descending'):
+                raise ClientNotImplError ('Local sort by ' + k.relation)
+        self._keys = [(k, zmarc.selector (k.sequence)) for k in keys]
+        self._order = self._sort ()
+    def __getattr__ (self, key):
+        if key in ResultSet.inherited_elts:
+            return getattr (self._base, key)
+        raise AttributeError (key)
+    def _key_for (self, i):
+        try:
+            rec = self._base [i]
+            marc = rec._get_parsed ()
+        except Bib1Err:
+            marc = None
+        if marc != None and not isinstance (marc, zmarc.MARC):
+            raise ClientNotImplError ('Local sort of %s records' %
+                                      rec.syntax)
+        key = []
+        for (k, sel) in self._keys:
+            val = None
+            if marc != None:
+                val = _marc_sort_value (marc, sel)
+            if val == None:
+                if k.missingValueData:
+                    val = k.missingValueData
+                elif k.missingValueAction == 'abort':
+                    raise ZoomError ('Missing sort key %s for record %d' %
+                                     (k.sequence, i))
+                else:
+                    # missing values sort after present ones, whichever
+                    # way the key sorts
+                    comp = (1, '')
+            if val != None:
+                if k.caseInsensitive:
+                    val = val.lower ()
+                if k.relation == 'descending':
+                    val = _Reversed (val)
+                comp = (0, val)
+            key.append (comp)
+        return (tuple (key), i) # i keeps the sort stable
+    def _sort (self):
+        runs = []
+        chunk = []
+        evict = getattr (self._base, '_evict', None)
+        if evict != None:
+            keep = self._base._cached ()
+        for i in range (len (self._base)):
+            chunk.append (self._key_for (i))
+            if evict != None:
+                evict (i, keep)
+            if len (chunk) >= self.memorySortLimit:
+                chunk.sort ()
+                runs.append (self._spill (chunk))
+                chunk = []
+        chunk.sort ()
+        order = array.array ('l')
+        if not runs:
+            order.extend ([i for (key, i) in chunk])
+            return order
+        iters = [self._read_run (f) for f in runs] + [iter (chunk)]
+        for (key, i) in heapq.merge (*iters):
+            order.append (i)
+        return order
+    def _spill (self, chunk):
+        f = tempfile.TemporaryFile ()
+        for item in chunk:
+            pickle.dump (item, f, pickle.HIGHEST_PROTOCOL)
+        f.seek (0)
+        return f
+    def _read_run (self, f):
+        try:
+            while 1:
+                try:
+                    yield pickle.load (f)
+                except EOFError:
+                    return
+        finally:
+            f.close ()
+    def __len__ (self):
+        return len (self._order)
+    def __getitem__ (self, i):
+        if isinstance (i, slice):
+            return [self [j] for j in range (*i.indices (len (self)))]
+        if i < 0:
+            i += len (self)
+        if i < 0 or i >= len (self):
+            raise IndexError
+        return self._base [self._order [i]]
+    def __getslice__ (self, i, j):
+        return self [max (0, i):max (0, j)]
+    def sort (self, keys, local = 1):
+        return SortedResultSet (self, keys)
+    def delete (self):
+        self._base.delete ()
 
 
 class SurrogateDiagnostic(_ErrHdlr):
@@ -722,101 +2093,197 @@ class Record:
 using this)
       OPAC     -- ditto
       
-      Other representations are not yet defined."""
-    def __init__ (self, oid, data, dbname):
-        """Only for use by ResultSet"""
-        self.syntax = _oid_to_key (oid)
-        self._rt = _record_type_dict [self.syntax]
-        self.data = self._rt.preproc (data)
+      Other representations are not yet defined.
+
+      Nothing is decoded until it's needed: 'data' is computed on first
+      access, and the parsed form used by get_field, get_fieldcount and
+      str (e.g. a zmarc.MARC object for MARC syntaxes) is built at most
+      once and then cached."""
+    def __init__ (self, oid, data, dbname, syntax = None):
+        """Only for use by ResultSet.  For syntaxes produced by local
+        transcoding, oid is None, syntax is given, and data is the
+        source Record."""
+        if syntax == None:
+            syntax = _oid_to_key (oid)
+        self.syntax = syntax
+        if syntax in _transcoder_dict:
+            self._rt = _transcoder_dict [syntax]
+        else:
+            self._rt = _record_type_dict [syntax]
+        self._raw = data
         self.databaseName = dbname
+    def __getattr__ (self, attr):
+        """Compute 'data' lazily, caching it as an ordinary attribute"""
+        if attr == 'data':
+            self.data = self._rt.preproc (self._raw)
+            return self.data
+        raise AttributeError (attr)
+    def _get_parsed (self):
+        parsed = self.__dict__.get ('_parsed')
+        if parsed is None:
+            parsed = self._parsed = self._rt.parse (self.data)
+        return parsed
     def is_surrogate_diag (self):
         return 0
     def get_fieldcount (self):
         """Get number of fields"""
-        return self._rt.fieldcount (self.data)
+        return self._rt.fieldcount (self._get_parsed ())
     def get_field (self,spec):
-        """Get field"""
-        return self._rt.field (self.data, spec)
+        """Get field.  For MARC syntaxes, spec is a zmarc.Selector or
+        a spec for one, such as '245$a', '650[ind2=0]$a$x' or
+        '008/07-10', and the result is a list with a string for each
+        matching field."""
+        return self._rt.field (self._get_parsed (), spec)
     def __str__ (self):
         """Render printably"""
-        s = self._rt.renderer (self.data)
+        s = self._rt.renderer (self._get_parsed ())
         return 'Rec: ' + str (self.syntax) + " " + s
 
 class _RecordType:
-    """Map syntax string to OID and per-syntax utility functions"""
+    """Map syntax string to OID and per-syntax utility functions.
+    preproc turns the raw decoded data into Record.data, parse turns
+    Record.data into the object handed to renderer, fieldcount and field."""
     def __init__ (self, name, oid, renderer = lambda v:v,
-                  fieldcount = lambda v:1, field = None, preproc = lambda v:v):
+                  fieldcount = lambda v:1, field = None, preproc = lambda v:v,
+                  parse = lambda v:v):
         """Register syntax"""
         self.oid = oid
         self.renderer = renderer
         self.fieldcount = fieldcount
         self.field = field
         self.preproc = preproc
+        self.parse = parse
         _record_type_dict [name] = self
 
-# XXX do I want an OPAC class?  Probably, and render_OPAC should be
-# a member function.
 
-
-def render_OPAC (opac_data):
-    s_list = []
-    biblio_oid = opac_data.bibliographicRecord.direct_reference
-    if (biblio_oid == z3950.Z3950_RECSYN_USMARC_ov):
-        bib_marc = zmarc.MARC (opac_data.bibliographicRecord.encoding [1])
-        s_list.append ("Bibliographic %s\n" % (str (bib_marc),) )
-    else:
-        s_list.append ("Unknown bibliographicRecord OID: " + str(biblio_oid))
-    for i, hd in my_enumerate (opac_data.holdingsData):
-        typ, data = hd
-        s_list.append ('Holdings %d:' % (i,))
-        if typ == 'holdingsAndCirc':
-            def render (item, level = 1):
-                s_list = []
-                if isinstance (item, asn1.StructBase):
-                    for attr, val in list(item.__dict__.items ()):
-                        if attr [0] != '_':
-                            s_list.append ("%s%s: %s" % (
-                                "\t" * level, attr, "\n".join(render (val, level + 1))))
-                elif (isinstance (item, type ([])) and len (item) > 0
-                      and isinstance (item [0], asn1.StructBase)):
-                    s_list.append ("") # generate newline
-                    for i, v in my_enumerate (item):
-                        s_list.append ("\t" * (level + 1) + str (i))
-                        s_list += render (v, level + 1)
-                else:
-                    s_list.append (repr (item))
-                return s_list
-            s_list.append ("\n".join (render (data)))
-        elif typ == 'marcHoldingsRecord':
-            hold_oid = data.direct_reference
-            if hold_oid == z3950.Z3950_RECSYN_USMARC_ov:
-                holdings_marc = zmarc.MARC (data.encoding [1])
-                s_list.append ("Holdings %s\n" % (str (holdings_marc),))
+class OPAC:
+    """Wrap an OPACRecord, parsing the embedded bibliographic and
+    MARC holdings records on first use only."""
+    def __init__ (self, opac_data):
+        self.opac_data = opac_data
+        self._holdings_marc = {}
+    def __getattr__ (self, attr):
+        if attr == 'bib_marc':
+            # None if the bibliographic record isn't MARC
+            self.bib_marc = None
+            bib = self.opac_data.bibliographicRecord
+            if bib.direct_reference == z3950.Z3950_RECSYN_USMARC_ov:
+                self.bib_marc = zmarc.MARC (bib.encoding [1])
+            return self.bib_marc
+        raise AttributeError (attr)
+    def get_holdings_marc (self, i):
+        """Return zmarc.MARC for the i-th holding, or None if it isn't
+        a marcHoldingsRecord with USMARC syntax."""
+        if i not in self._holdings_marc:
+            typ, data = self.opac_data.holdingsData [i]
+            if (typ == 'marcHoldingsRecord' and
+                data.direct_reference == z3950.Z3950_RECSYN_USMARC_ov):
+                self._holdings_marc [i] = zmarc.MARC (data.encoding [1])
             else:
-                s_list.append ("Unknown holdings OID: " + str (hold_oid))
+                self._holdings_marc [i] = None
+        return self._holdings_marc [i]
+    def __str__ (self):
+        s_list = []
+        biblio_oid = self.opac_data.bibliographicRecord.direct_reference
+        if self.bib_marc != None:
+            s_list.append ("Bibliographic %s\n" % (str (self.bib_marc),) )
         else:
-            s_list.append ("Unknown holdings type: " + typ)
-            # shouldn't happen unless z39.50 definition is extended
-    return "\n".join (s_list)
+            s_list.append ("Unknown bibliographicRecord OID: " + str(biblio_oid))
+        for i, hd in my_enumerate (getattr (self.opac_data, 'holdingsData',
+                                            [])):
+            typ, data = hd
+            s_list.append ('Holdings %d:' % (i,))
+            if typ == 'holdingsAndCirc':
+                def render (item, level = 1):
+                    s_list = []
+                    if isinstance (item, asn1.StructBase):
+                        for attr, val in list(item.__dict__.items ()):
+                            if attr [0] != '_':
+                                s_list.append ("%s%s: %s" % (
+                                    "\t" * level, attr, "\n".join(render (val, level + 1))))
+                    elif (isinstance (item, type ([])) and len (item) > 0
+                          and isinstance (item [0], asn1.StructBase)):
+                        s_list.append ("") # generate newline
+                        for i, v in my_enumerate (item):
+                            s_list.append ("\t" * (level + 1) + str (i))
+                            s_list += render (v, level + 1)
+                    else:
+                        s_list.append (repr (item))
+                    return s_list
+                s_list.append ("\n".join (render (data)))
+            elif typ == 'marcHoldingsRecord':
+                hold_oid = data.direct_reference
+                if hold_oid == z3950.Z3950_RECSYN_USMARC_ov:
+                    holdings_marc = self.get_holdings_marc (i)
+                    s_list.append ("Holdings %s\n" % (str (holdings_marc),))
+                else:
+                    s_list.append ("Unknown holdings OID: " + str (hold_oid))
+            else:
+                s_list.append ("Unknown holdings type: " + typ)
+                # shouldn't happen unless z39.50 definition is extended
+        return "\n".join (s_list)
+
+def render_OPAC (opac_data):
+    return str (OPAC (opac_data))
+
+def _marc_fieldcount (marc):
+    return sum ([len (occs) for (tag, occs) in marc.fields.items () if tag])
+
+def _marc_field (marc, spec):
+    """Selectors are compiled once per spec (see zmarc.selector)"""
+    return zmarc.selector (spec).select (marc)
 
 _RecordType ('USMARC', z3950.Z3950_RECSYN_USMARC_ov,
-            renderer = lambda v: str(zmarc.MARC(v)))
+            renderer = str, parse = zmarc.MARC,
+            fieldcount = _marc_fieldcount, field = _marc_field)
 _RecordType ('USMARCnonstrict', z3950.Z3950_RECSYN_USMARC_ov,
-            renderer = lambda v: str(zmarc.MARC(v, strict=0)))
+            renderer = str, parse = lambda v: zmarc.MARC(v, strict=0),
+            fieldcount = _marc_fieldcount, field = _marc_field)
 _RecordType ('UKMARC', z3950.Z3950_RECSYN_UKMARC_ov,
-            renderer = lambda v: str(zmarc.MARC(v)))
+            renderer = str, parse = zmarc.MARC,
+            fieldcount = _marc_fieldcount, field = _marc_field)
 _RecordType ('UNIMARC', z3950.Z3950_RECSYN_UNIMARC_ov,
-            renderer = lambda v: str(zmarc.MARC(v)))
+            renderer = str, parse = zmarc.MARC,
+            fieldcount = _marc_fieldcount, field = _marc_field)
 _RecordType ('SUTRS', z3950.Z3950_RECSYN_SUTRS_ov)
 _RecordType ('XML', z3950.Z3950_RECSYN_MIME_XML_ov)
 _RecordType ('SGML', z3950.Z3950_RECSYN_MIME_SGML_ov)
 _RecordType ('GRS-1', z3950.Z3950_RECSYN_GRS1_ov,
              renderer = lambda v: str (v),
              preproc = grs1.preproc)
-_RecordType ('OPAC', z3950.Z3950_RECSYN_OPAC_ov, renderer = render_OPAC)
+_RecordType ('OPAC', z3950.Z3950_RECSYN_OPAC_ov, renderer = str,
+             parse = OPAC)
 _RecordType ('EXPLAIN', z3950.Z3950_RECSYN_EXPLAIN_ov,
              renderer = lambda v: str (v))
 
+_transcoder_dict = {}
+"""Map syntax name to _Transcoder, for syntaxes we derive locally"""
+
+class _Transcoder:
+    """Register a syntax which ResultSet produces locally from records
+    in one of the sources syntaxes (in order of preference; the first
+    is the one presented if nothing suitable is cached), instead of
+    requesting it from the server.  convert takes the parsed source
+    record (e.g. a zmarc.MARC) and returns the new record's data.  Can
+    be used like a _RecordType by Record."""
+    def __init__ (self, name, sources, convert, renderer = lambda v:v,
+                  fieldcount = lambda v:1, field = None):
+        self.sources = sources
+        self.convert = convert
+        self.renderer = renderer
+        self.fieldcount = fieldcount
+        self.field = field
+        self.parse = lambda v:v
+        _transcoder_dict [name] = self
+    def preproc (self, src_rec):
+        return self.convert (src_rec._get_parsed ())
+
+_marc_sources = ['USMARC', 'USMARCnonstrict']
+_Transcoder ('MARCXML', _marc_sources, zmarc.MARC.toMARCXML)
+_Transcoder ('OAI-MARC', _marc_sources, zmarc.MARC.toOAIMARC)
+_Transcoder ('MODS', _marc_sources, zmarc.MARC.toMODS)
+_Transcoder ('DC', _marc_sources, zmarc.MARC.toSimpleDC)
+
 class ScanSet (_AttrCheck, _ErrHdlr):
     """Hold result of scan.
     """
@@ -891,6 +2358,9 @@ class ScanSet (_AttrCheck, _ErrHdlr):
             return i + len (self)
         return i
     def __getitem__ (self, i):
+        if isinstance (i, slice):
+            return [self.get_fields (k)
+                    for k in range (*i.indices (len (self)))]
         return self.get_fields (self._pin (i))
     def __getslice__ (self, i, j):
         i = self._pin (i)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""Capability and quirk profiles for Z39.50 targets.
+
+Every session with a target rediscovers the same facts: the option
+bits in its initResponse, whether it closes the connection when sent a
+deleteResultSetRequest despite claiming to support delete, which
+record syntaxes it rejects, how many records fit in a present
+response, how big a query or how many result sets it will put up
+with, and which indexes (use attributes) each database supports.  A
+Profile records these, and a store keeps Profiles between sessions.
+
+A zoom.Connection given a store (its profileStore option) looks up the
+target's Profile after connecting, uses what it knows to choose
+parameters (presentChunk, maxQueryTerms, maxResultSets,
+deleteResultSets) and to refuse requests which are bound to fail
+(presenting a rejected syntax, searching an unsupported use
+attribute, asking a target whose sort doesn't work to sort), and
+saves whatever it learns from diagnostics.  Options passed to the
+Connection constructor always win over the Profile.
+
+Profiles expire after maxAge seconds, and are discarded early if the
+target reports a different implementation (id, name or version) than
+when the Profile was made, since an upgrade may have changed its
+behavior.  FileStore files carry a format version, and files written by
+a different version are ignored.
+
+Sample usage:
+    from PyZ3950 import zoom, zprofile
+    store = zprofile.FileStore ('/var/cache/pyz3950/profiles.json')
+    conn = zoom.Connection ('z3950.loc.gov', 7090, profileStore = store)
+"""
+
+import os
+import json
+import time
+import threading
+
+from PyZ3950 import atomicfile
+
+PROFILE_VERSION = 1
+"""Version of the stored profile format"""
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+_impl_attrs = ['implementationId', 'implementationName',
+               'implementationVersion']
+
+class Profile:
+    """What's known about one target.  Attributes:
+
+    options                dict of initResponse option bit names to 0/1
+    implementationId,
+    implementationName,
+    implementationVersion  as reported by the target
+    facts                  dict of learned values: 'presentChunk',
+                           'maxQueryTerms', 'maxResultSets',
+                           'deleteResultSets', 'serverSort'
+    rejectedSyntaxes       record syntax names the target doesn't support
+    indexes                dict of database name to a dict of use
+                           attribute values to 1 (supported, from
+                           Explain) or 0 (diagnosed as unsupported)
+    indexesExplained       database names whose indexes came from Explain
+    created                when the profile was made (seconds since epoch)
+    """
+    def __init__ (self, key):
+        self.key = key
+        self.created = time.time ()
+        self.options = {}
+        self.implementationId = None
+        self.implementationName = None
+        self.implementationVersion = None
+        self.facts = {}
+        self.rejectedSyntaxes = []
+        self.indexes = {}
+        self.indexesExplained = []
+    def expired (self, maxAge, now = None):
+        if now == None:
+            now = time.time ()
+        return now - self.created > maxAge
+    def same_implementation (self, initresp):
+        for attr in _impl_attrs:
+            if getattr (self, attr) != getattr (initresp, attr, None):
+                return 0
+        return 1
+    def learn_init (self, initresp):
+        """Record the option bits and implementation info from an
+        InitializeResponse"""
+        options = initresp.options
+        num_to_name = getattr (options.defn, 'num_to_name', None) or {}
+        for (num, name) in list (num_to_name.items ()):
+            self.options [name] = int (bool (options.is_set (num)))
+        for attr in _impl_attrs:
+            setattr (self, attr, getattr (initresp, attr, None))
+    def learn (self, name, val):
+        """Record a fact (see the facts attribute)"""
+        self.facts [name] = val
+    def get (self, name, default = None):
+        return self.facts.get (name, default)
+    def reject_syntax (self, syn):
+        if syn not in self.rejectedSyntaxes:
+            self.rejectedSyntaxes.append (syn)
+    def learn_explain (self, dbname, rec):
+        """Record the use attributes listed in rec, an Explain
+        record (as returned by a zoom Record's data with syntax
+        EXPLAIN) for database dbname.  Only attributeDetails records
+        are useful; others are ignored."""
+        (typ, details) = rec
+        if typ != 'attributeDetails':
+            return
+        uses = self.indexes.setdefault (dbname, {})
+        for setdet in getattr (details, 'attributesBySet', []):
+            for typedet in setdet.attributesByType:
+                if typedet.attributeType != 1:
+                    continue
+                for av in getattr (typedet, 'attributeValues', []):
+                    uses [av.value [1]] = 1
+        if dbname not in self.indexesExplained:
+            self.indexesExplained.append (dbname)
+    def reject_use (self, dbname, val):
+        self.indexes.setdefault (dbname, {}) [val] = 0
+    def supports_use (self, dbname, val):
+        """Return 1 if the use attribute val is known to be supported
+        by database dbname, 0 if known not to be, None if unknown"""
+        uses = self.indexes.get (dbname, {})
+        if val in uses:
+            return uses [val]
+        if dbname in self.indexesExplained:
+            return 0
+        return None
+    def to_dict (self):
+        d = {}
+        for (k, v) in list (self.__dict__.items ()):
+            if k == 'indexes': # JSON keys must be strings
+                v = dict ([(db, [[u, ok] for (u, ok) in list (uses.items ())])
+                           for (db, uses) in list (v.items ())])
+            d [k] = v
+        return d
+    def from_dict (klass, d):
+        p = klass (d ['key'])
+        for (k, v) in list (d.items ()):
+            if k == 'indexes':
+                v = dict ([(db, dict ([(u, ok) for (u, ok) in uses]))
+                           for (db, uses) in list (v.items ())])
+            setattr (p, k, v)
+        return p
+    from_dict = classmethod (from_dict)
+    def __str__ (self):
+        return "Profile %s: %s %s %s facts %s rejected %s" % (
+            self.key, self.implementationId, self.implementationName,
+            self.implementationVersion, self.facts, self.rejectedSyntaxes)
+
+
+class MemoryStore:
+    """Keep Profiles in memory, for the life of the process (or of the
+    store: pass one to each Connection which should share them)"""
+    def __init__ (self, maxAge = DEFAULT_MAX_AGE):
+        self.maxAge = maxAge
+        self._lock = threading.Lock ()
+        self._profiles = {}
+    def _key (self, host, port):
+        return "%s:%s" % (host, port)
+    def lookup (self, host, port, initresp):
+        """Return the Profile for host:port, a new one if we have none
+        or it's expired or for a different implementation.  It's
+        updated from initresp, the target's InitializeResponse."""
+        key = self._key (host, port)
+        self._lock.acquire ()
+        try:
+            p = self._profiles.get (key)
+            if (p == None or p.expired (self.maxAge) or
+                not p.same_implementation (initresp)):
+                p = Profile (key)
+            p.learn_init (initresp)
+            self._profiles [key] = p
+        finally:
+            self._lock.release ()
+        self.save (p)
+        return p
+    def get (self, host, port):
+        """Return the unexpired Profile for host:port, or None"""
+        self._lock.acquire ()
+        try:
+            p = self._profiles.get (self._key (host, port))
+        finally:
+            self._lock.release ()
+        if p == None or p.expired (self.maxAge):
+            return None
+        return p
+    def save (self, profile):
+        """Called after profile has learned something"""
+        pass
+
+
+class FileStore (MemoryStore):
+    """Keep Profiles in a JSON file, rewritten (atomically) whenever a
+    Profile changes.  Several processes may share the file: each save
+    takes a lock file (path + '.lock'), re-reads the file and merges
+    in the other processes' Profiles before writing, so only the
+    Profile being saved is overwritten.  A lock file older than
+    lockTimeout seconds is taken to be left over from a crashed
+    process, and removed.  Unreadable files, or files of a different
+    PROFILE_VERSION, are treated as empty."""
+    lockTimeout = 30
+    def __init__ (self, path, maxAge = DEFAULT_MAX_AGE):
+        MemoryStore.__init__ (self, maxAge)
+        self.path = path
+        self._lockPath = path + '.lock'
+        self._profiles.update (self._read ())
+    def _read (self):
+        """Return a dict of the unexpired Profiles in the file"""
+        profiles = {}
+        try:
+            f = open (self.path)
+            try:
+                d = json.load (f)
+            finally:
+                f.close ()
+        except (IOError, OSError, ValueError):
+            return profiles
+        if not isinstance (d, dict) or d.get ('version') != PROFILE_VERSION:
+            return profiles
+        for pd in d.get ('profiles', []):
+            try:
+                p = Profile.from_dict (pd)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if not p.expired (self.maxAge):
+                profiles [p.key] = p
+        return profiles
+    def _lock_file (self):
+        while 1:
+            try:
+                fd = os.open (self._lockPath,
+                              os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                try:
+                    age = time.time () - os.path.getmtime (self._lockPath)
+                except OSError: # just released
+                    continue
+                if age > self.lockTimeout:
+                    try:
+                        os.remove (self._lockPath)
+                    except OSError:
+                        pass
+                else:
+                    time.sleep (0.01)
+                continue
+            os.close (fd)
+            return
+    def _unlock_file (self):
+        try:
+            os.remove (self._lockPath)
+        except OSError:
+            pass
+    def save (self, profile):
+        self._lock.acquire ()
+        try:
+            self._lock_file ()
+            try:
+                # others' changes win, except to the Profile we're saving
+                for (key, p) in list (self._read ().items ()):
+                    if key != profile.key:
+                        self._profiles [key] = p
+                self._profiles [profile.key] = profile
+                d = {'version' : PROFILE_VERSION,
+                     'profiles' : [p.to_dict () for p in
+                                   list (self._profiles.values ())
+                                   if not p.expired (self.maxAge)]}
+                atomicfile.write (self.path, lambda f: json.dump (d, f))
+            finally:
+                self._unlock_file ()
+        finally:
+            self._lock.release ()
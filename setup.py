@@ -58,6 +58,7 @@ setup (name="PyZ3950",
        classifiers = filter(None, classifiers.split("\n")),
        url = "http://www.pobox.com/~asl2/software/PyZ3950",
        packages = ["PyZ3950"],
+       scripts = ["scripts/pyz3950-harvest"],
        cmdclass = {'build_ext' : PLYBuild},
        ext_modules= [foo])
 
@@ -1,2 +1,35 @@
 import pytest
 
+from PyZ3950 import zmarc
+
+
+def make_marc(n=1, isbn=None, title='The oldest cuisine in the world',
+              nonfiling='4', date='2004.', org=None, fields=None):
+    """Return a raw MARC record for a book.  Its 001 is 'ocm' and n, or
+    n itself if a string (there's no 001 if n is None); its 003 org if
+    given.  There's no 245 if title is None.  fields, a dict of tag to
+    occurrences, adds or replaces fields."""
+    m = zmarc.MARC()
+    m.fields[0] = ['nam  a ']
+    if isinstance(n, str):
+        m.fields[1] = [n]
+    elif n is not None:
+        m.fields[1] = ['ocm%08d' % n]
+    if org is not None:
+        m.fields[3] = [org]
+    m.fields[8] = ['040101s2004    ilu           000 0 eng d']
+    if isbn:
+        m.fields[20] = [(' ', ' ', [('a', isbn)])]
+    m.fields[100] = [('1', ' ', [('a', 'Bottero, Jean.'), ('d', '1914-')])]
+    if title is not None:
+        m.fields[245] = [('1', nonfiling, [('a', title + ' :'),
+                                           ('b', 'cooking in Mesopotamia /')])]
+    m.fields[260] = [(' ', ' ', [('a', 'Chicago :'),
+                                 ('b', 'University of Chicago Press,'),
+                                 ('c', date)])]
+    m.fields[600] = [('1', '0', [('a', 'Smith, J.'), ('x', 'Criticism.')])]
+    m.fields[650] = [(' ', '0', [('a', 'Cookery'), ('z', 'Iraq')]),
+                     (' ', '0', [('a', 'Food & drink')])]
+    if fields:
+        m.fields.update(fields)
+    return m.get_MARC()
@@ -0,0 +1,28 @@
+import os
+import pytest
+from PyZ3950 import atomicfile
+
+def test_write_replaces(tmp_path):
+    path = str(tmp_path / 'state')
+    with open(path, 'w') as f:
+        f.write('old')
+    atomicfile.write(path, lambda f: f.write('new'), sync=1)
+    with open(path) as f:
+        assert f.read() == 'new'
+    atomicfile.write(path, lambda f: f.write(b'\x00\xff'), binary=1)
+    with open(path, 'rb') as f:
+        assert f.read() == b'\x00\xff'
+    assert os.listdir(str(tmp_path)) == ['state']
+
+def test_failed_write_keeps_old(tmp_path):
+    path = str(tmp_path / 'state')
+    with open(path, 'w') as f:
+        f.write('old')
+    def fill(f):
+        f.write('partial')
+        raise ValueError('disk full')
+    with pytest.raises(ValueError):
+        atomicfile.write(path, fill)
+    with open(path) as f:
+        assert f.read() == 'old'
+    assert os.listdir(str(tmp_path)) == ['state']
@@ -1,4 +1,5 @@
 import re
+import threading
 from PyZ3950 import ccl
 
 def test_word():
@@ -28,3 +29,27 @@ def test_word():
     
     
     
+
+def test_case_insensitive_keywords():
+    # qualifiers, boolean operators and ATTRSET match in any case
+    for q in ('ti=foo and au=bar', 'TI=foo AND AU=bar', 'Ti=foo aNd aU=bar'):
+        rpn = ccl.mk_rpn_query(q)[1].rpn
+        assert rpn[0] == 'rpnRpnOp'
+        assert rpn[1].op == ('and', None)
+    rpnq = ccl.mk_rpn_query('attrset (bib1/ ti=foo)')[1]
+    assert rpnq.rpn[0] == 'op'
+
+def test_threaded_parse():
+    queries = ['ti="word%d" and au=name%d' % (i, i) for i in range(200)]
+    def terms():
+        return [ccl.mk_rpn_query(q)[1].rpn[1].rpn1[1][1].term
+                for q in queries]
+    expected = terms()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(terms()))
+               for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [expected] * 4
@@ -0,0 +1,57 @@
+import codecs
+import io
+
+import pytest
+
+from PyZ3950 import marc8
+
+def test_decode():
+    assert b'Bott\xe2ero'.decode('marc8') == 'Bott\xe9ro'
+    assert b'\x1b(NmOSKWA\x1b(B 1990'.decode('marc8') == 'Москва 1990'
+    assert b'\x1b$1!M>!`o\x1b(B/ Huang'.decode('marc8') == '盤飾/ Huang'
+    # controls are kept, and the sets reset at the field terminator
+    assert b'\x1b(Nm\x1e\x1f m'.decode('marc8') == 'М\x1e\x1f m'
+    assert b'x\xa0y'.decode('marc8', 'replace') == 'x�y'
+    with pytest.raises(UnicodeDecodeError):
+        b'\x1b(Z'.decode('marc8')
+
+def test_encode():
+    assert 'Bottéro'.encode('marc8') == b'Bott\xe2ero'
+    assert 'Bottéro'.encode('marc-8') == 'Bottéro'.encode('marc8')
+    # one escape for the Cyrillic, spaces and digits included
+    assert ('mixed Москва 1990 and Bottéro'.encode('marc8') ==
+            b'mixed \x1b(NmOSKWA 1990 \x1b(Band Bott\xe2ero')
+    assert 'H₂O'.encode('marc8') == b'H\x1bb2\x1b(BO'
+    # U+1EF0 goes to ANSEL's U with horn and a combining dot below
+    assert 'Ự'.encode('marc8') == b'\xf2\xad'
+    assert '☺'.encode('marc8', 'replace') == b'?'
+    with pytest.raises(UnicodeEncodeError):
+        '☺'.encode('marc8')
+
+def test_round_trip():
+    # EACC has U+3000 as 0x212320 too, but that's not what's written
+    assert '\u3000'.encode('marc8') == b'\x1b$1!#!\x1b(B'
+    assert b'\x1b$1!# \x1b(B'.decode('marc8') == '\u3000'
+    # U+0670 is combining in Unicode, spacing in MARC-8: it stays put
+    for text in ('\u3000盤 飾', 'é بٰ', 'بٰ'):
+        assert text.encode('marc8').decode('marc8') == text
+
+def test_incremental():
+    text = 'Москва\nBottéro 盤飾 x²\nΕλληνικά\x1e'
+    raw = text.encode('marc8')
+    assert raw.decode('marc8') == text
+    decoder = codecs.getincrementaldecoder('marc8')()
+    out = [decoder.decode(raw[i:i + 1]) for i in range(len(raw))]
+    assert ''.join(out) + decoder.decode(b'', True) == text
+    encoder = codecs.getincrementalencoder('marc8')()
+    out = [encoder.encode(line) for line in text.splitlines(True)]
+    assert b''.join(out) + encoder.encode('', True) == raw
+
+def test_text_io():
+    raw = 'Москва\nBottéro\nplain\n'.encode('marc8')
+    f = io.TextIOWrapper(io.BytesIO(raw), encoding='marc8')
+    assert f.readline() == 'Москва\n'
+    pos = f.tell()
+    assert f.readline() == 'Bottéro\n'
+    f.seek(pos)
+    assert f.read() == 'Bottéro\nplain\n'
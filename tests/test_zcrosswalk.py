@@ -0,0 +1,102 @@
+from PyZ3950 import zcrosswalk, zmarc
+from PyZ3950.zcrosswalk import Crosswalk, Rule
+
+from .fixtures import make_marc
+
+def test_dc():
+    dc = zmarc.MARC(make_marc()).toSimpleDC()
+    assert '<title>The oldest cuisine in the world : cooking in Mesopotamia /</title>' in dc
+    assert '<creator>Bottero, Jean. (1914-)</creator>' in dc
+    assert '<subject>Food &amp; drink</subject>' in dc
+    assert '<date>2004</date>' in dc
+    assert '<publisher>Chicago : University of Chicago Press</publisher>' in dc
+
+def test_dc_empty():
+    m = zmarc.MARC(make_marc())
+    m.fields[245] = [('1', '0', [('c', 'Anon.')])]
+    m.fields[650] = [(' ', '0', [])]
+    dc = m.toSimpleDC()
+    assert '<title></title>' in dc
+    assert '<subject></subject>' in dc
+
+def test_mods():
+    # toMODS is still the hand-written conversion, output unchanged
+    mods = zmarc.MARC(make_marc()).toMODS()
+    assert mods.startswith(
+        '<mods>\n  <titleInfo>\n'
+        '    <title>The oldest cuisine in the world : </title>\n'
+        '    <subtitle>cooking in Mesopotamia / </subtitle>\n'
+        '  </titleInfo>\n'
+        '  <!-- Marc: 100 -->\n')
+    assert ('    <name type="personal">\n'
+            '      <namePart>Smith, J.</namePart>\n'
+            '      <topic>Criticism.</topic>\n'
+            '    </name>\n') in mods
+    assert mods.endswith(
+        '<recordIdentifier>ocm00000001</recordIdentifier>\n'
+        '  </recordInformation>\n</mods>')
+
+def test_mods3():
+    mods = zcrosswalk.convert(zmarc.MARC(make_marc()), 'MODS')
+    assert mods.startswith('<mods xmlns="http://www.loc.gov/mods/v3">\n'
+                           '  <titleInfo>\n    <title>')
+    assert '    <subTitle>cooking in Mesopotamia /</subTitle>\n' in mods
+    assert '<!--' not in mods
+    assert ('  <originInfo>\n'
+            '    <place><placeTerm type="code" authority="marccountry">ilu</placeTerm></place>\n'
+            '    <place><placeTerm type="text">Chicago :</placeTerm></place>\n') in mods
+    # subdivisions go in the subject, not the name
+    assert ('  <subject authority="lcsh">\n'
+            '    <name type="personal">\n'
+            '      <namePart>Smith, J.</namePart>\n'
+            '    </name>\n'
+            '    <topic>Criticism.</topic>\n'
+            '  </subject>\n') in mods
+    assert mods.count('<topic>') == 3
+    assert mods.endswith('<recordIdentifier>ocm00000001</recordIdentifier>\n'
+                         '  </recordInfo>\n</mods>')
+
+def test_sgml_groups():
+    sgml = zmarc.MARC(make_marc()).toSGML()
+    assert '      <fld001>ocm00000001</fld001>\n' in sgml
+    assert '        <fld245 AddEnty="1" NFChars="4">\n' in sgml
+    # numbcode is always there, other groups only if they have fields
+    assert '<numbcode>\n      </numbcode>' in sgml
+    assert '<series>' not in sgml
+
+def test_registered():
+    rules = [Rule(245, 'title', codes='ab', first=1, strip=' /:'),
+             Rule([100, 700], 'creator', codes='a', strip=','),
+             Rule(650, 'subject', group='subjects', children=[
+                 Rule(path='term type="%(code)s"', codes='az', each=1)]),
+             Rule(856, 'link', codes='u', each=1)]
+    zcrosswalk.register(Crosswalk('test', 'rec', rules))
+    assert zcrosswalk.convert(zmarc.MARC(make_marc()), 'test') == (
+        '<rec>\n'
+        '  <title>The oldest cuisine in the world : cooking in Mesopotamia</title>\n'
+        '  <creator>Bottero, Jean.</creator>\n'
+        '  <subjects>\n'
+        '    <subject>\n'
+        '      <term type="a">Cookery</term>\n'
+        '      <term type="z">Iraq</term>\n'
+        '    </subject>\n'
+        '    <subject>\n'
+        '      <term type="a">Food &amp; drink</term>\n'
+        '    </subject>\n'
+        '  </subjects>\n'
+        '</rec>')
+
+def test_attrs():
+    cw = Crosswalk('test2', 'rec', [
+        Rule(650, 'subject', codes='a', attrs=[
+            ('src', 'lcsh'), ('ind', ('ind2', {'0': 'zero'})),
+            ('place', ('sub', 'z'))])])
+    m = zmarc.MARC(make_marc())
+    assert cw.convert(m) == (
+        '<rec>\n'
+        '  <subject src="lcsh" ind="zero" place="Iraq">Cookery</subject>\n'
+        '  <subject src="lcsh" ind="zero">Food &amp; drink</subject>\n'
+        '</rec>')
+    # adding a rule is seen by the next conversion
+    cw.add(Rule(1, 'id'))
+    assert cw.convert(m).endswith('<id>ocm00000001</id>\n</rec>')
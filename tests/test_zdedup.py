@@ -0,0 +1,49 @@
+from PyZ3950 import zmarc, zdedup
+
+from .fixtures import make_marc
+
+def test_normalizers():
+    assert zmarc.normalize_isbn('0-312-03309-5 (pbk.)') == '9780312033095'
+    assert zmarc.normalize_issn('0317-8471') == '03178471'
+    assert zmarc.normalize_oclc('(OCoLC)ocm00012345') == '12345'
+    assert zmarc.normalize_lccn('n 79-21164') == 'n79021164'
+    assert zmarc.normalize_isbn('12X4567890') is None
+    assert zmarc.normalize_isbn('(pbk.)') is None
+    assert zmarc.normalize_issn('0317') is None
+
+def test_invalid_ids_unkeyed():
+    assert zdedup.isbn_keys(zmarc.MARC(make_marc(None, isbn='(pbk.)'))) == []
+    assert zdedup.isbn_keys(zmarc.MARC(make_marc(None, isbn=' '))) == []
+    d = zdedup.Deduper()
+    d.add(make_marc(None, isbn='(pbk.)', title='One book'))
+    assert d.add(make_marc(None, isbn='(pbk.)', title='Another book')) [1:] == (1, 0)
+
+def test_oclc_keys():
+    assert zdedup.oclc_keys(zmarc.MARC(make_marc(1))) == ['oclc:1']
+    assert zdedup.oclc_keys(zmarc.MARC(make_marc(1, org='OCoLC'))) == [
+        'oclc:1']
+    # another agency's control number, whatever it looks like
+    assert zdedup.oclc_keys(zmarc.MARC(make_marc(1, org='DLC'))) == []
+    d = zdedup.Deduper()
+    d.add(make_marc(1, org='DLC', title='One book'))
+    assert d.add(make_marc(1, org='DLC', title='Another book')) [1:] == (
+        1, 0)
+
+def test_clusters():
+    d = zdedup.Deduper()
+    assert d.add(make_marc(1, isbn='0312033095')) == (0, 0, 0)
+    assert d.add(make_marc(None, isbn='9780312033095')) [1:] == (0, 1)
+    assert d.add(make_marc(None, title='Oldest cuisine in the world',
+                           nonfiling='0', date='c2004')) [1:] == (0, 1)
+    assert d.add(make_marc(None, title='Another book')) [1:] == (3, 0)
+    assert d.add('not MARC') [1:] == (4, 0)
+    # joins the clusters of records 0 and 3
+    d.add(make_marc(1, title='Another book'))
+    assert d.cluster(3) == 0
+    assert (d.records, d.duplicates, d.merges, d.unkeyed) == (6, 3, 1, 1)
+
+def test_bounded_index():
+    d = zdedup.Deduper(maxKeys=2)
+    recs = [make_marc(None, title='Book %d' % i) for i in range(5)]
+    assert list(d.dedup(recs + recs[-1:])) == recs
+    assert len(d._index) == 2
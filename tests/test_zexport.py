@@ -0,0 +1,78 @@
+import io
+
+import pytest
+
+from PyZ3950 import zexport, zmarc
+
+from .fixtures import make_marc
+
+
+class CountingFile(io.BytesIO):
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.writes = 0
+
+    def write(self, b):
+        self.writes += 1
+        return io.BytesIO.write(self, b)
+
+
+def records(n, written, seen, bad=()):
+    """Yield n raw MARC records (those numbered in bad not MARC at
+    all), noting how many records had been written when each was
+    pulled"""
+    for i in range(n):
+        seen.append(written.writes - 1)  # less the header
+        if i in bad:
+            yield 'not MARC'
+            continue
+        yield make_marc(i)
+
+
+def test_export_window():
+    f = CountingFile()
+    seen = []
+    stats = zexport.export(records(20, f, seen),
+                           [zexport.Sink(f, 'MARCXML')],
+                           workers=2, window=3)
+    assert (stats.records, stats.errors) == (20, 0)
+    # a full window is drained before the next record is pulled
+    for (i, written) in enumerate(seen):
+        assert i - written <= 2
+    out = f.getvalue().decode('utf-8')
+    assert out.count('<record') == 20
+    assert (out.index('ocm00000001<') < out.index('ocm00000002<') <
+            out.index('ocm00000019<'))
+
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_export_errors(workers):
+    f = io.BytesIO()
+    stats = zexport.export(records(5, CountingFile(), [], bad=(2,)),
+                           [zexport.Sink(f, 'MARCXML')], workers=workers)
+    assert (stats.records, stats.errors) == (4, 1)
+    assert b'ocm00000002<' not in f.getvalue()
+
+
+@pytest.mark.parametrize('fmt', ['MARCXML', 'OAI-MARC'])
+def test_export_matches_writer(fmt):
+    """export's XML collections are those zmarc.MARCXMLWriter writes"""
+    recs = [make_marc(i) for i in range(3)]
+    f = io.BytesIO()
+    zexport.export(recs, [zexport.Sink(f, fmt)])
+    g = io.BytesIO()
+    writer = zmarc.MARCXMLWriter(g, fmt)
+    for rec in recs:
+        writer.write(rec)
+    writer.close()
+    assert f.getvalue() == g.getvalue()
+
+
+def test_export_mods():
+    f = io.BytesIO()
+    zexport.export([make_marc()], [zexport.Sink(f, 'MODS')])
+    out = f.getvalue().decode('utf-8')
+    assert out.startswith('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<modsCollection xmlns="http://www.loc.gov/mods/v3">\n'
+                          '<mods>\n')
+    assert out.endswith('</mods>\n</modsCollection>\n')
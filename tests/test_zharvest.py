@@ -0,0 +1,88 @@
+import pytest
+from PyZ3950 import zharvest
+
+def test_read_jobs():
+    jobs = zharvest.read_jobs([
+        '# comment',
+        '',
+        'z3950.loc.gov:7090:Voyager CCL ti=cookery and au=bottero',
+        'z3950.loc.gov:7090:Voyager PQF @attr 1=4 cookery',
+    ])
+    assert len(jobs) == 2
+    assert jobs[0].port == 7090
+    assert jobs[0].dbname == 'Voyager'
+    assert jobs[0].query == 'ti=cookery and au=bottero'
+    assert jobs[0].key != jobs[1].key
+    # keys must be stable across runs, for checkpoints
+    again = zharvest.read_jobs(['z3950.loc.gov:7090:Voyager PQF @attr 1=4 cookery'])
+    assert again[0].key == jobs[1].key
+
+def test_read_jobs_bad_line():
+    with pytest.raises(zharvest.HarvestError):
+        zharvest.read_jobs(['z3950.loc.gov:7090:Voyager'])
+
+GOOD_JOB = 'z3950.loc.gov:7090:Voyager PQF cookery\n'
+
+@pytest.mark.parametrize('args, jobs, msg', [
+    (['-f', 'XYZ'], GOOD_JOB, 'Unknown output format XYZ'),
+    (['-w', 'four'], GOOD_JOB, "option -w: 'four' is not a number"),
+    ([], GOOD_JOB + 'z3950.loc.gov:7090:Voyager\n',
+     'line 2: expected target, query type and query')])
+def test_main_bad_input(tmp_path, capsys, args, jobs, msg):
+    jobfile = tmp_path / 'jobs'
+    jobfile.write_text(jobs)
+    assert zharvest.main(args + ['-o', str(tmp_path), str(jobfile)]) == 2
+    err = capsys.readouterr().err
+    assert err.startswith(msg + '\n')
+    assert 'Usage: pyz3950-harvest' in err
+
+def test_main_no_job_file(tmp_path, capsys):
+    assert zharvest.main([str(tmp_path / 'missing')]) == 2
+    assert 'Usage: pyz3950-harvest' in capsys.readouterr().err
+
+def test_manifest(tmp_path):
+    path = str(tmp_path / 'job.manifest')
+    manifest = zharvest.Manifest(path)
+    assert manifest.since() is None
+    manifest.note('DLC:1', '20240301120000.0')
+    manifest.note('DLC:2', '20240115000000.0')
+    size = manifest.flush()
+    manifest.note('DLC:3', '20240401000000.0')
+    manifest.flush()
+    manifest.truncate(size)  # e.g. resuming from a checkpoint
+    assert len(manifest) == 2
+    assert manifest.since() == '20240229'
+    manifest = zharvest.Manifest(path)
+    assert not manifest.changed('DLC:1', '20240301120000.0')
+    assert manifest.changed('DLC:1', '20240302000000.0')
+    assert manifest.changed('DLC:3', '20240401000000.0')
+
+def test_manifest_compaction(tmp_path):
+    path = str(tmp_path / 'job.manifest')
+    manifest = zharvest.Manifest(path)
+    for i in range(3000):
+        manifest.note('DLC:1', '2024%04d' % i)
+    size = manifest.flush()  # checkpointed
+    manifest.note('DLC:2', '20240101')
+    manifest.flush()
+    # loading doesn't move lines a checkpoint's sizes refer to
+    manifest = zharvest.Manifest(path)
+    manifest.truncate(size)
+    assert len(manifest) == 1
+    assert not manifest.changed('DLC:1', '20242999')
+    manifest.compact()
+    assert len(open(path).readlines()) == 1
+    assert not zharvest.Manifest(path).changed('DLC:1', '20242999')
+
+def test_target_stats_threads():
+    import threading
+    stats = zharvest.TargetStats('host:210')
+    def work():
+        for i in range(1000):
+            stats.add(records=1, bytes=10)
+    threads = [threading.Thread(target=work) for i in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert (stats.records, stats.bytes) == (8000, 80000)
@@ -0,0 +1,166 @@
+import io
+
+import pytest
+
+from PyZ3950 import zmarc
+
+from .fixtures import make_marc
+
+def test_lazy_matches_eager():
+    raw = make_marc()
+    eager = zmarc.MARC(raw)
+    for data in (raw, raw.encode('latin-1'), memoryview(raw.encode('latin-1'))):
+        lazy = zmarc.LazyMARC(data)
+        assert lazy.fields[245] == eager.fields[245]
+        assert 999 not in lazy.fields
+        assert lazy.fields == eager.fields
+        assert list(lazy.fields.keys()) == list(eager.fields.keys())
+        assert lazy.get_MARC() == raw
+
+def test_lazy_fields_mutable():
+    lazy = zmarc.LazyMARC(make_marc().encode('latin-1'))
+    del lazy.fields[650]
+    lazy.fields[500] = [(' ', ' ', [('a', 'Translation.')])]
+    assert 650 not in lazy.fields
+    assert sorted(lazy.fields) == [0, 1, 8, 100, 245, 260, 500, 600]
+
+def test_reader(tmp_path):
+    recs = [make_marc(n).encode('latin-1') for n in range(5)]
+    bad = bytearray(recs[2])
+    bad[3] = ord('x') # garbled length: recovered from the terminator
+    recs[2] = bytes(bad)
+    data = recs[0] + b'\n' + b''.join(recs[1:]) + b'junk'
+    path = tmp_path / 'recs.mrc'
+    path.write_bytes(data)
+    for kw in ({}, {'use_mmap': 0, 'bufsize': 64}, {'lazy': 1}):
+        reader = zmarc.MARCReader(str(path), strict=0, **kw)
+        assert [m.fields[1][0] for m in reader] == [
+            'ocm%08d' % n for n in range(5)]
+        assert (reader.recovered, reader.skipped) == (1, 1)
+        reader.close()
+    offsets = [offset for (offset, raw) in
+               zmarc.MARCReader(io.BytesIO(data)).iter_raw()]
+    assert offsets[:2] == [0, len(recs[0]) + 1]
+
+def test_index(tmp_path):
+    path = str(tmp_path / 'recs.mrc')
+    with open(path, 'wb') as f:
+        for n in range(50):
+            f.write(make_marc(n).encode('latin-1'))
+    idx = zmarc.MARCIndex(path, keys=['001', '245$a'], chunkEntries=16)
+    assert len(idx) == 50
+    assert idx['ocm00000007'].fields[1] == ['ocm00000007']
+    assert 'ocm00000050' not in idx
+    assert len(idx.lookup('The oldest cuisine in the world :',
+                          key='245$a')) == 50
+    idx.close()
+    with open(path, 'ab') as f:
+        f.write(make_marc(50).encode('latin-1'))
+    idx = zmarc.MARCIndex(path, keys=['001', '245$a'])
+    assert len(idx) == 51
+    assert idx.get('ocm00000050').fields[1] == ['ocm00000050']
+    assert idx.update() == 0
+    idx.close()
+
+def test_index_recovered_and_functions(tmp_path):
+    recs = [make_marc(n).encode('latin-1') for n in range(3)]
+    bad = bytearray(recs[1])
+    bad[2] = ord('1') # leader length garbled, too short
+    recs[1] = bytes(bad)
+    path = str(tmp_path / 'recs.mrc')
+    with open(path, 'wb') as f:
+        f.write(b''.join(recs))
+    # two lambdas don't collide: unnamed functions go by position
+    first = lambda m: [m.fields[1][0][:5]]
+    last = lambda m: [m.fields[1][0][-3:]]
+    idx = zmarc.MARCIndex(path, keys=['001', first, last,
+                                      ('title', lambda m: ['t'])])
+    assert idx.keys == ['001', 'fn1', 'fn2', 'title']
+    assert idx['ocm00000001'].fields[650] == zmarc.MARC(
+        make_marc(1)).fields[650]
+    assert idx['ocm00000002'].fields[1] == ['ocm00000002']
+    assert len(idx.lookup('ocm00', key=first)) == 3
+    assert len(idx.lookup('001', key=last)) == 1
+    assert len(idx.lookup('001', key='fn2')) == 1
+    assert len(idx.lookup('t', key='title')) == 3
+    idx.close()
+    with pytest.raises(ValueError):
+        zmarc.MARCIndex(path, keys=['001', ('001', first)])
+
+def test_writer():
+    raw = make_marc()
+    marc = zmarc.MARC(raw)
+    assert marc.leader() == raw[:24]
+    assert raw[24 + 12 * 8] == '\x1e' # directory terminator
+    marc.fields[500] = [(' ', ' ', [('a', 'Translated from the French —')])]
+    out = io.BytesIO()
+    assert zmarc.write_records([raw, marc], out, encoding='utf-8') == 2
+    data = out.getvalue()
+    assert data[:len(raw)] == raw.encode('latin-1')
+    second = data[len(raw):]
+    assert int(second[:5]) == len(second)
+    assert zmarc.LazyMARC(second).fields[245] == marc.fields[245]
+
+def test_marcxml_round_trip():
+    marc = zmarc.MARC(make_marc())
+    marc.fields[500] = [(' ', ' ', [('a', 'Fish & <chips>')])]
+    out = io.BytesIO()
+    writer = zmarc.MARCXMLWriter(out)
+    writer.write(marc)
+    writer.write(make_marc(2))
+    writer.close()
+    recs = list(zmarc.MARCXMLReader(io.BytesIO(out.getvalue())))
+    assert len(recs) == 2
+    assert recs[0].fields == marc.fields
+    assert recs[1].fields[1] == ['ocm00000002']
+
+def test_marc8_to_unicode():
+    conv = zmarc.MARC8_to_Unicode()
+    assert conv.translate('Cookery, Assyro-Babylonian.') == 'Cookery, Assyro-Babylonian.'
+    assert conv.translate('Cookery\x1e') == 'Cookery'
+    # combining marks come first in MARC-8, and are composed
+    assert conv.translate('Bott\xe2ero') == 'Bott\xe9ro'
+    assert conv.translate('Gr\xe8u\x1fssen') == 'Gr\xfcssen'
+    # a mark carries over an escape to the next set's character
+    assert conv.translate('\xe2\x1b((Ne\x1b((B') == 'Е́'
+    assert conv.translate(' \x1b$$1!M>!`o!#!\x1b((B/ Huang') == ' 盤飾　/ Huang'
+    # space is in every G0 set
+    assert conv.translate('\x1b((Nab cd\x1b((B') == 'АБ ЦД'
+
+def test_marc8_tables():
+    from PyZ3950 import marc_to_unicode
+    ansel = marc_to_unicode.codesets[0x45]
+    assert ansel[0xe2] == (0x301, 1)
+    assert ansel.get(0xa0) is None
+    assert 0xa1 in ansel and 0x41 not in ansel
+    eacc = marc_to_unicode.codesets[0x31]
+    assert len(eacc) == 15739
+    assert eacc[0x212321] == eacc[0x212321] == (0x3000, 0)
+
+def test_selector():
+    raw = make_marc()
+    for marc in (zmarc.MARC(raw), zmarc.LazyMARC(raw)):
+        assert zmarc.selector('245$a')(marc) == ['The oldest cuisine in the world :']
+        assert zmarc.selector('650[ind2=0]$a$z').select(marc) == [
+            'Cookery Iraq', 'Food & drink']
+        assert zmarc.selector('650[ind1=#,ind2=4]$a').select(marc) == []
+        assert zmarc.selector('008/07-10').first(marc) == '2004'
+        assert zmarc.selector('6XX$z').values(marc) == ['Iraq']
+        assert zmarc.selector('1XX').occurrences(marc) == [
+            (100, '1', ' ', ['Bottero, Jean.', '1914-'])]
+        assert zmarc.selector('650').count(marc) == 2
+    assert zmarc.selector('245$ab') is zmarc.selector('245$ab')
+    for spec in ('008$a', '245/7', '24$', '650[ind3=1]'):
+        with pytest.raises(ValueError):
+            zmarc.Selector(spec)
+    recs = [make_marc(n) for n in range(3)]
+    assert zmarc.selector('001').batch(recs) == [
+        ['ocm00000000'], ['ocm00000001'], ['ocm00000002']]
+    assert list(zmarc.select_all(['001', '100$d'], recs[:1])) == [
+        [['ocm00000000'], ['1914-']]]
+
+def test_record_get_field():
+    from PyZ3950 import z3950, zoom
+    rec = zoom.Record(z3950.Z3950_RECSYN_USMARC_ov, make_marc(), 'db')
+    assert rec.get_field('245$b') == ['cooking in Mesopotamia /']
+    assert rec.get_fieldcount() == 8
@@ -0,0 +1,521 @@
+import gc
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from PyZ3950 import oids, z3950, zmarc, zoom, zprofile
+
+from .fixtures import make_marc
+
+
+class StubClient:
+    """Stands in for z3950.Client: a target where every search finds
+    records, a list of raw MARC records"""
+    options = ('namedResultSets',)
+
+    def __init__(self, records, host='stub', port=210, **kw):
+        self.records = records
+        self.host = host
+        self.sock = object()
+        self.initresp = SimpleNamespace()
+        self.search_results = {}
+        self.presents = []
+        self.deleted = []
+        self.sorts = []
+        self.sort_diag = None  # a Bib-1 condition to refuse sorts with
+        self.closed = 0
+
+    def get_option(self, name):
+        return name in self.options
+
+    def set_dbnames(self, dbnames):
+        pass
+
+    def search_2(self, query, rsn, **kw):
+        self.search_results[rsn] = len(self.records)
+        return SimpleNamespace(resultCount=len(self.records))
+
+    def present(self, start, count, rsn, **kw):
+        self.presents.append((start, count))
+        recs = []
+        for data in self.records[start - 1:start - 1 + count]:
+            ext = SimpleNamespace(
+                direct_reference=oids.Z3950_RECSYN_USMARC_ov,
+                encoding=('octet-aligned', data))
+            recs.append(SimpleNamespace(name='db',
+                                        record=('retrievalRecord', ext)))
+        return SimpleNamespace(records=('responseRecords', recs),
+                               numberOfRecordsReturned=len(recs))
+
+    def transact(self, req, expected):
+        assert req[0] == 'sortRequest'
+        self.sorts.append(req[1])
+        if self.sort_diag is not None:
+            diag = SimpleNamespace(condition=self.sort_diag, addinfo='',
+                                   diagnosticSetId=z3950.Z3950_DIAG_BIB1_ov)
+            return SimpleNamespace(diagnostics=[('defaultFormat', diag)])
+        return SimpleNamespace(resultCount=len(self.records))
+
+    def delete_many(self, names):
+        self.deleted.extend(names)
+
+    def close(self):
+        self.closed = 1
+        self.sock = None
+
+
+class StubTarget:
+    """Makes StubClients, all finding records"""
+    def __init__(self):
+        self.records = [make_marc(n) for n in range(5)]
+        self.clients = []
+
+    def client(self, host, port, optionslist=None, **kw):
+        cli = StubClient(self.records, host, port)
+        self.clients.append(cli)
+        return cli
+
+
+@pytest.fixture
+def stub_target(monkeypatch):
+    """Make Connections talk to StubClients"""
+    target = StubTarget()
+    monkeypatch.setattr(z3950, 'Client', target.client)
+    return target
+
+
+def test_result_set_slice(stub_target):
+    conn = zoom.Connection('stub', 210)
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    recs = rs[1:3]
+    assert [r.get_field('001') for r in recs] == [
+        ['ocm00000001'], ['ocm00000002']]
+    assert [r.get_field('001') for r in rs[-2:]] == [
+        ['ocm00000003'], ['ocm00000004']]
+    assert len(rs[::2]) == 3
+
+
+def test_mirror_group_fetch(stub_target):
+    group = zoom.MirrorGroup([('a', 210), ('b', 210)])
+    recs = group.fetch(zoom.Query('PQF', 'cookery'), 1, 3)
+    assert [r.get_field('001') for r in recs] == [
+        ['ocm00000001'], ['ocm00000002'], ['ocm00000003']]
+    assert len(group.fetch(zoom.Query('PQF', 'cookery'))) == 5
+    group.close()
+
+
+def titled(titles):
+    """Records with the 245 $a titles (None for no 245), numbered from 0"""
+    return [make_marc(n, title=title, nonfiling='0')
+            for (n, title) in enumerate(titles)]
+
+
+def test_local_sort(stub_target):
+    stub_target.records[:] = titled(
+        ['cookery', 'Apples', 'bread', None, 'apples'])
+    conn = zoom.Connection('stub', 210, presentChunk=2)
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    srs = rs.sort([zoom.SortKey(type='marc', sequence='245$a')])
+    # case insensitive and stable; missing values last
+    assert [r.get_field('001')[0] for r in srs[:]] == [
+        'ocm00000001', 'ocm00000004', 'ocm00000002', 'ocm00000000', 'ocm00000003']
+    srs = rs.sort([zoom.SortKey(type='marc', sequence='245$a',
+                                relation='descending')])
+    assert [r.get_field('001')[0] for r in srs[:]] == [
+        'ocm00000000', 'ocm00000002', 'ocm00000001', 'ocm00000004', 'ocm00000003']
+    srs = rs.sort([zoom.SortKey(type='marc', sequence='245$a',
+                                missingValueData='b')])
+    assert [r.get_field('001')[0] for r in srs[:]] == [
+        'ocm00000001', 'ocm00000004', 'ocm00000003', 'ocm00000002', 'ocm00000000']
+    with pytest.raises(zoom.ZoomError):
+        rs.sort([zoom.SortKey(type='marc', sequence='245$a',
+                              missingValueAction='abort')])
+
+
+def test_local_sort_spills(stub_target):
+    titles = ['t%03d' % ((n * 37) % 100) for n in range(100)]
+    stub_target.records[:] = titled(titles)
+    conn = zoom.Connection('stub', 210, presentChunk=10)
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    rs[0]  # the first present's records are kept
+    cached = rs._cached()
+    assert len(cached) == 10
+    srs = zoom.SortedResultSet(
+        rs, [zoom.SortKey(type='marc', sequence='245$a')],
+        memorySortLimit=7)
+    # the others were dropped as their keys were taken
+    assert rs._cached() == cached
+    assert [r.get_field('245$a')[0] for r in srs[:]] == [
+        t + ' :' for t in sorted(titles)]
+
+
+def test_server_sort(stub_target):
+    """Keys only the server understands go to it, whatever it claims,
+    and its diagnostics are raised"""
+    conn = zoom.Connection('stub', 210)
+    conn.profileStore = zprofile.MemoryStore()
+    conn._profile = zprofile.Profile(('stub', 210))
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    key = zoom.SortKey(type='private', sequence='title')
+    assert len(rs.sort([key])) == 5
+    cli = conn._cli
+    assert len(cli.sorts) == 1
+    cli.sort_diag = 211  # too many sort keys: not worth remembering
+    with pytest.raises(zoom.Bib1Err) as info:
+        rs.sort([key])
+    assert info.value.condition == 211
+    assert conn._profile.get('serverSort') is None
+    cli.sort_diag = 209  # no generic sort
+    with pytest.raises(zoom.Bib1Err):
+        rs.sort([key])
+    assert conn._profile.get('serverSort') == 0
+    # ... but it's still asked, as only it can sort by such keys
+    with pytest.raises(zoom.Bib1Err):
+        rs.sort([key])
+    assert len(cli.sorts) == 4
+    # marc keys are always sorted here
+    srs = rs.sort([zoom.SortKey(type='marc', sequence='245$a')])
+    assert isinstance(srs, zoom.SortedResultSet)
+    assert len(cli.sorts) == 4
+
+
+def test_sort_closed_connection(stub_target):
+    conn = zoom.Connection('stub', 210)
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    rs[:]
+    conn._cli = None  # dropped
+    key = zoom.SortKey(type='private', sequence='title')
+    # sent, on a new connection, where the set is no more
+    with pytest.raises(zoom.ConnectionError):
+        rs.sort([key])
+
+
+def fake_scan_all(words, calls):
+    """A Connection.scan_all walking words, a sorted index"""
+    def scan_all(self, query, numberOfEntries=200, stop=None):
+        start = zoom._scan_start_term(query.query)[1]
+        calls.append(start)
+        for w in words:
+            if w < start:
+                continue
+            time.sleep(0.001)
+            if stop is not None and stop(('general', w)):
+                return
+            yield {'term': ('general', w)}
+    return scan_all
+
+
+def test_scan_partitioned(stub_target, monkeypatch):
+    words = sorted('%s%d' % (c, n) for c in 'abcdefghij' for n in range(5))
+    calls = []
+    monkeypatch.setattr(zoom.Connection, 'scan_all',
+                        fake_scan_all(words, calls))
+    conn = zoom.Connection('stub', 210)
+    terms = [d['term'][1] for d in conn.scan_partitioned(
+        zoom.Query('PQF', 'a'), boundaries='bcdefghij', connections=3)]
+    assert terms == words
+    with pytest.raises(zoom.ClientNotImplError):
+        list(conn.scan_partitioned(zoom.Query('PQF', '@and a b')))
+
+
+def test_scan_partitioned_abandoned(stub_target, monkeypatch):
+    words = sorted('%s%d' % (c, n) for c in 'abcdefghij' for n in range(50))
+    calls = []
+    monkeypatch.setattr(zoom.Connection, 'scan_all',
+                        fake_scan_all(words, calls))
+    conn = zoom.Connection('stub', 210)
+    gen = conn.scan_partitioned(zoom.Query('PQF', 'a'),
+                                boundaries='bcdefghij', connections=2)
+    next(gen)
+    gen.close()
+    clones = stub_target.clients[1:]
+    deadline = time.time() + 5
+    while (not all(cli.closed for cli in clones) and
+           time.time() < deadline):
+        time.sleep(0.01)
+    assert len(clones) == 2
+    assert all(cli.closed for cli in clones)
+    assert len(calls) < 10
+
+
+def test_collected_result_sets_deleted(stub_target):
+    conn = zoom.Connection('stub', 210)
+    sets = [conn.search(zoom.Query('PQF', 'cookery')) for i in range(2)]
+    names = set(rs._resultSetName for rs in sets)
+    del sets
+    gc.collect()
+    # one name is reused, the other deleted before searching
+    rs = conn.search(zoom.Query('PQF', 'bread'))
+    deleted = stub_target.clients[0].deleted
+    assert len(deleted) == 1
+    assert set(deleted + [rs._resultSetName]) == names
+
+
+def test_result_sets_evicted(stub_target):
+    conn = zoom.Connection('stub', 210, maxResultSets=2)
+    sets = [conn.search(zoom.Query('PQF', 'cookery')) for i in range(3)]
+    # the least recently used name is taken for the new set
+    assert sets[2]._resultSetName == sets[0]._resultSetName
+    assert sets[2][0].get_field('001') == ['ocm00000000']
+    with pytest.raises(zoom.ConnectionError):
+        sets[0][0]
+    sets[1][0]  # now sets[2] is least recently used
+    rs = conn.search(zoom.Query('PQF', 'bread'))
+    assert rs._resultSetName == sets[2]._resultSetName
+    assert sets[2]._evicted
+    assert '_evicted' not in sets[1].__dict__
+
+
+def test_delete_closes_dropped_client(stub_target):
+    conn = zoom.Connection('stub', 210)
+    sets = [conn.search(zoom.Query('PQF', 'cookery')) for i in range(2)]
+    old = stub_target.clients[0]
+
+    def delete_many(names):
+        raise zoom.ConnectionError('closed on delete')
+    old.delete_many = delete_many
+    del sets
+    gc.collect()
+    conn.search(zoom.Query('PQF', 'bread'))
+    assert old.closed
+    assert len(stub_target.clients) == 2
+    assert conn.deleteResultSets == 0
+
+
+def or_leaves(rpn, depth=1):
+    """Return [(term, depth)] for the leaves of an ORed RPN tree"""
+    (typ, val) = rpn
+    if typ == 'op':
+        return [(val[1].term[1], depth)]
+    assert val.op[0] == 'or'
+    return or_leaves(val.rpn1, depth + 1) + or_leaves(val.rpn2, depth + 1)
+
+
+def test_mk_or_query():
+    (typ, rpnq) = zoom._mk_or_query(['t%d' % i for i in range(9)], 1, 7)
+    assert typ == 'type_1'
+    leaves = or_leaves(rpnq.rpn)
+    assert [t for (t, depth) in leaves] == ['t%d' % i for i in range(9)]
+    assert max(depth for (t, depth) in leaves) == 5  # balanced
+    (typ, rpnq) = zoom._mk_or_query(['t0'], 1, 1211)
+    assert or_leaves(rpnq.rpn) == [('t0', 1)]
+
+
+def test_learn_max_terms():
+    assert zoom._learn_max_terms(zoom.Bib1Err(5, '', '10'), 20) == 10
+    # a limit on operators allows one more term
+    assert zoom._learn_max_terms(zoom.Bib1Err(6, '', '3'), 20) == 4
+    assert zoom._learn_max_terms(zoom.Bib1Err(5, '', None), 20) == 10
+    assert zoom._learn_max_terms(zoom.Bib1Err(5, '', '50'), 20) == 10
+    assert zoom._learn_max_terms(zoom.Bib1Err(11, '', ''), 1) == 1
+
+
+def test_marc_ids_oclc():
+    def ids(ctl, org=None):
+        m = zmarc.MARC(make_marc(ctl, org=org, fields={
+            35: [(' ', ' ', [('a', '(OCoLC)00042')])]}))
+        return zoom._marc_ids(m, 1211)
+    assert ids('ocm00012345') == ['12345', '42']
+    assert ids('12345', 'OCoLC') == ['12345', '42']
+    # a local control number isn't an OCLC number
+    assert ids('12345', 'DLC') == ['42']
+    assert ids('ocm00012345', 'DLC') == ['42']
+    assert ids('12345') == ['42']
+
+
+def test_lookup_many_backoff(stub_target, monkeypatch):
+    isbns = ['0312033095', '9780140449136', '0-19-283398-X']
+    stub_target.records[:] = [make_marc(n, isbn=isbn)
+                              for (n, isbn) in enumerate(isbns)]
+    searched = []
+
+    def search_2(self, query, rsn, **kw):
+        terms = [t for (t, depth) in or_leaves(query[1].rpn)]
+        searched.append(len(terms))
+        if len(terms) > 2:
+            raise zoom.Bib1Err(5, 'Too many boolean operators', '')
+        self.search_results[rsn] = len(self.records)
+        return SimpleNamespace(resultCount=len(self.records))
+    monkeypatch.setattr(StubClient, 'search_2', search_2)
+    conn = zoom.Connection('stub', 210, maxQueryTerms=4)
+    found = conn.lookup_many(['978-0-312-03309-5', '0140449132',
+                              '019283398X', '(pbk.)'])
+    assert searched == [4, 2, 2]
+    assert conn.maxQueryTerms == 2
+    assert [r.get_field('001') for r in found['978-0-312-03309-5']] == [
+        ['ocm00000000']]
+    assert [r.get_field('001') for r in found['0140449132']] == [['ocm00000001']]
+    assert [r.get_field('001') for r in found['019283398X']] == [['ocm00000002']]
+    assert found['(pbk.)'] == []
+
+
+def test_limiter_aimd():
+    lim = zoom.AIMDLimiter(initial=2, minimum=1)
+    t1 = lim._acquire()
+    t2 = lim._acquire()
+    lim._release('search', t1, 0)  # healthy, with the limit in use
+    assert lim.limit == 2.5
+    t3 = lim._acquire()
+    # two congested requests from the same round cut only once
+    lim._release('search', t2, 1)
+    lim._release('search', t3, 1)
+    assert lim.stats()['limit'] == 1.25
+    t4 = lim._acquire()
+    lim._release('search', t4, 1)
+    assert lim.limit == 1
+
+    def busy():
+        raise zoom.Bib1Err(1018, 'Too busy', '')  # resources
+    # at the minimum: space out starts instead
+    with pytest.raises(zoom.Bib1Err):
+        lim.call('search', busy)
+    assert (lim.limit, lim.interval) == (1, 0.1)
+    with pytest.raises(ValueError):
+        lim.call('search', int, 'x')
+    assert lim.call('search', int, '3') == 3
+    assert lim.interval == 0
+    stats = lim.stats()
+    assert (stats['requests'], stats['congestions'], stats['failures'],
+            stats['inflight']) == (7, 4, 1, 0)
+    assert '7 requests, 4 congested, 1 failed' in str(lim)
+
+
+def test_limiter_threads():
+    lim = zoom.AIMDLimiter(initial=4, maximum=8)
+
+    def work():
+        for i in range(200):
+            lim.call('present', int, '1')
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert lim.stats()['requests'] == 800
+    assert lim.inflight() == 0
+
+
+def test_timeout_counts_as_congestion():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)  # accepts, but never answers the init
+    try:
+        lim = zoom.AIMDLimiter()
+        with pytest.raises(zoom.ConnectionError):
+            zoom.Connection('127.0.0.1', listener.getsockname()[1],
+                            timeout=0.2, limiter=lim)
+        assert lim.stats()['congestions'] == 1
+    finally:
+        listener.close()
+
+
+def test_transcoded_records(stub_target):
+    stub_target.records[:] = titled(['Title %d' % n for n in range(5)])
+    conn = zoom.Connection('stub', 210, preferredRecordSyntax='MARCXML')
+    rs = conn.search(zoom.Query('PQF', 'cookery'))
+    rec = rs[0]
+    assert rec.syntax == 'MARCXML'
+    assert '<subfield code="a">Title 0 :</subfield>' in rec.data
+    cli = stub_target.clients[0]
+    assert cli.presents == [(1, 5)]
+    # made from the cached MARC, without another present
+    rs.preferredRecordSyntax = 'DC'
+    assert '<title>Title 1 : cooking in Mesopotamia /</title>' in rs[1].data
+    assert cli.presents == [(1, 5)]
+
+
+def test_record_lazy(monkeypatch):
+    calls = []
+
+    def parse(data):
+        calls.append(data)
+        return zmarc.MARC(data)
+    monkeypatch.setattr(zoom._record_type_dict['USMARC'], 'parse', parse)
+    raw = make_marc(3, title='Title 3')
+    rec = zoom.Record(oids.Z3950_RECSYN_USMARC_ov, raw, 'db')
+    assert 'data' not in rec.__dict__
+    assert rec.get_field('245$a') == ['Title 3 :']
+    assert rec.get_field('001') == ['ocm00000003']
+    assert rec.get_fieldcount() == 8
+    assert 'Title 3' in str(rec)
+    assert calls == [raw]  # parsed once
+    assert rec.data == raw
+
+
+def test_single_flight():
+    flights = zoom.SingleFlight()
+    started = threading.Event()
+    go = threading.Event()
+    calls = []
+    results = []
+
+    def slow(val):
+        calls.append(val)
+        started.set()
+        go.wait()
+        if val == 'bad':
+            raise ValueError(val)
+        return val
+
+    def call(key, val):
+        try:
+            results.append(flights.do(key, slow, val))
+        except ValueError as err:
+            results.append(err)
+    threads = [threading.Thread(target=call, args=('k', 'first'))]
+    threads[0].start()
+    started.wait()
+    threads += [threading.Thread(target=call, args=('k', 'second'))
+                for i in range(3)]
+    for th in threads[1:]:
+        th.start()
+    time.sleep(0.05)  # let them join the flight
+    go.set()
+    for th in threads:
+        th.join()
+    assert calls == ['first']
+    assert results == ['first'] * 4
+    # nothing is remembered; exceptions go to every waiter
+    go.clear()
+    started.clear()
+    threads = [threading.Thread(target=call, args=('k', 'bad'))
+               for i in range(2)]
+    threads[0].start()
+    started.wait()
+    threads[1].start()
+    time.sleep(0.05)
+    go.set()
+    for th in threads:
+        th.join()
+    assert calls == ['first', 'bad']
+    assert [str(err) for err in results[4:]] == ['bad', 'bad']
+
+
+def test_opac_holdings():
+    def ext(oid, data):
+        return SimpleNamespace(direct_reference=oid,
+                               encoding=('octet-aligned', data))
+    opac_data = SimpleNamespace(
+        bibliographicRecord=ext(oids.Z3950_RECSYN_USMARC_ov,
+                                make_marc(1)),
+        holdingsData=[
+            ('marcHoldingsRecord', ext(oids.Z3950_RECSYN_USMARC_ov,
+                                       make_marc(2))),
+            ('marcHoldingsRecord', ext(oids.Z3950_RECSYN_SUTRS_ov,
+                                       'not MARC')),
+            ('holdingsAndCirc', SimpleNamespace(callNumber='QA76'))])
+    opac = zoom.OPAC(opac_data)
+    assert opac.bib_marc.fields[1] == ['ocm00000001']
+    assert opac.bib_marc is opac.bib_marc
+    marc = opac.get_holdings_marc(0)
+    assert marc.fields[1] == ['ocm00000002']
+    assert opac.get_holdings_marc(0) is marc
+    assert opac.get_holdings_marc(1) is None
+    assert opac.get_holdings_marc(2) is None
+    s = str(opac)
+    assert 'Unknown holdings OID' in s and 'QA76' in s
+    opac_data.bibliographicRecord = ext(oids.Z3950_RECSYN_SUTRS_ov, 'text')
+    assert zoom.OPAC(opac_data).bib_marc is None
@@ -0,0 +1,68 @@
+import json
+import os
+from PyZ3950 import z3950, zprofile
+
+def make_initresp(version='1.0'):
+    initresp = z3950.InitializeResponse()
+    initresp.options = z3950.Options()
+    initresp.options['sort'] = 1
+    initresp.implementationId = '81'
+    initresp.implementationName = 'YAZ'
+    initresp.implementationVersion = version
+    return initresp
+
+def test_file_store_round_trip(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    store = zprofile.FileStore(path)
+    profile = store.lookup('host', 210, make_initresp())
+    assert profile.options['sort'] == 1
+    assert profile.options['scan'] == 0
+    profile.learn('presentChunk', 7)
+    profile.reject_syntax('GRS-1')
+    profile.reject_use('Default', 21)
+    store.save(profile)
+
+    profile = zprofile.FileStore(path).get('host', 210)
+    assert profile.get('presentChunk') == 7
+    assert profile.rejectedSyntaxes == ['GRS-1']
+    assert profile.supports_use('Default', 21) == 0
+    assert profile.supports_use('Default', 4) is None
+
+def test_stale_profiles_discarded(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    store = zprofile.FileStore(path)
+    store.lookup('host', 210, make_initresp()).learn('maxQueryTerms', 10)
+    # a new implementation version may behave differently
+    profile = store.lookup('host', 210, make_initresp('2.0'))
+    assert profile.get('maxQueryTerms') is None
+    assert zprofile.FileStore(path, maxAge=-1).get('host', 210) is None
+
+    with open(path) as f:
+        d = json.load(f)
+    d['version'] = zprofile.PROFILE_VERSION + 1
+    with open(path, 'w') as f:
+        json.dump(d, f)
+    assert zprofile.FileStore(path).get('host', 210) is None
+
+def test_file_store_shared(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    store1 = zprofile.FileStore(path)
+    store2 = zprofile.FileStore(path)
+    store1.lookup('host1', 210, make_initresp()).learn('presentChunk', 7)
+    profile = store2.lookup('host2', 210, make_initresp())
+    profile.learn('maxQueryTerms', 10)
+    store2.save(profile)
+    # store2's saves merged in, rather than overwrote, store1's profile
+    assert store2.get('host1', 210) is not None
+    store = zprofile.FileStore(path)
+    assert store.get('host1', 210) is not None
+    assert store.get('host2', 210).get('maxQueryTerms') == 10
+    assert not os.path.exists(path + '.lock')
+
+def test_file_store_stale_lock(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    open(path + '.lock', 'w').close()
+    os.utime(path + '.lock', (0, 0))
+    store = zprofile.FileStore(path)
+    store.lookup('host', 210, make_initresp())
+    assert zprofile.FileStore(path).get('host', 210) is not None
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Packs MARC-8 code tables into the compact form used by
+PyZ3950/marc_to_unicode.py.  The input is a Python file in the form
+parse_marc_codetable.py writes, one dictionary per character set
+with the set's name as a comment,
+
+    charset_45 = { # Extended Latin (ANSEL)
+        0xa1: (0x141, 0),# UPPERCASE POLISH L / ...
+
+and a codesets dictionary mapping each set's final escape character
+to its table.  Everything after the generated-code marker in the
+output file is replaced; the hand-written code before it is kept.
+
+Usage: pack_marc8.py tables.py PyZ3950/marc_to_unicode.py
+"""
+from __future__ import print_function
+
+import re
+import sys
+import zlib
+import array
+import base64
+
+marker = '# Generated by tools/pack_marc8.py, do not edit below this line.\n'
+
+def pack (table):
+    """Return table, mapping code to (code point, combining flag), as
+    base64 of zlib compressed little-endian 32 bit words: the sorted
+    codes, then their code points with the flag in the top bit."""
+    codes = sorted (table.keys ())
+    words = array.array ('I' if array.array ('I').itemsize == 4 else 'L')
+    words.extend (codes)
+    words.extend ([table [c][0] | (table [c][1] << 31) for c in codes])
+    if sys.byteorder == 'big':
+        words.byteswap ()
+    return base64.b64encode (zlib.compress (words.tobytes (), 9))
+
+def main (src, dst):
+    text = open (src).read ()
+    names = dict (re.findall (r'^charset_(\w+) = \{ *# *(.*?) *$', text, re.M))
+    tables = {}
+    exec (text, tables)
+    with open (dst) as f:
+        head = f.read ().split (marker) [0]
+    out = [head, marker, '\n_packed = {\n']
+    for (final, table) in sorted (tables ['codesets'].items ()):
+        name = [n for n in names if tables ['charset_' + n] is table] [0]
+        data = pack (table).decode ('ascii')
+        out.append ('    0x%02X: (%r, # %d codes\n' %
+                    (final, names [name], len (table)))
+        for i in range (0, len (data), 64):
+            out.append ("        b'%s'\n" % data [i:i + 64])
+        out [-1] = out [-1] [:-1] + '),\n'
+    out.append ('}\n\ncodesets = _charsets ()\n')
+    with open (dst, 'w') as f:
+        f.write (''.join (out))
+
+if __name__ == '__main__':
+    if len (sys.argv) != 3:
+        print (__doc__)
+        sys.exit (1)
+    main (sys.argv [1], sys.argv [2])